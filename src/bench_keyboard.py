@@ -0,0 +1,98 @@
+import asyncio
+import random
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import keyboard
+import router
+
+RENDERS = 20000
+
+
+def old_ch_choose_button(available_courses=None, mode='buy', selected=None, menu_path='def'):
+    # Прежний keyboard.ch_choose_button: кнопки и callback_data собираются заново на каждый вызов
+    chapter_order = ['ch_1', 'ch_2', 'ch_3', 'ch_4', 'ch_5', 'ch_6', 'ch_7']
+    keyboard = []
+    selected = selected or []
+    for key in chapter_order:
+        if available_courses is None or key in available_courses:
+            course = config.courses[key]
+            num_of_chapter = key.split('_')[1]
+            name = course['short_name'] + course['emoji']
+            if mode == 'multi_buy' and key in selected:
+                name = '✅ ' + name
+            keyboard.append([InlineKeyboardButton(text=name, callback_data=f'{mode}_chapter:{num_of_chapter}:{menu_path}')])
+    return keyboard
+
+
+def old_multi_buy_menu(available, selected):
+    keyboard = old_ch_choose_button(available_courses=available, mode='multi_buy', selected=selected)
+    keyboard += [[InlineKeyboardButton(text=label, callback_data=f'{key}_buy_multiply')]
+                 for key, label in config.bot_btn['buy_multiply']['menu'].items()]
+    keyboard.append([InlineKeyboardButton(text=config.bot_btn['main_menu_main'], callback_data='main_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def old_my_courses(available):
+    # Прежний my_courses_command: клавиатура пересобиралась на каждый курс пользователя
+    keyboard = []
+    for course_key in available:
+        if config.courses.get(course_key):
+            keyboard = old_ch_choose_button(available_courses=available, menu_path='my_courses')
+    keyboard.append([InlineKeyboardButton(text=config.bot_btn['main_menu_main'], callback_data='main_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def new_multi_buy_menu(available, selected):
+    return keyboard.course_menu(mode='multi_buy', available=available, selected=selected,
+                                footer=('multi_buy_menu', 'main_menu'))
+
+
+def new_my_courses(available):
+    return keyboard.course_menu(available=available, menu_path='my_courses', footer=('main_menu',))
+
+
+def layout(markup: InlineKeyboardMarkup) -> list:
+    # Старые и новые callback_data ведут к одному действию с теми же аргументами
+    return [[(button.text, router.parse(button.callback_data)) for button in row] for row in markup.inline_keyboard]
+
+
+def bench(name: str, old, new, cases: list):
+    for args in cases[:50]:
+        assert layout(old(*args)) == layout(new(*args)), f"{name}: клавиатуры различаются"
+
+    started = time.perf_counter()
+    for args in cases:
+        old(*args)
+    old_time = time.perf_counter() - started
+
+    keyboard.invalidate()
+    started = time.perf_counter()
+    for args in cases:
+        new(*args)
+    new_time = time.perf_counter() - started
+
+    print(f"{name:<12} | {len(cases) / old_time:>12,.0f} | {len(cases) / new_time:>12,.0f} | "
+          f"{old_time / new_time:>6.1f}x")
+
+
+async def main():
+    random.seed(1)
+    chapters = list(keyboard.CHAPTER_ORDER)
+
+    def random_set(keys):
+        return [key for key in keys if random.random() < 0.5]
+
+    # Выбирают только из доступных к покупке
+    multi_buy = [(available, random_set(available)) for available in (random_set(chapters) for _ in range(RENDERS))]
+    my_courses = [(random_set(chapters),) for _ in range(RENDERS)]
+
+    print("Меню        | было, меню/с |  стало, меню/с | ускорение")
+    bench('multi_buy', old_multi_buy_menu, new_multi_buy_menu, multi_buy)
+    bench('my_courses', old_my_courses, new_my_courses, my_courses)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+import asyncio
+import random
+import string
+import time
+
+from order_codes import OrderCodeAllocator
+
+# Имитация задержки одного запроса к БД (сеть + Postgres)
+DB_LATENCY = 0.001
+ORDERS = 500
+CODE_SPACE = 100000
+
+
+class FakeDatabase:
+    """
+    База в памяти: считает запросы и добавляет к каждому DB_LATENCY.
+    """
+
+    def __init__(self, occupancy: float):
+        self.round_trips = 0
+        self.used = set(random.sample(range(CODE_SPACE), int(CODE_SPACE * occupancy)))
+        self.seq = CODE_SPACE
+
+    async def check_order_code_unique(self, order_code: str) -> bool:
+        self.round_trips += 1
+        await asyncio.sleep(DB_LATENCY)
+        return int(order_code) not in self.used
+
+    async def reserve_order_code_block(self) -> tuple[int, int]:
+        self.round_trips += 1
+        await asyncio.sleep(DB_LATENCY)
+        start, self.seq = self.seq, self.seq + 100
+        return start, 100
+
+
+async def old_generate_order_number(db: FakeDatabase):
+    # Прежний цикл из other_func: случайный код + проверка в БД на каждую попытку
+    while True:
+        number = ''.join(random.choices(string.digits, k=5))
+        if await db.check_order_code_unique(number):
+            return number
+
+
+async def bench(occupancy: float):
+    db = FakeDatabase(occupancy)
+    started = time.perf_counter()
+    for _ in range(ORDERS):
+        db.used.add(int(await old_generate_order_number(db)))
+    old_time = time.perf_counter() - started
+    old_trips = db.round_trips
+
+    db = FakeDatabase(occupancy)
+    allocator = OrderCodeAllocator(db)
+    started = time.perf_counter()
+    for _ in range(ORDERS):
+        await allocator.allocate()
+    new_time = time.perf_counter() - started
+
+    print(f"{occupancy:>5.0%} | {old_trips / ORDERS:>10.2f} {old_time / ORDERS * 1000:>8.3f} ms"
+          f" | {db.round_trips / ORDERS:>10.2f} {new_time / ORDERS * 1000:>8.3f} ms")
+
+
+async def main():
+    print("Занято | retry-цикл: запросов/заказ, время | аллокатор: запросов/заказ, время")
+    for occupancy in (0.0, 0.5, 0.9, 0.97):
+        await bench(occupancy)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import asyncio
+import random
+import time
+import warnings
+from datetime import datetime
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.ext import CallbackQueryHandler, ConversationHandler
+from telegram.warnings import PTBUserWarning
+
+import router
+from bot import callback_router
+
+UPDATES = 100000
+
+
+async def noop(update, context):
+    pass
+
+
+def old_handlers() -> list:
+    warnings.filterwarnings('ignore', category=PTBUserWarning)
+    # Прежний порядок регистрации в bot.run: ~20 CallbackQueryHandler с regex и ConversationHandler в конце
+    patterns = [
+        "^buy_courses$", "^buy_chapter:", "^buy_multiply$", "^multi_buy_chapter:", "^go_back:",
+        "^clear_buy_multiply$", "^upd_payment_url:", "^main_menu$", "^my_courses$",
+        r"^(all_courses|go_back_buy_multiply)$", "^documents$", "^support$", "^grant_access:", "^deny_access:",
+    ]
+    handlers = [CallbackQueryHandler(noop, pattern=pattern) for pattern in patterns]
+    handlers.append(ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(noop, pattern="^pay_chapter:"),
+            CallbackQueryHandler(noop, pattern="^confirm_buy_multiply$")
+        ],
+        states={
+            0: [CallbackQueryHandler(noop, pattern="^agree_offer:")],
+            1: [CallbackQueryHandler(noop, pattern="^agree_privacy:")],
+            2: [CallbackQueryHandler(noop, pattern="^(agree_newsletter:|disagree_newsletter:)")],
+        },
+        fallbacks=[CallbackQueryHandler(noop, pattern="^cancel$")],
+        allow_reentry=True
+    ))
+    return handlers
+
+
+def old_dispatch(handlers: list, update: Update):
+    # Application.process_update: check_update по очереди до первого совпадения, затем split в обработчике
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler, update.callback_query.data.split(':')
+    return None
+
+
+def new_dispatch(handler: CallbackQueryHandler, update: Update):
+    if handler.check_update(update):
+        return callback_router.resolve(update.callback_query.data)
+    return None
+
+
+def make_update(update_id: int, data: str) -> Update:
+    user = User(id=1000 + update_id % 500, first_name='U', is_bot=False)
+    chat = Chat(id=user.id, type=Chat.PRIVATE)
+    message = Message(message_id=1, date=datetime.now(), chat=chat)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), user, 'ci', message=message, data=data))
+
+
+def sample(rng: random.Random) -> tuple[str, str]:
+    """
+    Кнопка примерно с той частотой, с какой её нажимают: (старый формат, новый формат).
+    """
+    num = rng.randint(1, 7)
+    path = rng.choice(['default', 'my_courses', 'all_courses'])
+    token = f"{rng.getrandbits(32):08x}"
+    user_id = rng.randint(10 ** 8, 10 ** 10)
+    return rng.choices([
+        (f"buy_chapter:{num}:{path}", router.pack(router.BUY_CHAPTER, num, path)),
+        (f"multi_buy_chapter:{num}:def", router.pack(router.MULTI_BUY_CHAPTER, num, 'def')),
+        ("main_menu", router.pack(router.MAIN_MENU)),
+        ("buy_courses", router.pack(router.BUY_COURSES)),
+        (f"go_back:{path}", router.pack(router.GO_BACK, path)),
+        ("my_courses", router.pack(router.MY_COURSES)),
+        (f"pay_chapter:{num}", router.pack(router.PAY_CHAPTER, num)),
+        (f"agree_offer:{token}", router.pack(router.AGREE_OFFER, token)),
+        (f"agree_privacy:{token}", router.pack(router.AGREE_PRIVACY, token)),
+        (f"disagree_newsletter:{token}", router.pack(router.AGREE_NEWSLETTER, token, 0)),
+        ("cancel", router.pack(router.CANCEL)),
+        (f"grant_access:{user_id}:ch_{num}", router.pack(router.GRANT_ACCESS, user_id, f"ch_{num}")),
+    ], weights=[30, 15, 15, 10, 8, 6, 5, 3, 3, 2, 2, 1])[0]
+
+
+def check_limit():
+    # Самые длинные кнопки бота с запасом: user_id в 13 цифр и ключ раздела
+    longest = router.pack(router.GRANT_ACCESS, 10 ** 13, 'ch_7')
+    assert len(longest.encode()) <= router.MAX_CALLBACK_DATA
+    try:
+        router.pack(router.GRANT_ACCESS, 'x' * 70)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("pack пропустил callback_data длиннее 64 байт")
+    print(f"callback_data: самая длинная кнопка {len(longest.encode())} байт из {router.MAX_CALLBACK_DATA}")
+
+
+async def main():
+    check_limit()
+
+    rng = random.Random(1)
+    pairs = [sample(rng) for _ in range(UPDATES)]
+    old_updates = [make_update(i, old) for i, (old, _) in enumerate(pairs)]
+    new_updates = [make_update(i, new) for i, (_, new) in enumerate(pairs)]
+
+    # Старые callback_data (уже отправленные кнопки) ведут туда же, куда новые
+    for old, new in pairs[:1000]:
+        assert callback_router.resolve(old) == callback_router.resolve(new), f"{old} != {new}"
+
+    handlers = old_handlers()
+    started = time.perf_counter()
+    for update in old_updates:
+        old_dispatch(handlers, update)
+    old_time = time.perf_counter() - started
+
+    handler = callback_router.handler()
+    started = time.perf_counter()
+    for update in new_updates:
+        new_dispatch(handler, update)
+    new_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for update in old_updates:
+        new_dispatch(handler, update)
+    legacy_time = time.perf_counter() - started
+
+    print("Разбор                   | мкс/апдейт")
+    print(f"regex-обработчики        | {old_time / UPDATES * 1e6:>10.2f}")
+    print(f"роутер, новый формат     | {new_time / UPDATES * 1e6:>10.2f}  ({old_time / new_time:.1f}x)")
+    print(f"роутер, старый формат    | {legacy_time / UPDATES * 1e6:>10.2f}")
+    sizes = [len(new.encode()) for _, new in pairs]
+    old_sizes = [len(old.encode()) for old, _ in pairs]
+    print(f"callback_data, байт в среднем: было {sum(old_sizes) / UPDATES:.1f}, стало {sum(sizes) / UPDATES:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+import config
+import telegram_https
+
+MESSAGES = 500
+CONCURRENCY = 20
+
+
+async def fake_bot_api(request: web.Request) -> web.Response:
+    # Локальный фейк Bot API: принимает любой метод и отвечает ok
+    await request.json()
+    return web.json_response({'ok': True, 'result': {'message_id': 1}})
+
+
+async def old_send_message(user_id: int, text: str):
+    # Прежний вариант: новая сессия (и новое TCP/TLS соединение) на каждое сообщение
+    async with aiohttp.ClientSession() as session:
+        url = f"{telegram_https.API_URL}/bot{config.config_env['TELEGRAM_TOKEN']}/sendMessage"
+        payload = {'chat_id': user_id, 'text': text, 'parse_mode': 'HTML'}
+        async with session.post(url, json=payload) as response:
+            await response.json()
+
+
+async def new_send_message(user_id: int, text: str):
+    # Сразу _post, мимо Dispatcher: сравниваем переиспользование соединений, а не лимиты Telegram
+    await telegram_https._post('sendMessage', {'chat_id': user_id, 'text': text, 'parse_mode': 'HTML'})
+
+
+async def bench(name: str, send):
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        await send(i, 'test')
+    sequential = time.perf_counter() - started
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def limited(i):
+        async with semaphore:
+            await send(i, 'test')
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(MESSAGES)))
+    concurrent = time.perf_counter() - started
+
+    print(f"{name:<22} | {sequential / MESSAGES * 1000:>8.3f} ms/сообщение"
+          f" | {MESSAGES / concurrent:>8.0f} сообщений/с при {CONCURRENCY} параллельно")
+
+
+async def main():
+    app = web.Application()
+    app.router.add_post('/{path:.*}', fake_bot_api)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    # Без TLS: против api.telegram.org выигрыш больше на стоимость TLS-рукопожатия
+    telegram_https.API_URL = f"http://127.0.0.1:{port}"
+
+    await telegram_https.start()
+    try:
+        await bench("сессия на сообщение", old_send_message)
+        await bench("общая сессия", new_send_message)
+    finally:
+        await telegram_https.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
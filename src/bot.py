@@ -5,6 +5,7 @@ import logging
 import traceback
 import html
 import re
+import secrets
 import time as time_new
 from datetime import time, datetime, timedelta
 from pathlib import Path
@@ -12,28 +13,34 @@ from pathlib import Path
 import pytz
 import telegram
 import other_func
-from setup import pdb
+from setup import pdb, media_registry, broadcast_jobs, segments, campaigns, join_requests
 import config
 import yaml
 import keyboard as my_keyboard
+from catalog import catalog
+import router
+from router import CallbackRouter, flag, pack
+from campaigns import CHECK_INTERVAL as CAMPAIGN_CHECK_INTERVAL, USAGE as CAMPAIGN_USAGE, parse_campaign_args
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, BotCommand, ReplyKeyboardMarkup, \
     ReplyKeyboardRemove, KeyboardButton, InputMediaPhoto, InputMediaDocument
 from telegram.constants import ParseMode, ChatAction
-from telegram.error import RetryAfter, BadRequest
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     ApplicationBuilder,
     CommandHandler,
-    CallbackQueryHandler,
-    ConversationHandler,
     CallbackContext,
     MessageHandler,
     TypeHandler,
     JobQueue,
     AIORateLimiter,
     ChatJoinRequestHandler,
+    ChatMemberHandler,
     filters)
 
+import migrate
+import telegram_https
+from broadcast import unreachable_reason
 import payment
 
 # Установка русской локали
@@ -77,7 +84,7 @@ def is_valid_email(email: str) -> bool:
 
 
 async def user_exists_pdb(user_id: int) -> bool:
-    return pdb.user_exists(user_id)
+    return await pdb.user_exists(user_id)
 
 
 
@@ -163,19 +170,16 @@ async def register(update: Update, context: CallbackContext) -> int:
 
     # Добавление пользователя в БД
     if not await user_exists_pdb(user_id):
-        pdb.add_user(user_id, username, first_name, last_name)
+        await pdb.add_user(user_id, username, first_name, last_name)
+    else:
+        # Написал сам — значит, снова доступен для рассылок
+        await pdb.mark_users_reachable([user_id])
 
-    keyboard = [[InlineKeyboardButton(config.bot_btn['buy_courses'], callback_data='buy_courses')]]
+    keyboard = [[InlineKeyboardButton(config.bot_btn['buy_courses'], callback_data=pack(router.BUY_COURSES))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    video_path = config.media_dir / "video.mp4"
-
     try:
-        with open(video_path, 'rb') as video:
-            await context.bot.send_video_note(
-                chat_id=user_id,
-                video_note=video
-            )
+        await media_registry.send(context.bot, user_id, "video.mp4", 'video_note')
         await asyncio.sleep(5)
     except telegram.error.BadRequest as e:
         logger.info(f"Ошибка при отправке video note: {e}")
@@ -188,14 +192,12 @@ async def register(update: Update, context: CallbackContext) -> int:
         parse_mode=ParseMode.HTML
     )
 
-    return ConversationHandler.END
-
 
 async def my_courses_command(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
 
     # Получаем все доступные курсы
-    available_courses = pdb.get_all_user_courses(user_id)
+    available_courses = await pdb.get_all_user_courses(user_id)
     menu_path = 'my_courses'
 
     if not available_courses:
@@ -205,15 +207,7 @@ async def my_courses_command(update: Update, context: CallbackContext) -> None:
         await send_or_edit_message(update, context, text, reply_markup)
         return
 
-    keyboard = []
-
-    for course_key in available_courses:
-        course = config.courses.get(course_key)
-        if course:
-            keyboard = my_keyboard.ch_choose_button(available_courses=available_courses, menu_path=menu_path)
-
-    keyboard.extend(my_keyboard.main_menu_button_markup())  # <-- исправлено
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = my_keyboard.course_menu(available=available_courses, menu_path=menu_path, footer=('main_menu',))
 
     text = "Ваши доступные курсы. Нажмите, чтобы перейти:"
     await send_or_edit_message(update, context, text, reply_markup)
@@ -226,11 +220,7 @@ async def my_courses_callback_handle(update: Update, context: CallbackContext) -
 
 
 async def all_courses_command(update: Update, context: CallbackContext) -> None:
-    keyboard = my_keyboard.ch_choose_button(menu_path='all_courses')
-
-    keyboard.extend(my_keyboard.buy_multiply_button_markup())
-    keyboard.extend(my_keyboard.main_menu_button_markup())
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = my_keyboard.course_menu(menu_path='all_courses', footer=('buy_multiply', 'main_menu'))
     text = config.bot_msg['choose_chapter']
     await send_or_edit_message(update, context, text, reply_markup)
 
@@ -242,18 +232,7 @@ async def all_courses_callback_handle(update: Update, context: CallbackContext)
 
 
 async def documents_command(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    person_info_text = config.other_cfg["person_info"]
-    offer_text = f'<a href="{config.other_cfg["links"]["offer"]}">Ознакомиться с офертой</a>'
-    privacy_text = f'<a href="{config.other_cfg["links"]["privacy"]}">Ознакомиться с политикой обработки персональных данных</a>'
-    consent_text = f'<a href="{config.other_cfg["links"]["consent"]}">Ознакомиться с документом на получение рекламной и информационной рассылки</a>'
-    text = person_info_text + "\n\n" + offer_text + "\n\n" + privacy_text + "\n\n" + consent_text
-
-    keyboard = [
-        [InlineKeyboardButton("📲 Главное меню", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await send_or_edit_message(update, context, text, reply_markup)
+    await send_or_edit_message(update, context, catalog.documents_text, my_keyboard.main_menu_markup())
 
 
 async def documents_callback_handle(update: Update, context: CallbackContext) -> None:
@@ -285,10 +264,7 @@ async def main_menu_callback_handle(update: Update, context: CallbackContext) ->
 
 
 async def buy_courses_command(update: Update, context: CallbackContext) -> None:
-    keyboard = my_keyboard.ch_choose_button(menu_path = 'default')
-
-    keyboard.extend(my_keyboard.buy_multiply_button_markup())
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = my_keyboard.course_menu(menu_path='default', footer=('buy_multiply',))
     text = config.bot_msg['choose_chapter']
     await send_or_edit_message(update, context, text, reply_markup)
 
@@ -309,48 +285,22 @@ async def buy_courses_callback_handle(update: Update, context: CallbackContext)
 
 
 # Детали конкретного курса
-async def buy_chapter_callback_handle(update: Update, context: CallbackContext) -> None:
+async def buy_chapter_callback_handle(update: Update, context: CallbackContext, num_of_chapter: str,
+                                      menu_path: str = 'default') -> None:
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
-    num_of_chapter = query.data.split(':')[1]
-    try:
-        menu_path = query.data.split(':')[2]
-    except Exception:
-        menu_path = 'default'
-
-    chapter_mask = f'ch_{num_of_chapter}'
-    course = config.courses.get(chapter_mask)
+    course = catalog.get_by_num(num_of_chapter)
 
     if not course:
         await query.edit_message_text("Раздел не найден.")
         return
 
-    text = config.bot_msg['buy_chapter_info'].format(
-        name=course['name'] + course['emoji'],
-        description=course['description'],
-        price=course['price']
-    )
-
-    keyboard = []
-
-    if pdb.has_paid_course(user_id, chapter_mask) or pdb.has_manual_access(user_id, chapter_mask):
-        keyboard.append([
-            InlineKeyboardButton(config.bot_btn['go_to_channel'], url=course['channel_invite_link'])
-        ])
-    else:
-        keyboard.append([
-            InlineKeyboardButton(config.bot_btn['go_to_pay'], callback_data=f'pay_chapter:{num_of_chapter}')
-        ])
-
-    keyboard.append([
-        InlineKeyboardButton(config.bot_btn['go_back'], callback_data=f'go_back:{menu_path}')
-    ])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    owned = await pdb.has_paid_course(user_id, course.key) or await pdb.has_manual_access(user_id, course.key)
+    reply_markup = my_keyboard.chapter_info_menu(course.num, menu_path, bool(owned))
     await query.edit_message_text(
-        text=text,
+        text=course.info_text,
         reply_markup=reply_markup,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True
@@ -358,44 +308,22 @@ async def buy_chapter_callback_handle(update: Update, context: CallbackContext)
 
 
 # Переход к оплате
-async def pay_chapter_callback_handle(update: Update, context: CallbackContext) -> int:
+async def pay_chapter_callback_handle(update: Update, context: CallbackContext, num_of_chapter: str) -> None:
     query = update.callback_query
     await query.answer()
-    user_id = query.from_user.id
 
-    num_of_chapter = query.data.split(':')[1]
-    course_mask = f'ch_{num_of_chapter}'
-    course = config.courses.get(course_mask)
+    course = catalog.get_by_num(num_of_chapter)
 
     if not course:
         await query.edit_message_text("Курс не найден.")
-        return ConversationHandler.END
-
-    order_code = other_func.generate_order_number()
-    order_id = pdb.create_order(user_id=user_id, course_chapter=[course_mask], order_code=order_code)
-    context.user_data['selected_course'] = course
-    context.user_data['chapter_number'] = num_of_chapter
-    context.user_data['order_id'] = order_id
+        return
 
     context.user_data['is_in_conversation'] = True
 
-    keyboard = [
-        [InlineKeyboardButton("✅ Принимаю", callback_data=f"agree_offer:{order_code}")],
-        [InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await query.edit_message_text(
-        text=f'📄 Я ознакомился и принимаю условия <a href="{config.other_cfg["links"]["offer"]}">Публичной оферты.</a>',
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True
-    )
-    # return AGREE_OFFER
-    return await start_payment_handle(update, context, [course_mask])
+    await start_payment_handle(update, context, [course.key])
 
 
-async def confirm_multi_buy_handle(update: Update, context: CallbackContext) -> int:
+async def confirm_multi_buy_handle(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
 
@@ -404,29 +332,30 @@ async def confirm_multi_buy_handle(update: Update, context: CallbackContext) ->
 
     if not selected_courses:
         await query.edit_message_text("❗️Вы не выбрали ни одного курса.")
-        return ConversationHandler.END
+        return
 
     context.user_data['is_in_conversation'] = True
     context.user_data['multi_buy_selected'] = selected_courses
 
     # Переход в общий обработчик запуска оплаты
-    return await start_payment_handle(update, context, selected_courses)
+    await start_payment_handle(update, context, selected_courses)
 
 
-async def start_payment_handle(update: Update, context: CallbackContext, selected_courses: list) -> int:
+# Шаги оформления: на каком шаге пользователь, хранится в user_data['checkout_step'];
+# кнопки и e-mail, пришедшие не на своём шаге, не принимаются
+async def start_payment_handle(update: Update, context: CallbackContext, selected_courses: list) -> None:
     query = update.callback_query
-    user_id = query.from_user.id
-
-    order_code = other_func.generate_order_number()
-    order_id = pdb.create_order(user_id=user_id, course_chapter=selected_courses, order_code=order_code)
 
+    # Заказ в БД создаётся только на шаге e-mail, а до него
+    # кнопки согласий несут лёгкий токен сессии оформления
+    checkout_token = secrets.token_hex(4)
     context.user_data['selected_courses'] = selected_courses
-    context.user_data['order_id'] = order_id
-    context.user_data['order_code'] = order_code
+    context.user_data['checkout_token'] = checkout_token
+    context.user_data['checkout_step'] = AGREE_OFFER
 
     keyboard = [
-        [InlineKeyboardButton("✅ Принимаю", callback_data=f"agree_offer:{order_code}")],
-        [InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]
+        [InlineKeyboardButton("✅ Принимаю", callback_data=pack(router.AGREE_OFFER, checkout_token))],
+        [InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -436,19 +365,32 @@ async def start_payment_handle(update: Update, context: CallbackContext, selecte
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True
     )
-    return AGREE_OFFER
+
+
+# Кнопка из текущей сессии оформления и для текущего шага, а не из старого сообщения?
+async def is_current_checkout(query, context: CallbackContext, checkout_token: str, step: int) -> bool:
+    if checkout_token == context.user_data.get('checkout_token') and step == context.user_data.get('checkout_step'):
+        return True
+    await query.edit_message_text(
+        text="Оформление устарело. Пожалуйста, начните покупку заново.",
+        reply_markup=InlineKeyboardMarkup(my_keyboard.main_menu_button_markup())
+    )
+    return False
 
 
 # Шаг 2 — согласие на обработку ПДн
-async def handle_offer_agree(update: Update, context: CallbackContext) -> int:
+async def handle_offer_agree(update: Update, context: CallbackContext, checkout_token: str) -> None:
     query = update.callback_query
     await query.answer()
 
-    order_code = query.data.split(':')[1]
-    pdb.update_agreed_offer(order_code, True)
+    if not await is_current_checkout(query, context, checkout_token, AGREE_OFFER):
+        return
+    # Согласия копим в сессии и сохраняем вместе с заказом на шаге e-mail
+    context.user_data['agreed_offer_at'] = datetime.now(moscow_tz)
+    context.user_data['checkout_step'] = AGREE_PRIVACY
 
-    keyboard = [[InlineKeyboardButton("✅ Даю согласие", callback_data=f"agree_privacy:{order_code}")],
-                [InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]]
+    keyboard = [[InlineKeyboardButton("✅ Даю согласие", callback_data=pack(router.AGREE_PRIVACY, checkout_token))],
+                [InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.CANCEL))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(
@@ -457,20 +399,21 @@ async def handle_offer_agree(update: Update, context: CallbackContext) -> int:
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True
     )
-    return AGREE_PRIVACY
 
 
 # Шаг 3 — согласие на рассылку
-async def handle_privacy_agree(update: Update, context: CallbackContext) -> int:
+async def handle_privacy_agree(update: Update, context: CallbackContext, checkout_token: str) -> None:
     query = update.callback_query
     await query.answer()
-    order_code = query.data.split(':')[1]
-    pdb.update_agreed_privacy(order_code, True)
+    if not await is_current_checkout(query, context, checkout_token, AGREE_PRIVACY):
+        return
+    context.user_data['agreed_privacy_at'] = datetime.now(moscow_tz)
+    context.user_data['checkout_step'] = AGREE_NEWSLETTER
 
     keyboard = [
-        [InlineKeyboardButton("✅ Я согласен", callback_data=f"agree_newsletter:{order_code}")],
-        [InlineKeyboardButton("❌ Не согласен", callback_data=f"disagree_newsletter:{order_code}")],
-        [InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]
+        [InlineKeyboardButton("✅ Я согласен", callback_data=pack(router.AGREE_NEWSLETTER, checkout_token, 1))],
+        [InlineKeyboardButton("❌ Не согласен", callback_data=pack(router.AGREE_NEWSLETTER, checkout_token, 0))],
+        [InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -480,55 +423,65 @@ async def handle_privacy_agree(update: Update, context: CallbackContext) -> int:
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True
     )
-    return AGREE_NEWSLETTER
 
 
 # Шаг 4 — e-mail
-async def handle_newsletter_agree(update: Update, context: CallbackContext) -> int:
+async def handle_newsletter_agree(update: Update, context: CallbackContext, checkout_token: str,
+                                  agreement_newsletter_bool: bool) -> None:
     query = update.callback_query
     await query.answer()
-    agreement_newsletter, order_code = query.data.split(':')
-    if agreement_newsletter == 'agree_newsletter':
-        agreement_newsletter_bool = True
-    else:
-        agreement_newsletter_bool = False
+    if not await is_current_checkout(query, context, checkout_token, AGREE_NEWSLETTER):
+        return
 
     keyboard = [
-        [InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]
+        [InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     email_msg = await query.edit_message_text(text="📧 Введите ваш e-mail для отправки чека:",
                                               reply_markup=reply_markup)
-    pdb.update_agreed_newsletter(order_code, agreement_newsletter_bool)
+    context.user_data['agreed_newsletter'] = agreement_newsletter_bool
+    context.user_data['agreed_newsletter_at'] = datetime.now(moscow_tz)
 
     context.user_data['email_msg'] = email_msg
-    context.user_data['order_code'] = order_code
-    return ASK_EMAIL
+    context.user_data['checkout_step'] = ASK_EMAIL
 
 
 # Шаг 5 — обработка e-mail и оплата
-async def ask_email_handle(update: Update, context: CallbackContext) -> int:
+async def ask_email_handle(update: Update, context: CallbackContext) -> None:
+    # Текст вне оформления — не e-mail
+    if context.user_data.get('checkout_step') != ASK_EMAIL:
+        return
     logger.info("📨 Получен email от пользователя")
     email = update.message.text.strip()
 
     if not is_valid_email(email):
-        keyboard = [[InlineKeyboardButton("🚫 Отмена", callback_data='cancel')]]
+        keyboard = [[InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.CANCEL))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             text="Некорректный e-mail. Пожалуйста, введите корректный e-mail:",
             reply_markup=reply_markup
         )
-        return ASK_EMAIL
+        return
 
-    order_code = context.user_data['order_code']
-    order_id = context.user_data['order_id']
     selected_courses = context.user_data.get('selected_courses', [])  # список course_key
-    pdb.update_email(order_code, email)
     context.user_data['email'] = email
 
     email_msg = context.user_data.get('email_msg')
     user_id = update.effective_user.id
 
+    # Покупатель дошёл до оплаты — только теперь создаём заказ, сразу со всеми согласиями
+    order_code = await other_func.generate_order_number()
+    order_id = await pdb.create_order(
+        user_id=user_id,
+        course_chapter=selected_courses,
+        order_code=order_code,
+        email=email,
+        agreed_offer_at=context.user_data.get('agreed_offer_at'),
+        agreed_privacy_at=context.user_data.get('agreed_privacy_at'),
+        agreed_newsletter=context.user_data.get('agreed_newsletter'),
+        agreed_newsletter_at=context.user_data.get('agreed_newsletter_at')
+    )
+
     try:
         if email_msg:
             await context.bot.delete_message(chat_id=user_id, message_id=email_msg.message_id)
@@ -536,37 +489,21 @@ async def ask_email_handle(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Ошибка удаления сообщения: {e}")
 
-    text_lines = [config.bot_msg['confirm_purchase_header'].format(email=email)]
-    # Заголовок
-
-    # Каждая строка курса
-    total_price = 0
-    for course_key in selected_courses:
-        course = config.courses[course_key]
-        line = config.bot_msg['confirm_purchase_course_line'].format(
-            name=course['name'] + course['emoji'],
-            price=course['price']
-        )
-        text_lines.append(line)
-        total_price += course['price']
-
-    # Итог
-    text_lines.append(config.bot_msg['confirm_purchase_footer'].format(total=total_price))
-
-    text = "\n".join(text_lines)
+    # Заголовок, готовые строки разделов из каталога и итог
+    text, total_price = catalog.confirm_purchase_text(email, selected_courses)
 
     # Создаём платёж (убедись, что функция поддерживает многокурсовую оплату)
     payment_url = payment.create_payment_robokassa(
         price=total_price,
         email=email,
-        num_of_chapter=",".join([key.split('_')[1] for key in selected_courses]),
+        num_of_chapter=",".join(catalog.get(key).num for key in selected_courses if key in catalog),
         order_code=order_code,
         order_id=order_id,
         user_id=user_id)
 
     keyboard = [
         [InlineKeyboardButton("✅ Подтвердить и оплатить", url=payment_url)],
-        [InlineKeyboardButton("🚫 Отмена", callback_data='main_menu')]
+        [InlineKeyboardButton("🚫 Отмена", callback_data=pack(router.MAIN_MENU))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -576,25 +513,19 @@ async def ask_email_handle(update: Update, context: CallbackContext) -> int:
         parse_mode=ParseMode.HTML
     )
     payment_message_id = payment_message.message_id
-    pdb.update_payment_message_id(order_code, payment_message_id)
+    await pdb.update_payment_message_id(order_code, payment_message_id)
 
     context.user_data.clear()
-    return ConversationHandler.END
 
 
 # Отмена
-async def cancel_payment_handle(update: Update, context: CallbackContext) -> int:
+async def cancel_payment_handle(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
 
     context.user_data.clear()
-    keyboard = [
-        [InlineKeyboardButton("📲 Главное меню", callback_data='main_menu')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text="Покупка отменена. Возвращайтесь позже.",
-                                  reply_markup=reply_markup)
-    return ConversationHandler.END
+                                  reply_markup=my_keyboard.main_menu_markup())
 
 
 async def buy_multiply_callback_handle(update: Update, context: CallbackContext) -> None:
@@ -602,7 +533,7 @@ async def buy_multiply_callback_handle(update: Update, context: CallbackContext)
     await query.answer()
 
     user_id = query.from_user.id
-    not_bought_courses = pdb.get_not_bought_courses(user_id)
+    not_bought_courses = await pdb.get_not_bought_courses(user_id)
     not_bought_courses = [ch for ch in not_bought_courses if ch != "ch_1"]
 
     if not not_bought_courses:
@@ -612,14 +543,12 @@ async def buy_multiply_callback_handle(update: Update, context: CallbackContext)
         # Получаем уже выбранные курсы из context.user_data
         selected = context.user_data.get("multi_buy_selected", [])
 
-        keyboard = my_keyboard.ch_choose_button(
-            available_courses=not_bought_courses,
+        reply_markup = my_keyboard.course_menu(
             mode='multi_buy',
-            selected=selected
+            available=not_bought_courses,
+            selected=selected,
+            footer=('multi_buy_menu', 'main_menu')
         )
-        keyboard += my_keyboard.buy_multiply_menu_items_button()
-        keyboard.extend(my_keyboard.main_menu_button_markup())
-        reply_markup = InlineKeyboardMarkup(keyboard)
         text = "Выберите разделы, которые хотите купить. Нажмите ещё раз, чтобы снять выбор."
 
     await query.edit_message_text(
@@ -629,13 +558,12 @@ async def buy_multiply_callback_handle(update: Update, context: CallbackContext)
     )
 
 
-async def toggle_multi_buy_chapter(update: Update, context: CallbackContext) -> None:
+async def toggle_multi_buy_chapter(update: Update, context: CallbackContext, chapter_num: str,
+                                   menu_path: str = 'def') -> None:
     query = update.callback_query
     await query.answer()
 
     user_id = query.from_user.id
-    data = query.data  # Пример: "multi_buy_chapter:1"
-    chapter_num = data.split(":")[1]
     chapter_key = f"ch_{chapter_num}"
 
     selected = context.user_data.get("multi_buy_selected", [])
@@ -647,17 +575,15 @@ async def toggle_multi_buy_chapter(update: Update, context: CallbackContext) ->
 
     context.user_data["multi_buy_selected"] = selected
 
-    not_bought_courses = pdb.get_not_bought_courses(user_id)
+    not_bought_courses = await pdb.get_not_bought_courses(user_id)
     not_bought_courses = [ch for ch in not_bought_courses if ch != "ch_7"]
 
-    keyboard = my_keyboard.ch_choose_button(
-        available_courses=not_bought_courses,
+    reply_markup = my_keyboard.course_menu(
         mode='multi_buy',
-        selected=selected
+        available=not_bought_courses,
+        selected=selected,
+        footer=('multi_buy_menu', 'main_menu')
     )
-    keyboard += my_keyboard.buy_multiply_menu_items_button()
-    keyboard.extend(my_keyboard.main_menu_button_markup())
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(
         text="Выберите разделы, которые хотите купить. Нажмите ещё раз, чтобы снять выбор.",
@@ -671,22 +597,20 @@ async def clear_selected_multi_buy_callback_handle(update: Update, context: Call
     await buy_multiply_callback_handle(update, context)
 
 
-async def upd_payment_url_handle(update: Update, context: CallbackContext) -> None:
+async def upd_payment_url_handle(update: Update, context: CallbackContext, order_code: int) -> None:
     query = update.callback_query
     await query.answer()
-    data = query.data
 
-    order_code = data.split(':')[1]
-    order_data = pdb.get_order_by_code(int(order_code))
+    order_data = await pdb.get_order_by_code(order_code)
 
-    course = config.courses.get(order_data['course_chapter'])
+    course = catalog.get(order_data['course_chapter'])
     user_id = order_data['user_id']
     email = order_data['email']
-    num = order_data['course_chapter'].split('_')[1]
+    num = course.num
     order_id = order_data['order_id']
 
     payment_url = await payment.create_payment(
-        price=course['price'],
+        price=course.price,
         user_id=user_id,
         email=email,
         num_of_chapter=num,
@@ -701,16 +625,62 @@ async def upd_payment_url_handle(update: Update, context: CallbackContext) -> No
     payment_message = await query.edit_message_text(
         text=config.bot_msg['confirm_purchase'].format(
             email=email,
-            name=course['name'] + course['emoji'],
+            name=course.title,
             num=num,
-            price=course['price'],
+            price=course.price,
         ),
         reply_markup=reply_markup,
         parse_mode=ParseMode.HTML
     )
 
     payment_message_id = payment_message.message_id
-    pdb.update_payment_message_id(order_code, payment_message_id)
+    await pdb.update_payment_message_id(order_code, payment_message_id)
+
+
+async def handle_my_chat_member(update: Update, context: CallbackContext) -> None:
+    # Пользователь заблокировал / разблокировал бота в личке
+    member_update = update.my_chat_member
+    if member_update.chat.type != 'private':
+        return
+
+    user_id = member_update.chat.id
+    status = member_update.new_chat_member.status
+    if status == 'kicked':
+        await pdb.mark_users_unreachable([(user_id, 'blocked')])
+    elif status == 'member':
+        await pdb.mark_users_reachable([user_id])
+
+
+# Повторная проверка недоступных пользователей: раз в PROBE_INTERVAL берём до PROBE_BATCH
+# тех, кто недоступен дольше PROBE_AFTER_HOURS
+PROBE_INTERVAL = timedelta(hours=6)
+PROBE_AFTER_HOURS = 72
+PROBE_BATCH = 100
+
+
+async def probe_unreachable_users(context: CallbackContext) -> None:
+    user_ids = await pdb.get_unreachable_users_to_probe(PROBE_AFTER_HOURS, PROBE_BATCH)
+    if not user_ids:
+        return
+
+    # send_chat_action ничего не оставляет в чате, но падает с Forbidden, если бот заблокирован
+    results = await asyncio.gather(
+        *(context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING) for user_id in user_ids),
+        return_exceptions=True
+    )
+    reachable = []
+    unreachable = []
+    for user_id, result in zip(user_ids, results):
+        if not isinstance(result, Exception):
+            reachable.append(user_id)
+        elif reason := unreachable_reason(result):
+            unreachable.append((user_id, reason))
+
+    if reachable:
+        await pdb.mark_users_reachable(reachable)
+    # Обновляем время проверки, чтобы в следующий раз взять других
+    await pdb.mark_users_unreachable(unreachable)
+    logger.info(f"🔎 Проверка недоступных: вернулись {len(reachable)}, всё ещё недоступны {len(unreachable)}")
 
 
 async def handle_join_request(update: Update, context: CallbackContext):
@@ -720,75 +690,63 @@ async def handle_join_request(update: Update, context: CallbackContext):
     if user_id == 146679674:
         await join_request.approve()
         return
-    channel_data = config.channel_map.get(chat_id)
-
-    if channel_data:
-        name = channel_data.get('name')
-        channel_invite_link = channel_data.get('channel_invite_link')
-    else:
+    if not catalog.get_by_channel(chat_id):
         return
 
-    course_key = config.channel_id_to_key.get(chat_id)
-    logger.info(f"course_key! = {course_key}")
+    # Доступы проверяются и заявки одобряются пачками (см. join_requests.py)
+    join_requests.submit(context.bot, join_request)
 
-    if pdb.has_manual_access(user_id, course_key) or pdb.has_paid_course(user_id, course_key):
-        await join_request.approve()
-        keyboard = [
-            [InlineKeyboardButton("✅ Перейти в канал", url=channel_invite_link)],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"Для перехода в канал ({name}) нажмите на кнопку ниже",
-            reply_markup=reply_markup
-        )
-        logger.info(f"✅ Одобрен вход для {user_id}")
+
+async def resolve_declined_request(query, user_id: str, result: str):
+    """
+    Отмечает решение по отклонённой заявке. В сводке по нескольким заявкам убирает
+    кнопки этого пользователя и дописывает результат, одиночное сообщение заменяет.
+    """
+    def is_users_button(button) -> bool:
+        # Кнопки grant_access / deny_access: первый аргумент — user_id (старый и новый формат)
+        parsed = router.parse(button.callback_data) if button.callback_data else None
+        return bool(parsed and parsed[1][:1] == [user_id])
+
+    markup = query.message.reply_markup
+    remaining = [
+        row for row in (markup.inline_keyboard if markup else ())
+        if not any(is_users_button(button) for button in row)
+    ]
+    if remaining:
+        await query.edit_message_text(f"{query.message.text}\n{result}", reply_markup=InlineKeyboardMarkup(remaining))
     else:
-        await join_request.decline()
-        keyboard = [
-            [InlineKeyboardButton("✅ Выдать доступ", callback_data=f"grant_access:{user_id}:{course_key}")],
-            [InlineKeyboardButton("❌ Не выдавать доступ", callback_data=f"deny_access:{user_id}:{course_key}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(
-            chat_id=config.cfg['ADMIN_CHAT_ID']['MAIN'],
-            text=f"❌ Пользователь {user_id} был отклонён при попытке вступить в {name}. Хотите выдать ему доступ?",
-            reply_markup=reply_markup,
-            message_thread_id=config.cfg['ADMIN_CHAT_ID']['DECLINED_REQUESTS']
-        )
+        await query.edit_message_text(result)
 
 
-async def grant_manual_access_handle(update: Update, context: CallbackContext):
+async def grant_manual_access_handle(update: Update, context: CallbackContext, user_id: int, course_key: str):
     query = update.callback_query
     await query.answer()
 
-    _, user_id_str, course_key = query.data.split(":")
-    user_id = int(user_id_str)
+    user_id_str = str(user_id)
     admin_id = query.from_user.id
-    course = config.courses.get(course_key)
-    name = course['name'] + course['emoji']
+    name = catalog.get(course_key).title
     # Добавим доступ в manual_access
     try:
-        pdb.grant_manual_access(user_id=user_id, course_chapter=course_key, granted_by=admin_id)
-        await query.edit_message_text(
+        await pdb.grant_manual_access(user_id=user_id, course_chapter=course_key, granted_by=admin_id)
+        await resolve_declined_request(
+            query, user_id_str,
             f"✅ Доступ пользователю {user_id} к курсу {name} успешно выдан. Теперь ему нужно заново перейти в канал.")
     except Exception as e:
         logger.error(f"❌ Ошибка выдачи доступа: {e}")
         await query.edit_message_text("❌ Ошибка при попытке выдать доступ.")
 
 
-async def deny_manual_access(update: Update, context: CallbackContext):
+async def deny_manual_access(update: Update, context: CallbackContext, user_id: int, course_key: str):
     query = update.callback_query
     await query.answer()
-    _, user_id_str, course_key = query.data.split(":")
-    await query.edit_message_text(f"⛔️ Вы отказали в доступе пользователю {user_id_str} к курсу {course_key}.")
+    await resolve_declined_request(query, str(user_id),
+                                   f"⛔️ Вы отказали в доступе пользователю {user_id} к курсу {course_key}.")
 
 
-async def go_back_callback_handle(update: Update, context: CallbackContext) -> None:
+async def go_back_callback_handle(update: Update, context: CallbackContext, menu_path: str) -> None:
     query = update.callback_query
     await query.answer()
 
-    menu_path = query.data.split(':')[1]
     if menu_path == 'all_courses':
         await all_courses_command(update, context)
     elif menu_path == 'my_courses':
@@ -797,77 +755,142 @@ async def go_back_callback_handle(update: Update, context: CallbackContext) -> N
         await buy_courses_command(update, context)
 
 
+# Кто может запускать рассылки и управлять ими (MAILING_ADMIN_IDS в .env — через запятую)
+MAILING_ADMIN_IDS = {
+    int(admin_id) for admin_id in config.config_env.get('MAILING_ADMIN_IDS', '146679674').split(',') if admin_id.strip()
+}
+
+
 async def mail_command(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
 
-    # Список пользователей для рассылки
-    list_data = pdb.get_users_without_course_and_newsletter_decline()
-    list_data = list(set(list_data))
-    # list_data = [146679674, 146679674]
-    successful_sends = 0
-    failed_sends = 0
+    if user_id not in MAILING_ADMIN_IDS:
+        return
 
-    if user_id == 146679674:
-        img3_path = config.media_dir / "IMG_3.jpg"
-        keyboard = [[InlineKeyboardButton(config.bot_btn['buy_courses'], callback_data='buy_courses')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Рассылку отправляет broadcast_worker.py; повторная команда показывает её прогресс
+    running = await pdb.get_broadcast_jobs(['running'])
+    if running:
+        job = running[0]
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"Рассылка #{job['job_id']} уже идёт: отправлено {job['sent']}, "
+                 f"ошибок {job['failed']}, осталось {job['pending']}."
+        )
+        return
 
-        batch_size = 50          # сколько пользователей в одном батче
-        per_message_delay = 0.2  # задержка между сообщениями внутри батча
-        per_batch_delay = 5      # задержка между батчами
+    # Не купившие ch_1, не отказавшиеся от рассылки и не заблокировавшие бота
+    audience = await segments.select(not_owns=['ch_1'])
 
-        # Перебор по батчам
-        for i in range(0, len(list_data), batch_size):
-            batch = list_data[i:i + batch_size]
+    keyboard = [[InlineKeyboardButton(config.bot_btn['buy_courses'], callback_data=pack(router.BUY_COURSES))]]
+    message = {
+        'kind': 'photo',
+        'media': "IMG_3.jpg",
+        'text': config.mailling_msg['mail1710'],
+        'reply_markup': InlineKeyboardMarkup(keyboard).to_dict()
+    }
+    job_id = await broadcast_jobs.create('mail1710', message, segments.user_ids_of(audience), created_by=user_id)
 
-            for user_mail_id in batch:
-                try:
-                    await context.bot.send_photo(
-                        chat_id=user_mail_id,
-                        caption=config.mailling_msg['mail1710'],
-                        photo=open(img3_path, 'rb'),
-                        reply_markup=reply_markup
-                    )
-                    # await asyncio.sleep(0.1)
-                    # await context.bot.send_message(
-                    #     chat_id=user_mail_id,
-                    #     text=config.mailling_msg['mail1710'],
-                    #     parse_mode=ParseMode.HTML,
-                    #     reply_markup=reply_markup
-                    # )
-                    successful_sends += 1
-
-                except RetryAfter as e:
-                    # Флуд-контроль: ждём указанное телеграмом время
-                    # Можно логировать, если у тебя есть logger
-                    logger.warning(f"Flood control для {user_mail_id}: ждём {e.retry_after} секунд")
-                    await asyncio.sleep(e.retry_after)
-                    failed_sends += 1
-
-                except Exception as e:
-                    # Любая другая ошибка отправки
-                    logger.error(f"Ошибка при отправке {user_mail_id}: {e}")
-                    failed_sends += 1
-
-                # Небольшая задержка между отправками
-                await asyncio.sleep(per_message_delay)
-
-            # Пауза между батчами, чтобы не упереться в лимиты
-            logger.info(f"Завершён батч с {len(batch)} пользователями, делаем паузу.")
-            await asyncio.sleep(per_batch_delay)
-
-        result_message = (
-            f"Рассылка завершена!\n\n"
-            f"Успешно отправлено: {successful_sends}\n"
-            f"Не удалось отправить: {failed_sends}\n"
-        )
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=f"Рассылка #{job_id} поставлена в очередь: {segments.count(audience)} получателей.\n"
+             f"Управление: /mailjob pause|resume|cancel {job_id}"
+    )
 
-        # Отправляем отчёт админу (инициатору рассылки)
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=result_message,
-            parse_mode=ParseMode.HTML
-        )
+
+async def mail_job_command(update: Update, context: CallbackContext) -> None:
+    """
+    /mailjob — список незавершённых рассылок, /mailjob pause|resume|cancel <id> — управление.
+    """
+    user_id = update.effective_user.id
+
+    if user_id not in MAILING_ADMIN_IDS:
+        return
+
+    actions = {
+        'pause': broadcast_jobs.pause,
+        'resume': broadcast_jobs.resume,
+        'cancel': broadcast_jobs.cancel,
+    }
+    args = context.args or []
+
+    if not args:
+        jobs = await pdb.get_broadcast_jobs(['running', 'paused'])
+        if not jobs:
+            text = "Незавершённых рассылок нет."
+        else:
+            text = "\n".join(
+                f"#{job['job_id']} {job['name']} — {job['status']}: отправлено {job['sent']}, "
+                f"ошибок {job['failed']}, осталось {job['pending']}"
+                for job in jobs
+            )
+    elif len(args) == 2 and args[0] in actions and args[1].isdigit():
+        changed = await actions[args[0]](int(args[1]))
+        text = "Готово." if changed else f"Рассылку #{args[1]} нельзя {args[0]} в текущем статусе."
+    else:
+        text = "Использование: /mailjob [pause|resume|cancel <id>]"
+
+    await context.bot.send_message(chat_id=user_id, text=text)
+
+
+async def campaign_command(update: Update, context: CallbackContext) -> None:
+    """
+    /campaign — запланированные рассылки; add | drip | cancel — см. campaigns.USAGE.
+    """
+    user_id = update.effective_user.id
+
+    if user_id not in MAILING_ADMIN_IDS:
+        return
+
+    args = context.args or []
+
+    if not args:
+        scheduled = await pdb.get_campaigns(['scheduled'])
+        if not scheduled:
+            text = f"Запланированных рассылок нет.\n\n{CAMPAIGN_USAGE}"
+        else:
+            text = "\n".join(
+                f"#{campaign['campaign_id']} {campaign['template']} — "
+                + (f"drip через {campaign['drip_after']} после регистрации"
+                   if campaign['drip_after'] is not None
+                   else campaign['send_at'].astimezone(moscow_tz).strftime('%d.%m.%Y %H:%M'))
+                for campaign in scheduled
+            )
+    elif len(args) == 2 and args[0] == 'cancel' and args[1].isdigit():
+        changed = await campaigns.cancel(int(args[1]))
+        text = "Готово." if changed else f"Кампанию #{args[1]} уже нельзя отменить."
+    else:
+        try:
+            params = parse_campaign_args(args)
+        except ValueError as e:
+            text = str(e)
+        else:
+            campaign_id = await campaigns.schedule(**params, created_by=user_id)
+            text = f"Кампания #{campaign_id} запланирована."
+
+    await context.bot.send_message(chat_id=user_id, text=text)
+
+
+async def run_due_campaigns(context: CallbackContext) -> None:
+    # Задания отправит broadcast_worker.py
+    await campaigns.run_due()
+
+
+async def reload_config_command(update: Update, context: CallbackContext) -> None:
+    """
+    /reload_config — перечитать тексты, кнопки и courses.yml без перезапуска бота.
+    """
+    user_id = update.effective_user.id
+
+    if user_id not in MAILING_ADMIN_IDS:
+        return
+
+    try:
+        config.reload()
+        text = "Конфиг перечитан."
+    except Exception as e:
+        logger.error(f"❌ Ошибка при перечитывании конфига: {e}")
+        text = f"Не удалось перечитать конфиг: {e}"
+    await context.bot.send_message(chat_id=user_id, text=text)
 
 
 async def error_handler(update: object, context: CallbackContext) -> None:
@@ -888,22 +911,33 @@ async def error_handler(update: object, context: CallbackContext) -> None:
     max_length = 4096 - len(message_base) - 100  # Вычитаем длину основного сообщения и резервируем место
     parts = [tb_string[i:i + max_length] for i in range(0, len(tb_string), max_length)]
 
-    # Отправляем базовую часть сообщения
-    await context.bot.send_message(
-        chat_id=config.cfg['ADMIN_CHAT_ID']['MAIN'], text=message_base, parse_mode=ParseMode.HTML,
-        message_thread_id=config.cfg['ADMIN_CHAT_ID']['LOGS']
-    )
-
-    # Отправляем каждую часть traceback по отдельности
-    for part in parts:
-        message = f"<pre>{html.escape(part)}</pre>"
-        await context.bot.send_message(
-            chat_id=config.cfg['ADMIN_CHAT_ID']['MAIN'], text=message, parse_mode=ParseMode.HTML,
-            message_thread_id=config.cfg['ADMIN_CHAT_ID']['LOGS']
-        )
+    # Базовая часть и каждая часть traceback по отдельности. В админский чат пишет outbox_worker
+    # (лимит 20 сообщений в минуту на группу); если недоступна сама БД — отправляем напрямую
+    admin_chat_id = int(config.cfg['ADMIN_CHAT_ID']['MAIN'])
+    texts = [message_base] + [f"<pre>{html.escape(part)}</pre>" for part in parts]
+    try:
+        await pdb.add_outbox([(admin_chat_id, 'sendMessage', {
+            'chat_id': admin_chat_id, 'text': text, 'parse_mode': 'HTML',
+            'message_thread_id': config.cfg['ADMIN_CHAT_ID']['LOGS']
+        }) for text in texts])
+    except Exception as e:
+        logger.error(f"❌ Не удалось поставить ошибку в outbox: {e}")
+        for text in texts:
+            await context.bot.send_message(
+                chat_id=admin_chat_id, text=text, parse_mode=ParseMode.HTML,
+                message_thread_id=config.cfg['ADMIN_CHAT_ID']['LOGS']
+            )
 
 
 async def post_init(application: Application) -> None:
+    # Открываем пул подключений к БД внутри event loop приложения
+    await pdb.connect()
+    await migrate.apply_migrations(pdb)
+
+    # Сегменты для рассылок: покупки и ручные доступы приходят через NOTIFY
+    pdb.entitlement_listeners.append(segments.on_entitlements_changed)
+    await segments.load()
+
     # Подгружаем команды из main_menu
     menu_commands = [
         BotCommand(f"/{key}", value) for key, value in config.bot_btn['main_menu'].items()
@@ -913,31 +947,44 @@ async def post_init(application: Application) -> None:
     await application.bot.set_my_commands(menu_commands)
 
 
-buy_course_conversation = ConversationHandler(
-    entry_points=[
-        CallbackQueryHandler(pay_chapter_callback_handle, pattern="^pay_chapter:"),
-        CallbackQueryHandler(confirm_multi_buy_handle, pattern="^confirm_buy_multiply$")
-    ],
-    states={
-        AGREE_OFFER: [CallbackQueryHandler(handle_offer_agree, pattern="^agree_offer:")],
-        AGREE_PRIVACY: [CallbackQueryHandler(handle_privacy_agree, pattern="^agree_privacy:")],
-        AGREE_NEWSLETTER: [
-            CallbackQueryHandler(handle_newsletter_agree, pattern="^(agree_newsletter:|disagree_newsletter:)")
-        ],
-        ASK_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_email_handle)],
-    },
-    fallbacks=[CallbackQueryHandler(cancel_payment_handle, pattern="^cancel$")],
-    allow_reentry=True
-)
+async def post_shutdown(application: Application) -> None:
+    await join_requests.close()
+    await pdb.close()
+
+
+# Все кнопки бота — один CallbackQueryHandler с разбором callback_data в router.py
+callback_router = CallbackRouter()
+callback_router.add(router.MAIN_MENU, main_menu_callback_handle)
+callback_router.add(router.BUY_COURSES, buy_courses_callback_handle)
+callback_router.add(router.BUY_CHAPTER, buy_chapter_callback_handle, str, str)
+callback_router.add(router.PAY_CHAPTER, pay_chapter_callback_handle, str)
+callback_router.add(router.BUY_MULTIPLY, buy_multiply_callback_handle)
+callback_router.add(router.MULTI_BUY_CHAPTER, toggle_multi_buy_chapter, str, str)
+callback_router.add(router.CONFIRM_MULTI_BUY, confirm_multi_buy_handle)
+callback_router.add(router.CLEAR_MULTI_BUY, clear_selected_multi_buy_callback_handle)
+callback_router.add(router.ALL_COURSES, all_courses_callback_handle)
+callback_router.add(router.MY_COURSES, my_courses_callback_handle)
+callback_router.add(router.DOCUMENTS, documents_callback_handle)
+callback_router.add(router.SUPPORT, support_callback_handle)
+callback_router.add(router.GO_BACK, go_back_callback_handle, str)
+callback_router.add(router.AGREE_OFFER, handle_offer_agree, str)
+callback_router.add(router.AGREE_PRIVACY, handle_privacy_agree, str)
+callback_router.add(router.AGREE_NEWSLETTER, handle_newsletter_agree, str, flag)
+callback_router.add(router.CANCEL, cancel_payment_handle)
+callback_router.add(router.UPD_PAYMENT_URL, upd_payment_url_handle, int)
+callback_router.add(router.GRANT_ACCESS, grant_manual_access_handle, int, str)
+callback_router.add(router.DENY_ACCESS, deny_manual_access, int, str)
 
 
 def run():
-    # Создание экземпляра RateLimiter
+    # Создание экземпляра RateLimiter: доля бота от общих лимитов токена (config/other.yml)
+    limits = telegram_https.rate_limits('bot')
     rate_limiter = AIORateLimiter(
-        overall_max_rate=30,  # Максимум 30 сообщений в секунду на всего бота
+        overall_max_rate=limits['overall_per_second'],  # Сообщений в секунду на процесс бота
         overall_time_period=1,  # Временной период для общего лимита (в секундах)
-        group_max_rate=20,  # Максимум 20 сообщений в минуту на группу
-        group_time_period=60  # Временной период для группового лимита (в секундах)
+        group_max_rate=limits['group_per_minute'],  # Сообщений в минуту на группу
+        group_time_period=60,  # Временной период для группового лимита (в секундах)
+        max_retries=limits['max_retries']
     )
 
     application = (
@@ -948,6 +995,7 @@ def run():
         .concurrent_updates(True)
         .rate_limiter(rate_limiter)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -957,35 +1005,20 @@ def run():
     application.add_handler(CommandHandler('documents', documents_command))
     application.add_handler(CommandHandler('support', support_command))
     application.add_handler(CommandHandler('mailx', mail_command))
+    application.add_handler(CommandHandler('mailjob', mail_job_command))
+    application.add_handler(CommandHandler('campaign', campaign_command))
+    application.add_handler(CommandHandler('reload_config', reload_config_command))
 
-    application.add_handler(CallbackQueryHandler(buy_courses_callback_handle, pattern="^buy_courses$"))
-    application.add_handler(CallbackQueryHandler(buy_chapter_callback_handle, pattern="^buy_chapter:"))
-
-    application.add_handler(CallbackQueryHandler(buy_multiply_callback_handle, pattern="^buy_multiply$"))
-
-    application.add_handler(CallbackQueryHandler(toggle_multi_buy_chapter, pattern="^multi_buy_chapter:"))
-
-    application.add_handler(CallbackQueryHandler(go_back_callback_handle, pattern="^go_back:"))
-
-    application.add_handler(CallbackQueryHandler(clear_selected_multi_buy_callback_handle,
-                                                 pattern="^clear_buy_multiply$"))
-
-    application.add_handler(CallbackQueryHandler(upd_payment_url_handle, pattern="^upd_payment_url:"))
-
-    application.add_handler(CallbackQueryHandler(main_menu_callback_handle, pattern="^main_menu$"))
-    application.add_handler(CallbackQueryHandler(my_courses_callback_handle, pattern="^my_courses$"))
-    application.add_handler(CallbackQueryHandler(all_courses_callback_handle,
-                                                 pattern=r"^(all_courses|go_back_buy_multiply)$"))
-    application.add_handler(CallbackQueryHandler(documents_callback_handle, pattern="^documents$"))
-    application.add_handler(CallbackQueryHandler(support_callback_handle, pattern="^support$"))
-
-    application.add_handler(CallbackQueryHandler(grant_manual_access_handle, pattern="^grant_access:"))
-    application.add_handler(CallbackQueryHandler(deny_manual_access, pattern="^deny_access:"))
-
-    application.add_handler(buy_course_conversation)
+    application.add_handler(callback_router.handler())
+    # E-mail на шаге оформления (ask_email_handle сам пропускает текст вне оформления)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ask_email_handle))
     application.add_handler(ChatJoinRequestHandler(handle_join_request))
+    application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
     application.add_error_handler(error_handler)
 
+    application.job_queue.run_repeating(probe_unreachable_users, interval=PROBE_INTERVAL, first=timedelta(minutes=5))
+    application.job_queue.run_repeating(run_due_campaigns, interval=CAMPAIGN_CHECK_INTERVAL, first=30)
+
     logger.addHandler(logging.StreamHandler())
 
     # Запуск бота
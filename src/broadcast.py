@@ -0,0 +1,550 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+
+import telegram
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+import config
+import telegram_https
+from media_registry import SEND_METHODS
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Одновременных запросов к Bot API
+CONCURRENCY = 30
+# Попыток на получателя при сетевых ошибках (429 сюда не входит — такие всегда возвращаются в очередь)
+MAX_ATTEMPTS = 3
+# После 429 скорость падает вдвое и восстанавливается на RATE_RECOVERY msg/s за каждое успешное сообщение
+RATE_DECREASE = 0.5
+RATE_RECOVERY = 0.05
+MIN_RATE = 1.0
+# Как часто писать прогресс в лог, секунд
+PROGRESS_INTERVAL = 30
+# Как часто сбрасывать результаты отправки в БД, секунд
+FLUSH_INTERVAL = 2
+# Сколько раз повторять последний сброс, если БД недоступна (раз в FLUSH_INTERVAL)
+FINAL_FLUSH_ATTEMPTS = 30
+# По скольким последним отправкам считать p95 задержки
+LATENCY_WINDOW = 1000
+# Как часто редактировать сообщение с прогрессом в админском чате, секунд
+# (в группах Telegram разрешает не больше 20 сообщений в минуту)
+DASHBOARD_INTERVAL = 5
+
+
+def unreachable_reason(error: Exception) -> str | None:
+    """
+    Причина, по которой пользователь недоступен, или None, если ошибка не об этом.
+
+    :return: blocked / deactivated / chat_not_found
+    """
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        return 'deactivated' if 'deactivated' in message else 'blocked'
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return 'chat_not_found'
+    return None
+
+
+def make_bot() -> telegram.Bot:
+    """
+    Отдельный Bot для рассылок: без AIORateLimiter бота, лимиты держит сам Broadcast.
+    """
+    return telegram.Bot(
+        token=config.config_env['TELEGRAM_TOKEN'],
+        request=HTTPXRequest(connection_pool_size=CONCURRENCY)
+    )
+
+
+class Broadcast:
+    """
+    Рассылка одного сообщения списку получателей: параллельно, на максимально
+    допустимой скорости. На 429 все отправки встают на паузу, скорость снижается,
+    а получатель возвращается в очередь.
+    """
+
+    def __init__(self, recipients, send, rate: float = None, on_flush=None, total: int = None):
+        """
+        :param recipients: user_id получателей — список или асинхронный генератор
+                           (например, Database.iter_pending_broadcast_recipients): из него читается
+                           по мере отправки, поэтому память не зависит от размера аудитории.
+        :param send: async-функция (bot, chat_id), отправляющая сообщение одному получателю.
+        :param rate: Максимальная скорость, msg/s. По умолчанию — доля broadcast из config/other.yml.
+        :param on_flush: async-функция (sent, failed, unreachable), куда раз в FLUSH_INTERVAL уходят
+                         результаты: список user_id, список (user_id, ошибка) и список
+                         (user_id, причина недоступности — см. unreachable_reason).
+        :param total: Число получателей, если recipients — генератор (для прогресса и ETA).
+        """
+        self.send = send
+        self.on_flush = on_flush
+        self.max_rate = rate or telegram_https.rate_limits('broadcast')['overall_per_second']
+        self.bucket = telegram_https.TokenBucket(self.max_rate)
+        if isinstance(recipients, list):
+            self.total = len(recipients)
+            self._queue = deque((chat_id, 1) for chat_id in recipients)
+            self._source = None
+        else:
+            self.total = total or 0
+            # Здесь только повторы; новые получатели берутся из _source
+            self._queue = deque()
+            self._source = aiter(recipients)
+        self._source_lock = asyncio.Lock()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.stopped = False
+        self._finished = asyncio.Event()
+        self._sent_buffer = []
+        self._failed_buffer = []
+        self._unreachable_buffer = []
+        self.unreachable = 0
+        # Длительность последних отправок, секунд — для p95
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def _set_rate(self, rate: float):
+        # Растянутая рассылка может идти медленнее MIN_RATE — тогда это и есть нижняя граница
+        self.bucket.rate = max(min(MIN_RATE, self.max_rate), min(self.max_rate, rate))
+
+    async def _send_one(self, bot, chat_id: int, attempt: int):
+        try:
+            await self.send(bot, chat_id)
+        except RetryAfter as e:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            self._set_rate(self.rate * RATE_DECREASE)
+            self._queue.append((chat_id, attempt))
+            logger.warning(f"⏳ Рассылка: 429, пауза {e.retry_after} с, скорость {self.rate:.1f} msg/s")
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+            self._fail(chat_id, e)
+            logger.info(f"Не доставлено {chat_id}: {e}")
+        except (TimedOut, NetworkError) as e:
+            if attempt < MAX_ATTEMPTS:
+                self._queue.append((chat_id, attempt + 1))
+            else:
+                self._fail(chat_id, e)
+                logger.error(f"Ошибка при отправке {chat_id}: {e}")
+        except Exception as e:
+            self._fail(chat_id, e)
+            logger.error(f"Ошибка при отправке {chat_id}: {e}")
+        else:
+            self.sent += 1
+            self._sent_buffer.append(chat_id)
+            self._set_rate(self.rate + RATE_RECOVERY)
+
+    def _fail(self, chat_id: int, error: Exception):
+        self.failed += 1
+        self._failed_buffer.append((chat_id, str(error)))
+        reason = unreachable_reason(error)
+        if reason:
+            self.unreachable += 1
+            self._unreachable_buffer.append((chat_id, reason))
+
+    @property
+    def unflushed(self) -> int:
+        """
+        Сколько результатов отправки ещё не записано через on_flush.
+        """
+        return len(self._sent_buffer) + len(self._failed_buffer)
+
+    async def _flush(self):
+        if self.on_flush is None or not (self._sent_buffer or self._failed_buffer):
+            return
+        sent, self._sent_buffer = self._sent_buffer, []
+        failed, self._failed_buffer = self._failed_buffer, []
+        unreachable, self._unreachable_buffer = self._unreachable_buffer, []
+        try:
+            await self.on_flush(sent, failed, unreachable)
+        except Exception:
+            # Не записанное возвращаем в буферы (перед собранным за время записи) — повторит следующий сброс
+            self._sent_buffer[:0] = sent
+            self._failed_buffer[:0] = failed
+            self._unreachable_buffer[:0] = unreachable
+            raise
+
+    async def _flush_periodically(self):
+        # Не отменяется снаружи, чтобы не оборвать UPDATE на середине: после
+        # завершения рассылки делает последний сброс и выходит сам
+        while not self._finished.is_set():
+            try:
+                await asyncio.wait_for(self._finished.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи результатов рассылки: {e}")
+        # Последний сброс повторяем: иначе отправленные остались бы pending и получили бы сообщение ещё раз
+        for attempt in range(FINAL_FLUSH_ATTEMPTS):
+            if not self.unflushed:
+                return
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи результатов рассылки (попытка {attempt + 1}): {e}")
+
+    def stop(self):
+        """
+        Останавливает рассылку: новые отправки не начинаются, run() завершается
+        после текущих. Неотправленные получатели остаются в очереди.
+        """
+        self.stopped = True
+
+    async def _next_recipient(self) -> tuple[int, int] | None:
+        # Сначала повторы, потом следующий получатель из источника
+        if self._queue:
+            return self._queue.popleft()
+        if self._source is None:
+            return None
+        async with self._source_lock:
+            if self._source is None:
+                return None
+            try:
+                return await anext(self._source), 1
+            except StopAsyncIteration:
+                self._source = None
+                return None
+
+    async def _worker(self, bot):
+        while not self.stopped and (self._source is not None or self._queue or self._in_flight):
+            if self._source is None and not self._queue:
+                # Новых нет, но кто-то ещё отправляет и может вернуть получателя
+                await asyncio.sleep(0.05)
+                continue
+            # Ждём токен и паузу после 429 короткими шагами, чтобы быстро заметить stop()
+            while not self.stopped and (delay := max(self.bucket.wait_time(),
+                                                     self._paused_until - time.monotonic())) > 0:
+                await asyncio.sleep(min(delay, 1.0))
+            if self.stopped:
+                break
+            self._in_flight += 1
+            try:
+                recipient = await self._next_recipient()
+                if recipient is None:
+                    continue
+                self.bucket.tokens -= 1
+                started = time.perf_counter()
+                await self._send_one(bot, *recipient)
+                self._latencies.append(time.perf_counter() - started)
+            finally:
+                self._in_flight -= 1
+
+    async def _log_progress(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            progress = self.progress()
+            logger.info(
+                f"📨 Рассылка: {progress['sent']}/{self.total}, ошибок {progress['failed']}, "
+                f"{progress['per_second']:.1f} msg/s, осталось ~{progress['eta']:.0f} с"
+            )
+
+    async def run(self, bot=None) -> dict:
+        """
+        Отправляет всем получателям и возвращает итог (см. progress()).
+
+        :param bot: telegram.Bot; по умолчанию — make_bot().
+        """
+        self.started_at = time.monotonic()
+        progress_task = asyncio.create_task(self._log_progress())
+        flush_task = asyncio.create_task(self._flush_periodically())
+        try:
+            if bot is None:
+                async with make_bot() as bot:
+                    await asyncio.gather(*(self._worker(bot) for _ in range(CONCURRENCY)))
+            else:
+                await asyncio.gather(*(self._worker(bot) for _ in range(CONCURRENCY)))
+        finally:
+            progress_task.cancel()
+            if self._source is not None:
+                # Остановлена раньше конца: закрываем генератор получателей
+                await self._source.aclose()
+                self._source = None
+            self.finished_at = time.monotonic()
+            self._finished.set()
+            await flush_task
+        return self.progress()
+
+    def progress(self) -> dict:
+        """
+        :return: sent, failed, unreachable, throttled, remaining, per_second (средняя скорость), eta (секунд),
+                 elapsed, p95 (секунд на отправку по последним LATENCY_WINDOW, None — ещё не было).
+        """
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0.0
+        done = self.sent + self.failed
+        per_second = done / elapsed if elapsed else 0.0
+        remaining = self.total - done
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'unreachable': self.unreachable,
+            'throttled': self.throttled,
+            'remaining': remaining,
+            'per_second': per_second,
+            'eta': remaining / per_second if per_second else 0.0,
+            'elapsed': elapsed,
+            'p95': self.latency_p95()
+        }
+
+    def latency_p95(self) -> float | None:
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+
+class ProgressMessage:
+    """
+    Прогресс рассылки одним сообщением в админском чате (топик ADMIN_CHAT_ID.BROADCASTS).
+    Сообщение редактируется не чаще раза в DASHBOARD_INTERVAL и только если текст
+    поменялся; ошибки Telegram на рассылку не влияют.
+    """
+
+    def __init__(self, bot, job: dict):
+        """
+        :param bot: Bot, которым идёт рассылка.
+        :param job: Задание из Database.get_broadcast_job — счётчики до этого запуска.
+        """
+        self.bot = bot
+        self.job = job
+        self.chat_id = config.cfg['ADMIN_CHAT_ID']['MAIN']
+        self.thread_id = config.cfg['ADMIN_CHAT_ID'].get('BROADCASTS')
+        self.message_id = None
+        self._text = None
+        self._hold_until = 0.0
+        # (monotonic, отправлено + ошибок) на момент прошлого обновления — для текущей скорости
+        self._last = None
+
+    def render(self, mailing: Broadcast, state: str) -> str:
+        progress = mailing.progress()
+        done = progress['sent'] + progress['failed']
+        now = time.monotonic()
+        if state == 'идёт' and self._last and now > self._last[0]:
+            current = (done - self._last[1]) / (now - self._last[0])
+        else:
+            current = progress['per_second']
+        self._last = (now, done)
+
+        p95 = f"{progress['p95'] * 1000:.0f} мс" if progress['p95'] is not None else "—"
+        lines = [
+            f"📨 Рассылка #{self.job['job_id']} ({self.job['name']}) — {state}",
+            "",
+            f"Отправлено: {self.job['sent'] + progress['sent']}",
+            f"Ошибок: {self.job['failed'] + progress['failed']} (недоступны: {progress['unreachable']})",
+            f"429: {progress['throttled']}",
+            f"Осталось: {progress['remaining']}",
+            f"Скорость: {current:.1f} msg/s, p95 отправки: {p95}",
+        ]
+        if state == 'идёт':
+            lines.append(f"ETA: ~{_duration(progress['eta'])}" if current else "ETA: —")
+        else:
+            lines.append(f"Заняло: {_duration(progress['elapsed'])}")
+        return "\n".join(lines)
+
+    async def show(self, text: str):
+        if text == self._text or time.monotonic() < self._hold_until:
+            return
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_message(chat_id=self.chat_id, text=text,
+                                                      message_thread_id=self.thread_id)
+                self.message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
+            self._text = text
+        except RetryAfter as e:
+            self._hold_until = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.error(f"Не удалось обновить прогресс рассылки: {e}")
+        except Exception as e:
+            logger.error(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def follow(self, mailing: Broadcast):
+        """
+        Обновляет сообщение, пока его не отменят (отдельная задача рядом с mailing.run()).
+        """
+        while True:
+            await self.show(self.render(mailing, 'идёт'))
+            await asyncio.sleep(DASHBOARD_INTERVAL)
+
+    async def finish(self, mailing: Broadcast, state: str):
+        # Итог показываем, даже если недавно была пауза после 429
+        self._hold_until = 0.0
+        await self.show(self.render(mailing, state))
+
+
+def make_sender(message: dict, file_id: str = None):
+    """
+    Функция отправки для Broadcast по описанию сообщения из broadcast_jobs.message.
+
+    :param message: {'kind': 'text' | 'photo' | ..., 'text': ..., 'media': имя файла, 'reply_markup': dict}
+    :param file_id: file_id медиа (см. MediaRegistry), если сообщение с файлом.
+    """
+    reply_markup = InlineKeyboardMarkup.de_json(message['reply_markup'], None) if message.get('reply_markup') else None
+    kind = message.get('kind', 'text')
+
+    async def send(bot, chat_id):
+        if kind == 'text':
+            await bot.send_message(chat_id=chat_id, text=message['text'], parse_mode=message.get('parse_mode'),
+                                   reply_markup=reply_markup, disable_web_page_preview=True)
+        else:
+            method, argument = SEND_METHODS[kind]
+            await getattr(bot, method)(chat_id=chat_id, caption=message.get('text'),
+                                       parse_mode=message.get('parse_mode'), reply_markup=reply_markup,
+                                       **{argument: file_id})
+
+    return send
+
+
+class BroadcastJobs:
+    """
+    Рассылки как задания в БД (broadcast_jobs / broadcast_deliveries): результаты
+    пишутся пачками, после перезапуска незавершённые задания продолжаются с pending.
+    Бот только создаёт задания и меняет их статус, отправляет их broadcast_worker.py.
+    """
+
+    def __init__(self, db, media):
+        self.db = db
+        self.media = media
+        self.running = {}   # job_id -> Broadcast
+        self._tasks = {}    # job_id -> asyncio.Task
+
+    async def create(self, name: str, message: dict, recipients, created_by: int, rate: float = None,
+                     quiet_hours: tuple = None, campaign_id: int = None) -> int:
+        """
+        Сохраняет задание со статусом running (параметры — см. Database.create_broadcast_job).
+        Отправляет его broadcast_worker.py — он подхватит задание при следующем sync().
+
+        :return: job_id
+        """
+        return await self.db.create_broadcast_job(name, message, recipients, created_by, rate, quiet_hours,
+                                                  campaign_id)
+
+    def start(self, job_id: int):
+        # Если прошлый запуск ещё останавливается (pause → resume), новый дождётся его
+        previous = self._tasks.get(job_id)
+        task = asyncio.create_task(self._run(job_id, previous))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None) if self._tasks.get(job_id) is task else None)
+
+    async def _run(self, job_id: int, previous: asyncio.Task = None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        job = await self.db.get_broadcast_job(job_id)
+        recipients = self.db.iter_pending_broadcast_recipients(job_id)
+        message = job['message']
+        logger.info(f"📨 Рассылка #{job_id} ({job['name']}): осталось {job['pending']} получателей")
+
+        try:
+            async with make_bot() as bot:
+                file_id = None
+                if message.get('media'):
+                    file_id = await self.media.file_id(bot, message['media'], message['kind'])
+                mailing = Broadcast(recipients, make_sender(message, file_id),
+                                    rate=job['rate'], on_flush=partial(self._record, job_id),
+                                    total=job['pending'])
+                self.running[job_id] = mailing
+                dashboard = ProgressMessage(bot, job)
+                dashboard_task = asyncio.create_task(dashboard.follow(mailing))
+                try:
+                    await mailing.run(bot)
+                finally:
+                    self.running.pop(job_id, None)
+                    dashboard_task.cancel()
+                await dashboard.finish(mailing, 'остановлена' if mailing.stopped else 'завершена')
+
+                # Остановлена через pause / cancel / close — статус уже выставлен
+                if mailing.stopped:
+                    return
+                if mailing.unflushed:
+                    # Результаты не записаны — у этих получателей pending; done закрыл бы им рассылку навсегда.
+                    # Задание остаётся running, sync() продолжит его (этим получателям — возможно, повторно)
+                    logger.error(f"❗ Рассылка #{job_id}: не записано {mailing.unflushed} результатов, "
+                                 f"задание не завершено")
+                    return
+                await self.db.set_broadcast_job_status(job_id, 'done', ['running'])
+                await self._report(bot, job, mailing)
+        except Exception as e:
+            logger.error(f"❗ Рассылка #{job_id} прервана: {e}")
+
+    async def _record(self, job_id: int, sent: list[int], failed: list[tuple[int, str]],
+                      unreachable: list[tuple[int, str]]):
+        await self.db.record_broadcast_deliveries(job_id, sent, failed)
+        # Заблокировавшие бота не попадут в следующие рассылки
+        await self.db.mark_users_unreachable(unreachable)
+
+    async def _report(self, bot, job: dict, mailing: Broadcast):
+        if not job['created_by']:
+            return
+        # Счётчики из БД — с учётом запусков до перезапуска
+        counts = await self.db.get_broadcast_job(job['job_id'])
+        result = mailing.progress()
+        text = (
+            f"Рассылка #{job['job_id']} завершена!\n\n"
+            f"Успешно отправлено: {counts['sent']}\n"
+            f"Не удалось отправить: {counts['failed']}\n"
+            f"Заблокировали бота / удалили аккаунт: {result['unreachable']}\n"
+            f"Повторов после 429: {result['throttled']}\n"
+            f"Скорость: {result['per_second']:.1f} msg/s, заняло {_duration(result['elapsed'])}."
+        )
+        try:
+            await bot.send_message(chat_id=job['created_by'], text=text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчёт о рассылке #{job['job_id']}: {e}")
+
+    async def sync(self):
+        """
+        Сверяет запущенные в этом процессе рассылки со статусами в БД:
+        запускает новые и продолженные (running), останавливает поставленные
+        на паузу или отменённые из бота и те, у которых начались тихие часы.
+        """
+        running_ids = set(await self.db.get_sendable_broadcast_job_ids())
+        for job_id in running_ids - self._tasks.keys():
+            self.start(job_id)
+        for job_id, mailing in list(self.running.items()):
+            if job_id not in running_ids:
+                mailing.stop()
+
+    async def pause(self, job_id: int) -> bool:
+        # Статус меняется в БД, воркер остановит рассылку при следующем sync()
+        return await self.db.set_broadcast_job_status(job_id, 'paused', ['running'])
+
+    async def resume(self, job_id: int) -> bool:
+        return await self.db.set_broadcast_job_status(job_id, 'running', ['paused'])
+
+    async def cancel(self, job_id: int) -> bool:
+        return await self.db.set_broadcast_job_status(job_id, 'cancelled', ['running', 'paused'])
+
+    async def close(self):
+        """
+        Останавливает рассылки при выключении воркера. Статус остаётся running —
+        после перезапуска sync() их продолжит.
+        """
+        for mailing in self.running.values():
+            mailing.stop()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
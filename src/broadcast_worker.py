@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+import psycopg
+
+import config
+import migrate
+from setup import pdb, broadcast_jobs
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Как часто сверять задания с БД: новые из /mailx, pause / resume / cancel из /mailjob
+POLL_INTERVAL = float(config.config_env.get('BROADCAST_POLL_INTERVAL', 2))
+# Произвольный ключ advisory lock: рассылки отправляет только один воркер,
+# второй экземпляр ждёт, пока первый не остановится
+WORKER_LOCK_KEY = 7348202
+
+
+async def wait_for_lock() -> psycopg.AsyncConnection:
+    """
+    Берёт advisory lock воркера на отдельном подключении (lock живёт, пока оно открыто).
+
+    :return: Подключение, которое держит lock.
+    """
+    conn = await psycopg.AsyncConnection.connect(**pdb.conn_kwargs, autocommit=True)
+    while True:
+        cursor = await conn.execute("SELECT pg_try_advisory_lock(%s)", (WORKER_LOCK_KEY,))
+        if (await cursor.fetchone())[0]:
+            return conn
+        logger.info("⏳ Рассылки уже отправляет другой воркер, ждём")
+        await asyncio.sleep(POLL_INTERVAL * 10)
+
+
+async def main():
+    await pdb.connect()
+    await migrate.apply_migrations(pdb)
+    lock_conn = await wait_for_lock()
+    logger.info("📨 Воркер рассылок запущен")
+    try:
+        while True:
+            try:
+                await broadcast_jobs.sync()
+            except Exception as e:
+                logger.error(f"❗ Ошибка воркера рассылок: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        await broadcast_jobs.close()
+        await lock_conn.close()
+        await pdb.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,167 @@
+import logging
+from datetime import datetime, time
+
+import pytz
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import router
+from catalog import catalog
+import telegram_https
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Как часто JobQueue проверяет, не пора ли запускать кампании, секунд
+CHECK_INTERVAL = 60
+# Как часто запускается drip-кампания (каждый запуск берёт новых пользователей), минут
+DRIP_INTERVAL = 60
+
+moscow_tz = pytz.timezone('Europe/Moscow')
+
+USAGE = (
+    "/campaign — запланированные рассылки\n"
+    "/campaign add <шаблон> <ДД.ММ.ГГГГ> <ЧЧ:ММ> [опции] — разовая рассылка (время московское)\n"
+    "/campaign drip <шаблон> <часов после регистрации> [опции] — рассылка новым пользователям\n"
+    "/campaign cancel <id>\n\n"
+    "Опции: spread=<минут> quiet=22-9 owns=ch_1,ch_2 not_owns=ch_1 media=IMG_3.jpg"
+)
+
+
+def parse_campaign_args(args: list[str]) -> dict:
+    """
+    Разбирает аргументы /campaign add | drip в параметры Campaigns.schedule.
+
+    :raises ValueError: Если аргументы не подходят (текст ошибки — для админа).
+    """
+    if len(args) < 3 or args[0] not in ('add', 'drip'):
+        raise ValueError(USAGE)
+    kind, template, rest = args[0], args[1], args[2:]
+    if template not in config.mailling_msg:
+        raise ValueError(f"Шаблона {template} нет в mailling.yml")
+
+    params = {'template': template}
+    if kind == 'add':
+        if len(rest) < 2:
+            raise ValueError(USAGE)
+        send_at = datetime.strptime(f"{rest[0]} {rest[1]}", "%d.%m.%Y %H:%M")
+        params['send_at'] = moscow_tz.localize(send_at)
+        rest = rest[2:]
+    else:
+        params['send_at'] = datetime.now(moscow_tz)
+        params['drip_after_hours'] = int(rest[0])
+        rest = rest[1:]
+
+    for option in rest:
+        key, _, value = option.partition('=')
+        if key == 'spread':
+            params['spread_minutes'] = int(value)
+        elif key == 'quiet':
+            start, _, end = value.partition('-')
+            params['quiet_hours'] = (time(int(start) % 24), time(int(end) % 24))
+        elif key in ('owns', 'not_owns'):
+            chapters = value.split(',')
+            unknown = [chapter for chapter in chapters if chapter not in catalog]
+            if unknown:
+                raise ValueError(f"Нет таких курсов: {', '.join(unknown)}")
+            params[key] = chapters
+        elif key == 'media':
+            if not config.media_dir.joinpath(value).is_file():
+                raise ValueError(f"Файла {value} нет в media/")
+            params['media'] = value
+        else:
+            raise ValueError(f"Неизвестная опция {key}\n\n{USAGE}")
+    return params
+
+
+class Campaigns:
+    """
+    Запланированные и drip-рассылки. Хранятся в таблице campaigns; JobQueue бота
+    раз в CHECK_INTERVAL вызывает run_due(), который в нужное время выбирает
+    сегмент и создаёт задание для воркера рассылок. Чтобы не упираться в лимиты
+    всплеском, отправка растягивается на spread_minutes, а в тихие часы не идёт.
+    """
+
+    def __init__(self, db, segments, jobs):
+        self.db = db
+        self.segments = segments
+        self.jobs = jobs
+
+    async def schedule(self, template: str, send_at: datetime, media: str = None, owns: list[str] = (),
+                       not_owns: list[str] = (), drip_after_hours: int = None, spread_minutes: int = 0,
+                       quiet_hours: tuple = None, created_by: int = None) -> int:
+        """
+        Планирует рассылку (параметры — см. Database.create_campaign и parse_campaign_args).
+
+        :return: campaign_id
+        """
+        keyboard = [[InlineKeyboardButton(config.bot_btn['buy_courses'], callback_data=router.pack(router.BUY_COURSES))]]
+        message = {
+            'kind': 'photo' if media else 'text',
+            'media': media,
+            'parse_mode': 'HTML',
+            'reply_markup': InlineKeyboardMarkup(keyboard).to_dict()
+        }
+        segment = {'owns': list(owns), 'not_owns': list(not_owns)}
+        return await self.db.create_campaign(template, message, segment, send_at, drip_after_hours,
+                                             spread_minutes, quiet_hours, created_by)
+
+    async def cancel(self, campaign_id: int) -> bool:
+        # Уже созданные задания останавливаются через /mailjob cancel
+        return await self.db.set_campaign_status(campaign_id, 'cancelled', ['scheduled'])
+
+    async def run_due(self) -> list[int]:
+        """
+        Запускает кампании, которым пора.
+
+        :return: job_id созданных заданий.
+        """
+        job_ids = []
+        for campaign in await self.db.claim_due_campaigns(DRIP_INTERVAL):
+            try:
+                job_id = await self._start(campaign)
+            except Exception as e:
+                logger.error(f"❗ Кампания #{campaign['campaign_id']} не запущена: {e}")
+                if campaign['drip_after'] is None:
+                    await self.db.set_campaign_status(campaign['campaign_id'], 'failed', ['started'])
+                else:
+                    # Окно уже сдвинуто при claim — без отката эти регистрации не получили бы рассылку
+                    await self.db.release_campaign_window(campaign['campaign_id'], campaign['registered_after'],
+                                                          campaign['registered_until'])
+                continue
+            # None — в окне нет получателей, сдвинутая граница верна
+            if job_id is not None:
+                job_ids.append(job_id)
+        return job_ids
+
+    async def _start(self, campaign: dict) -> int | None:
+        segment = campaign['segment']
+        registered = {}
+        if campaign['drip_after'] is not None:
+            registered = {'registered_after': campaign['registered_after'],
+                          'registered_before': campaign['registered_until']}
+        audience = await self.segments.select(owns=segment.get('owns', ()), not_owns=segment.get('not_owns', ()),
+                                              **registered)
+        total = self.segments.count(audience)
+        if not total:
+            return None
+
+        # Темп, при котором отправка займёт spread_minutes, но не быстрее доли broadcast
+        rate = None
+        if campaign['spread_minutes']:
+            max_rate = telegram_https.rate_limits('broadcast')['overall_per_second']
+            rate = min(max_rate, total / (campaign['spread_minutes'] * 60))
+        quiet_hours = None
+        if campaign['quiet_start'] is not None and campaign['quiet_end'] is not None:
+            quiet_hours = (campaign['quiet_start'], campaign['quiet_end'])
+
+        message = {**campaign['message'], 'text': config.mailling_msg[campaign['template']]}
+        # Отчёт о каждом запуске drip-кампании (раз в DRIP_INTERVAL) был бы спамом
+        created_by = campaign['created_by'] if campaign['drip_after'] is None else None
+        job_id = await self.jobs.create(campaign['template'], message, self.segments.user_ids_of(audience),
+                                        created_by=created_by, rate=rate, quiet_hours=quiet_hours,
+                                        campaign_id=campaign['campaign_id'])
+        logger.info(f"🗓 Кампания #{campaign['campaign_id']} ({campaign['template']}): "
+                    f"задание #{job_id}, {total} получателей")
+        return job_id
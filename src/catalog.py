@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+from types import MappingProxyType
+
+import config
+
+
+@dataclass(frozen=True, slots=True)
+class Course:
+    """
+    Раздел курса из courses.yml с заранее собранными текстами.
+    """
+    key: str                    # ch_1
+    num: str                    # 1 — номер в callback_data
+    name: str
+    short_name: str
+    emoji: str
+    title: str                  # name + emoji
+    button_text: str            # short_name + emoji — кнопка в меню разделов
+    description: str
+    price: int
+    channel_id: int | None
+    channel_invite_link: str | None
+    receipt_name: str           # short_name_for_receipt
+    info_text: str              # экран раздела (buy_chapter_info)
+    confirm_line: str           # строка раздела в подтверждении покупки
+    receipt_item: MappingProxyType  # позиция чека Robokassa
+
+
+class Catalog:
+    """
+    Каталог разделов, собранный один раз из courses.yml и текстов бота: записи
+    курсов с индексами по ключу, номеру и каналу и готовые статические экраны.
+    После config.reload() пересобирается на месте — импортированный объект
+    остаётся тем же.
+    """
+
+    __slots__ = ('courses', 'by_key', 'by_num', 'by_channel_id', 'documents_text')
+
+    def __init__(self):
+        self.build()
+
+    def build(self):
+        courses = tuple(
+            _compile_course(key, value)
+            for key, value in config.courses.items()
+            if isinstance(value, dict)
+        )
+        # Индексы собираются до присваивания, чтобы обработчики не видели каталог наполовину
+        by_key = MappingProxyType({course.key: course for course in courses})
+        by_num = MappingProxyType({course.num: course for course in courses})
+        by_channel_id = MappingProxyType({
+            course.channel_id: course
+            for course in courses
+            if course.channel_id and course.channel_invite_link
+        })
+        documents_text = _render_documents()
+
+        self.courses = courses
+        self.by_key = by_key
+        self.by_num = by_num
+        self.by_channel_id = by_channel_id
+        self.documents_text = documents_text
+
+    def get(self, key: str) -> Course | None:
+        return self.by_key.get(key)
+
+    def get_by_num(self, num) -> Course | None:
+        return self.by_num.get(str(num))
+
+    def get_by_channel(self, channel_id: int) -> Course | None:
+        return self.by_channel_id.get(channel_id)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.by_key
+
+    def keys(self):
+        return self.by_key.keys()
+
+    def confirm_purchase_text(self, email: str, keys: list) -> tuple[str, int]:
+        """
+        Текст подтверждения покупки: заголовок с e-mail, готовые строки разделов и итог.
+
+        :param keys: Ключи выбранных разделов (неизвестные пропускаются).
+        :return: (текст, общая сумма)
+        """
+        courses = [self.by_key[key] for key in keys if key in self.by_key]
+        total = sum(course.price for course in courses)
+        text_lines = [config.bot_msg['confirm_purchase_header'].format(email=email)]
+        text_lines.extend(course.confirm_line for course in courses)
+        text_lines.append(config.bot_msg['confirm_purchase_footer'].format(total=total))
+        return "\n".join(text_lines), total
+
+
+def _compile_course(key: str, value: dict) -> Course:
+    title = value['name'] + value['emoji']
+    price = value['price']
+    return Course(
+        key=key,
+        num=key.split('_')[1],
+        name=value['name'],
+        short_name=value['short_name'],
+        emoji=value['emoji'],
+        title=title,
+        button_text=value['short_name'] + value['emoji'],
+        description=value.get('description', ''),
+        price=price,
+        channel_id=value.get('channel_id'),
+        channel_invite_link=value.get('channel_invite_link'),
+        receipt_name=value['short_name_for_receipt'],
+        info_text=config.bot_msg['buy_chapter_info'].format(
+            name=title,
+            description=value.get('description', ''),
+            price=price
+        ),
+        confirm_line=config.bot_msg['confirm_purchase_course_line'].format(name=title, price=price),
+        receipt_item=MappingProxyType({
+            "Name": f"{value['short_name_for_receipt']}",
+            "Quantity": 1,
+            "Sum": price,
+            "PaymentMethod": "full_prepayment",
+            "PaymentObject": "service",
+            "Tax": "none"
+        })
+    )
+
+
+def _render_documents() -> str:
+    links = config.other_cfg["links"]
+    return "\n\n".join((
+        config.other_cfg["person_info"],
+        f'<a href="{links["offer"]}">Ознакомиться с офертой</a>',
+        f'<a href="{links["privacy"]}">Ознакомиться с политикой обработки персональных данных</a>',
+        f'<a href="{links["consent"]}">Ознакомиться с документом на получение рекламной и информационной рассылки</a>'
+    ))
+
+
+catalog = Catalog()
+
+config.reload_hooks.append(catalog.build)
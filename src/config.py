@@ -8,6 +8,9 @@ config_dir = base_dir.joinpath("config")
 media_dir = base_dir.joinpath("media")
 data_dir = base_dir.joinpath("data")
 
+# Функции без аргументов, которые вызываются после reload() (сброс кэшей, собранных из конфига)
+reload_hooks = []
+
 
 # Функция для чтения YAML файла
 def read_yaml_file(file_path):
@@ -15,34 +18,31 @@ def read_yaml_file(file_path):
         return yaml.safe_load(f)
 
 
-# Чтение конфигурационных файлов
-cfg = read_yaml_file(config_dir.joinpath("config.yml"))
-other_cfg = read_yaml_file(config_dir.joinpath("other.yml"))
-bot_msg = read_yaml_file(config_dir.joinpath("bot_messages.yml"))
-admin_msg = read_yaml_file(config_dir.joinpath("admin_messages.yml"))
-mailling_msg = read_yaml_file(config_dir.joinpath("mailling.yml"))
+def _load():
+    global cfg, other_cfg, bot_msg, admin_msg, mailling_msg, bot_btn, config_env, courses
+
+    # Чтение конфигурационных файлов
+    cfg = read_yaml_file(config_dir.joinpath("config.yml"))
+    other_cfg = read_yaml_file(config_dir.joinpath("other.yml"))
+    bot_msg = read_yaml_file(config_dir.joinpath("bot_messages.yml"))
+    admin_msg = read_yaml_file(config_dir.joinpath("admin_messages.yml"))
+    mailling_msg = read_yaml_file(config_dir.joinpath("mailling.yml"))
+
+    bot_btn = read_yaml_file(config_dir.joinpath("bot_buttons.yml"))
 
-bot_btn = read_yaml_file(config_dir.joinpath("bot_buttons.yml"))
+    config_env = dotenv.dotenv_values(config_dir / ".env")
 
-config_env = dotenv.dotenv_values(config_dir / ".env")
+    # Разобранный каталог с индексами и готовыми текстами — catalog.catalog
+    courses = read_yaml_file(data_dir.joinpath("courses.yml"))
 
-courses = read_yaml_file(data_dir.joinpath("courses.yml"))
 
-channel_map = {}
+def reload():
+    """
+    Перечитывает конфиги и courses.yml без перезапуска и вызывает reload_hooks.
+    """
+    _load()
+    for hook in reload_hooks:
+        hook()
 
-for key, value in courses.items():
-    if isinstance(value, dict):
-        channel_id = value.get('channel_id')
-        channel_invite_link = value.get('channel_invite_link')
-        name = value.get('name')
-        if channel_id and channel_invite_link and name:
-            channel_map[channel_id] = {
-                'name': name,
-                'channel_invite_link': channel_invite_link
-            }
 
-channel_id_to_key = {
-    value["channel_id"]: key
-    for key, value in courses.items()
-    if isinstance(value, dict) and "channel_id" in value
-}
\ No newline at end of file
+_load()
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+# Канал LISTEN/NOTIFY, через который процессы бота и uvicorn сообщают друг другу,
+# что у пользователя поменялся набор доступных курсов
+ENTITLEMENTS_CHANNEL = 'user_entitlements'
+
+
+class Entitlements(NamedTuple):
+    paid: frozenset      # курсы, оплаченные через orders + payments
+    manual: frozenset    # курсы, выданные вручную (manual_access)
+
+    @property
+    def all(self) -> frozenset:
+        return self.paid | self.manual
+
+
+class EntitlementCache:
+    """
+    Ограниченный LRU-кэш с TTL: user_id -> Entitlements.
+
+    Чтение из БД и set() разделены await: если между ними пришла инвалидация,
+    прочитанное уже устарело. Поэтому перед чтением берётся version(), и set()
+    с этой версией ничего не делает, если пользователя с тех пор инвалидировали.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (expires_at, Entitlements)
+        # Счётчик инвалидаций и номер последней по каждому пользователю (не больше max_size записей)
+        self._epoch = 0
+        self._invalidated = OrderedDict()  # user_id -> epoch
+        # Инвалидации до этого номера уже не помним — set() со старой версией пропускается
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Entitlements | None:
+        item = self._data.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def version(self) -> int:
+        """
+        Версия кэша — взять до чтения из БД и передать в set().
+        """
+        return self._epoch
+
+    def set(self, user_id: int, entitlements: Entitlements, version: int = None):
+        """
+        :param version: version() до чтения entitlements; если после неё пользователя
+                        инвалидировали, значение устарело и не кэшируется.
+        """
+        if version is not None and (version < self._forgotten or version < self._invalidated.get(user_id, 0)):
+            return
+        self._data[user_id] = (time.monotonic() + self.ttl, entitlements)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._epoch += 1
+        self._data.pop(user_id, None)
+        self._invalidated[user_id] = self._epoch
+        self._invalidated.move_to_end(user_id)
+        while len(self._invalidated) > self.max_size:
+            _, epoch = self._invalidated.popitem(last=False)
+            self._forgotten = epoch
+
+    def clear(self):
+        self._epoch += 1
+        self._data.clear()
+        self._invalidated.clear()
+        self._forgotten = self._epoch
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
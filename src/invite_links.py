@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+import config
+from catalog import catalog
+import telegram_https
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько свободных ссылок держать на каждый канал
+POOL_SIZE = int(config.config_env.get('INVITE_POOL_SIZE', 20))
+# Когда запас падает до этого числа, пул пополняется до POOL_SIZE
+LOW_WATERMARK = int(config.config_env.get('INVITE_POOL_LOW', 5))
+# Как часто проверять запас, секунд
+REFILL_INTERVAL = 60
+
+
+class InviteLinkPool:
+    """
+    Запас одноразовых ссылок (member_limit = 1) в каналы курсов из catalog.by_channel_id.
+    Ссылки создаются заранее в фоне, а при оплате выдаются из БД
+    (Database.record_payment) — без запроса к Bot API на пути вебхука.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def refill(self) -> int:
+        """
+        Досоздаёт ссылки для каналов, где запас упал до LOW_WATERMARK.
+
+        :return: Сколько ссылок создано.
+        """
+        stock = await self.db.get_invite_link_stock()
+        created = 0
+        for channel_id, course in catalog.by_channel_id.items():
+            course_chapter = course.key
+            available = stock.get(course_chapter, 0)
+            if available > LOW_WATERMARK:
+                continue
+
+            links = await asyncio.gather(*(
+                telegram_https.create_invite_link(channel_id, creates_join_request=False,
+                                                  name=f"pool {course_chapter}", member_limit=1)
+                for _ in range(POOL_SIZE - available)
+            ))
+            links = [link for link in links if link]
+            if links:
+                await self.db.save_invite_links(course_chapter, channel_id, links)
+                created += len(links)
+                logger.info(f"🔗 {course_chapter}: +{len(links)} ссылок, в запасе {available + len(links)}")
+        return created
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"❗ Не удалось пополнить запас ссылок: {e}")
+            await asyncio.sleep(REFILL_INTERVAL)
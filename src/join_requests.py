@@ -0,0 +1,147 @@
+import asyncio
+import logging
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import router
+from catalog import catalog
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько ждать после первой заявки, собирая пачку, секунд
+BATCH_WINDOW = 0.5
+# Пачка такого размера обрабатывается сразу, не дожидаясь окна
+MAX_BATCH = 200
+# Отклонённых в одной сводке для админа (по две кнопки на строку, в клавиатуре — до 100 кнопок)
+DIGEST_SIZE = 50
+
+
+class JoinRequestBatcher:
+    """
+    Заявки на вступление в каналы курсов обрабатываются пачками: доступы всей
+    пачки — одним запросом, одобрения, отказы и сообщения уходят параллельно
+    (лимиты держит AIORateLimiter бота), а отклонённые по каждому каналу
+    собираются в одну сводку для админа.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._pending = []
+        self._window_open = False
+        self._tasks = set()
+
+    def submit(self, bot, join_request):
+        """
+        Ставит заявку в пачку. Возвращается сразу — обработчик апдейта не ждёт БД и Bot API.
+        """
+        self._pending.append(join_request)
+        if len(self._pending) >= MAX_BATCH:
+            self._spawn(self._flush(bot))
+        elif not self._window_open:
+            self._window_open = True
+            self._spawn(self._flush_after_window(bot))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_after_window(self, bot):
+        await asyncio.sleep(BATCH_WINDOW)
+        self._window_open = False
+        await self._flush(bot)
+
+    async def _flush(self, bot):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await self.process(bot, batch)
+        except Exception as e:
+            logger.error(f"❗ Ошибка при обработке заявок на вступление ({len(batch)} шт.): {e}")
+
+    async def process(self, bot, batch: list):
+        entitlements = await self.db.get_users_entitlements([request.from_user.id for request in batch])
+
+        approved, declined = [], {}
+        for request in batch:
+            course = catalog.get_by_channel(request.chat.id)
+            if course and course.key in entitlements[request.from_user.id].all:
+                approved.append(request)
+            else:
+                declined.setdefault(request.chat.id, []).append(request)
+
+        await asyncio.gather(
+            *(self._approve(bot, request) for request in approved),
+            *(self._decline(bot, request) for requests in declined.values() for request in requests),
+            *(self._send_digest(chat_id, requests[i:i + DIGEST_SIZE])
+              for chat_id, requests in declined.items() for i in range(0, len(requests), DIGEST_SIZE))
+        )
+        logger.info(f"🚪 Заявки на вступление: одобрено {len(approved)}, "
+                    f"отклонено {sum(len(requests) for requests in declined.values())}")
+
+    async def _approve(self, bot, request):
+        course = catalog.get_by_channel(request.chat.id)
+        user_id = request.from_user.id
+        try:
+            await bot.approve_chat_join_request(chat_id=request.chat.id, user_id=user_id)
+            keyboard = [[InlineKeyboardButton("✅ Перейти в канал", url=course.channel_invite_link)]]
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"Для перехода в канал ({course.name}) нажмите на кнопку ниже",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            logger.info(f"✅ Одобрен вход для {user_id}")
+        except Exception as e:
+            logger.error(f"❌ Не удалось одобрить заявку {user_id} в {request.chat.id}: {e}")
+
+    async def _decline(self, bot, request):
+        try:
+            await bot.decline_chat_join_request(chat_id=request.chat.id, user_id=request.from_user.id)
+        except Exception as e:
+            logger.error(f"❌ Не удалось отклонить заявку {request.from_user.id} в {request.chat.id}: {e}")
+
+    async def _send_digest(self, chat_id: int, requests: list):
+        course = catalog.get_by_channel(chat_id)
+        name, course_key = course.name, course.key
+        if len(requests) == 1:
+            user_id = requests[0].from_user.id
+            text = f"❌ Пользователь {user_id} был отклонён при попытке вступить в {name}. Хотите выдать ему доступ?"
+            keyboard = [
+                [InlineKeyboardButton("✅ Выдать доступ", callback_data=router.pack(router.GRANT_ACCESS, user_id, course_key))],
+                [InlineKeyboardButton("❌ Не выдавать доступ", callback_data=router.pack(router.DENY_ACCESS, user_id, course_key))]
+            ]
+        else:
+            lines = []
+            keyboard = []
+            for request in requests:
+                user = request.from_user
+                username = f" @{user.username}" if user.username else ""
+                lines.append(f"• {user.full_name}{username} — {user.id}")
+                keyboard.append([
+                    InlineKeyboardButton(f"✅ {user.id}", callback_data=router.pack(router.GRANT_ACCESS, user.id, course_key)),
+                    InlineKeyboardButton(f"❌ {user.id}", callback_data=router.pack(router.DENY_ACCESS, user.id, course_key))
+                ])
+            text = (f"❌ Отклонены заявки в {name} ({len(requests)}). Кнопками ниже можно выдать доступ:\n\n"
+                    + "\n".join(lines))
+        # В админский чат пишет только outbox_worker — так соблюдается лимит 20 сообщений в минуту на группу
+        admin_chat_id = int(config.cfg['ADMIN_CHAT_ID']['MAIN'])
+        try:
+            await self.db.add_outbox([(admin_chat_id, 'sendMessage', {
+                'chat_id': admin_chat_id,
+                'text': text,
+                'reply_markup': InlineKeyboardMarkup(keyboard).to_dict(),
+                'message_thread_id': config.cfg['ADMIN_CHAT_ID']['DECLINED_REQUESTS']
+            })])
+        except Exception as e:
+            logger.error(f"❌ Не удалось отправить сводку отклонённых заявок в {name}: {e}")
+
+    async def close(self):
+        """
+        Дорабатывает собранные заявки при остановке бота.
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
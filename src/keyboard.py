@@ -1,21 +1,49 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import config
+from catalog import catalog
+import router
+
+# Кнопки под меню «Купить несколько разделов»: ключ в bot_buttons.yml -> код действия
+MULTI_BUY_ACTIONS = {
+    'confirm': router.CONFIRM_MULTI_BUY,
+    'clear': router.CLEAR_MULTI_BUY,
+    'go_back': router.ALL_COURSES,
+}
+
+# Порядок разделов в меню (как в courses.yml); номер бита раздела в масках — его позиция здесь.
+# Пересобираются из каталога в invalidate()
+CHAPTER_ORDER = ()
+CHAPTER_BITS = {}
+ALL_CHAPTERS = 0
+
+
+def _index_chapters():
+    global CHAPTER_ORDER, CHAPTER_BITS, ALL_CHAPTERS
+    CHAPTER_ORDER = tuple(course.key for course in catalog.courses)
+    CHAPTER_BITS = {key: 1 << position for position, key in enumerate(CHAPTER_ORDER)}
+    ALL_CHAPTERS = (1 << len(CHAPTER_ORDER)) - 1
+
+
+def chapter_mask(chapters) -> int:
+    """
+    Битовая маска набора разделов (None — все разделы).
+    """
+    if chapters is None:
+        return ALL_CHAPTERS
+    mask = 0
+    for key in chapters:
+        mask |= CHAPTER_BITS.get(key, 0)
+    return mask
 
 
 def main_menu_button_markup():
-    keyboard = [[InlineKeyboardButton(
-        text=config.bot_btn['main_menu_main'],
-        callback_data='main_menu'
-    )]]
-    return keyboard
+    return [list(row) for row in _footer_rows('main_menu')]
 
 
 def buy_multiply_button_markup():
-    keyboard = [[InlineKeyboardButton(
-        text=config.bot_btn['buy_multiply']['main'],
-        callback_data='buy_multiply'
-    )]]
-    return keyboard
+    return [list(row) for row in _footer_rows('buy_multiply')]
 
 #
 # def ch_choose_button(available_courses=None):
@@ -36,36 +64,98 @@ def buy_multiply_button_markup():
 
 
 def ch_choose_button(available_courses=None, mode='buy', selected=None, menu_path='def'):
-    chapter_order = ['ch_1', 'ch_2', 'ch_3', 'ch_4', 'ch_5', 'ch_6', 'ch_7']
-    keyboard = []
-
-    selected = selected or []
-
-    for key in chapter_order:
-        if available_courses is None or key in available_courses:
-            course = config.courses[key]
-            num_of_chapter = key.split('_')[1]
-            name = course['short_name'] + course['emoji']
-
-            # Добавляем галочку, если в режиме multi_buy и глава выбрана
-            if mode == 'multi_buy' and key in selected:
-                name = '✅ ' + name
-
-            button = InlineKeyboardButton(
-                text=name,
-                callback_data=f'{mode}_chapter:{num_of_chapter}:{menu_path}'  # например: multi_buy_chapter:1
-            )
-            keyboard.append([button])
-
-    return keyboard
-
-
+    # Список для тех, кто дописывает свои строки; сами кнопки берутся из кэша
+    return [list(row) for row in course_menu(mode, menu_path, available_courses, selected).inline_keyboard]
+
+
+def course_menu(mode: str = 'buy', menu_path: str = 'def', available=None, selected=None,
+                footer: tuple = ()) -> InlineKeyboardMarkup:
+    """
+    Меню разделов из кэша (InlineKeyboardMarkup неизменяемый — один объект на всех).
+
+    :param mode: buy | multi_buy — префикс callback_data, в multi_buy выбранные отмечены галочкой.
+    :param menu_path: Откуда открыто меню (третья часть callback_data).
+    :param available: Какие разделы показать (None — все).
+    :param selected: Выбранные разделы (только для multi_buy).
+    :param footer: Строки под разделами по порядку: buy_multiply, multi_buy_menu, main_menu.
+    """
+    selected_mask = chapter_mask(selected or ()) if mode == 'multi_buy' else 0
+    return _course_menu(mode, menu_path, chapter_mask(available), selected_mask, tuple(footer))
+
+
+# multi_buy: выбранные ⊆ доступных — 3^n вариантов (2187 при 7 разделах), плюс несколько меню режима buy
+@lru_cache(maxsize=4096)
+def _course_menu(mode: str, menu_path: str, available_mask: int, selected_mask: int,
+                 footer: tuple) -> InlineKeyboardMarkup:
+    keyboard = [
+        (_chapter_button(mode, key, menu_path, bool(selected_mask & bit)),)
+        for key, bit in CHAPTER_BITS.items()
+        if available_mask & bit
+    ]
+    for name in footer:
+        keyboard.extend(_footer_rows(name))
+    return InlineKeyboardMarkup(keyboard)
+
+
+@lru_cache(maxsize=256)
+def _chapter_button(mode: str, key: str, menu_path: str, checked: bool) -> InlineKeyboardButton:
+    course = catalog.get(key)
+    name = course.button_text
+
+    # Добавляем галочку, если в режиме multi_buy и глава выбрана
+    if checked:
+        name = '✅ ' + name
+
+    action = router.MULTI_BUY_CHAPTER if mode == 'multi_buy' else router.BUY_CHAPTER
+    return InlineKeyboardButton(
+        text=name,
+        callback_data=router.pack(action, course.num, menu_path)  # например: 1mc:1:def
+    )
+
+
+@lru_cache(maxsize=None)
+def _footer_rows(name: str) -> tuple:
+    if name == 'main_menu':
+        return ((InlineKeyboardButton(text=config.bot_btn['main_menu_main'], callback_data=router.pack(router.MAIN_MENU)),),)
+    if name == 'buy_multiply':
+        return ((InlineKeyboardButton(text=config.bot_btn['buy_multiply']['main'], callback_data=router.pack(router.BUY_MULTIPLY)),),)
+    if name == 'multi_buy_menu':
+        # Каждая кнопка — это (название, callback_data)
+        return tuple(
+            (InlineKeyboardButton(text=label, callback_data=router.pack(MULTI_BUY_ACTIONS[key])),)
+            for key, label in config.bot_btn['buy_multiply']['menu'].items()
+        )
+    raise ValueError(f"Неизвестная строка меню: {name}")
+
+
+@lru_cache(maxsize=256)
+def chapter_info_menu(num_of_chapter: str, menu_path: str, owned: bool) -> InlineKeyboardMarkup:
+    """
+    Кнопки под описанием раздела: в канал (если доступ есть) или к оплате, и назад.
+    """
+    course = catalog.get_by_num(num_of_chapter)
+    if owned:
+        action = InlineKeyboardButton(config.bot_btn['go_to_channel'], url=course.channel_invite_link)
+    else:
+        action = InlineKeyboardButton(config.bot_btn['go_to_pay'], callback_data=router.pack(router.PAY_CHAPTER, course.num))
+    return InlineKeyboardMarkup([
+        [action],
+        [InlineKeyboardButton(config.bot_btn['go_back'], callback_data=router.pack(router.GO_BACK, menu_path))]
+    ])
+
+
+@lru_cache(maxsize=None)
+def main_menu_markup() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(_footer_rows('main_menu'))
+
+
+@lru_cache(maxsize=None)
 def main_menu_items_button_markup():
     main_menu = config.bot_btn['main_menu']
 
-    # Каждая кнопка — это (название, callback_data)
+    # Ключи пунктов — они же команды бота; в callback_data — код действия по старому имени
     buttons = [
-        [InlineKeyboardButton(text=label, callback_data=key)]
+        [InlineKeyboardButton(text=label, callback_data=router.pack(router.LEGACY[key][0]))]
         for key, label in main_menu.items()
     ]
 
@@ -73,12 +163,22 @@ def main_menu_items_button_markup():
 
 
 def buy_multiply_menu_items_button():
-    buy_multiply_menu = config.bot_btn['buy_multiply']['menu']
+    return [list(row) for row in _footer_rows('multi_buy_menu')]
+
+
+def invalidate():
+    """
+    Пересобирает порядок разделов из каталога и сбрасывает кэш клавиатур (после config.reload()).
+    """
+    _index_chapters()
+    _course_menu.cache_clear()
+    _chapter_button.cache_clear()
+    _footer_rows.cache_clear()
+    chapter_info_menu.cache_clear()
+    main_menu_markup.cache_clear()
+    main_menu_items_button_markup.cache_clear()
 
-    # Каждая кнопка — это (название, callback_data)
-    buttons = [
-        [InlineKeyboardButton(text=label, callback_data=f'{key}_buy_multiply')]
-        for key, label in buy_multiply_menu.items()
-    ]
 
-    return buttons
+_index_chapters()
+# Каталог зарегистрировал свой хук раньше (импорт выше), поэтому здесь он уже пересобран
+config.reload_hooks.append(invalidate)
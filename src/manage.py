@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+import argparse
+import asyncio
+import sys
+
+import migrate
+from setup import pdb
+
+
+async def run_migrations():
+    await pdb.connect()
+    try:
+        applied = await migrate.apply_migrations(pdb)
+        print(f"✅ Применено миграций: {len(applied)}")
+    finally:
+        await pdb.close()
+
+
+async def verify_plans(users: int) -> bool:
+    await pdb.connect()
+    try:
+        return await migrate.verify_plans(pdb, users=users)
+    finally:
+        await pdb.close()
+
+
+async def backfill_user_courses():
+    await pdb.connect()
+    try:
+        await migrate.apply_migrations(pdb)
+        inserted = await pdb.backfill_user_courses()
+        print(f"✅ user_courses заполнена, добавлено строк: {inserted}")
+    finally:
+        await pdb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('migrate', help="Накатить новые миграции из src/migrations")
+
+    verify_parser = subparsers.add_parser(
+        'verify-plans',
+        help="Проверить через EXPLAIN, что запросы postgresdb.py не уходят в seq scan"
+    )
+    verify_parser.add_argument('--users', type=int, default=200000,
+                               help="Размер синтетического набора данных (число пользователей)")
+
+    subparsers.add_parser('backfill-user-courses',
+                          help="Заполнить user_courses по оплатам и ручным доступам")
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        asyncio.run(run_migrations())
+    elif args.command == 'verify-plans':
+        if not asyncio.run(verify_plans(args.users)):
+            sys.exit(1)
+    elif args.command == 'backfill-user-courses':
+        asyncio.run(backfill_user_courses())
+
+
+if __name__ == '__main__':
+    main()
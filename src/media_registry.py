@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import logging
+
+import config
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# kind -> (метод бота, имя аргумента с файлом)
+SEND_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'video_note': ('send_video_note', 'video_note'),
+    'document': ('send_document', 'document'),
+}
+
+
+def _sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_id(message, kind: str) -> str:
+    if kind == 'photo':
+        return message.photo[-1].file_id
+    return getattr(message, kind).file_id
+
+
+class MediaRegistry:
+    """
+    Отправляет файлы из config.media_dir по file_id. Каждый файл загружается
+    в Telegram один раз (в админский топик-хранилище), file_id и sha256
+    хранятся в media_files. Если файл на диске поменялся — загружается заново.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._file_ids = {}  # (name, kind) -> (sha256, file_id)
+        self._hashes = {}    # name -> ((mtime_ns, size), sha256)
+        self._locks = {}     # (name, kind) -> asyncio.Lock
+        self.uploads = 0
+
+    async def _hash(self, name: str) -> str:
+        path = config.media_dir / name
+        stat = path.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._hashes.get(name)
+        if cached is None or cached[0] != key:
+            # Видео может весить десятки мегабайт — считаем хэш не в event loop
+            cached = (key, await asyncio.to_thread(_sha256, path))
+            self._hashes[name] = cached
+        return cached[1]
+
+    async def _upload(self, bot, name: str, kind: str) -> str:
+        method, argument = SEND_METHODS[kind]
+        with open(config.media_dir / name, 'rb') as f:
+            message = await getattr(bot, method)(
+                chat_id=config.cfg['ADMIN_CHAT_ID']['MAIN'],
+                message_thread_id=config.cfg['ADMIN_CHAT_ID'].get('MEDIA'),
+                **{argument: f}
+            )
+        self.uploads += 1
+        logger.info(f"📎 Загружен {name} ({kind})")
+        return _file_id(message, kind)
+
+    async def file_id(self, bot, name: str, kind: str) -> str:
+        """
+        Возвращает file_id файла, при необходимости загрузив его.
+
+        :param bot: telegram.Bot
+        :param name: Имя файла в config.media_dir.
+        :param kind: photo / video / video_note / document.
+        """
+        key = (name, kind)
+        sha256 = await self._hash(name)
+        cached = self._file_ids.get(key)
+        if cached and cached[0] == sha256:
+            return cached[1]
+
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            cached = self._file_ids.get(key)
+            if cached and cached[0] == sha256:
+                return cached[1]
+
+            saved = await self.db.get_media_file(name, kind)
+            if saved and saved['sha256'] == sha256:
+                file_id = saved['file_id']
+            else:
+                file_id = await self._upload(bot, name, kind)
+                await self.db.save_media_file(name, kind, sha256, file_id)
+            self._file_ids[key] = (sha256, file_id)
+            return file_id
+
+    async def send(self, bot, chat_id: int, name: str, kind: str, **kwargs):
+        """
+        Отправляет файл из config.media_dir по file_id.
+
+        :param kwargs: Остальные параметры метода отправки (caption, reply_markup, ...).
+        :return: telegram.Message
+        """
+        method, argument = SEND_METHODS[kind]
+        file_id = await self.file_id(bot, name, kind)
+        return await getattr(bot, method)(chat_id=chat_id, **{argument: file_id}, **kwargs)
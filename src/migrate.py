@@ -0,0 +1,255 @@
+import ast
+import json
+import logging
+import re
+from pathlib import Path
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+migrations_dir = Path(__file__).parent.joinpath("migrations")
+postgresdb_path = Path(__file__).parent.joinpath("postgresdb.py")
+
+# Произвольный ключ advisory lock, чтобы бот и uvicorn не накатывали миграции одновременно
+MIGRATIONS_LOCK_KEY = 7348201
+
+# Запросы, которым seq scan по указанным таблицам разрешён:
+# они по смыслу проходят всю таблицу (None — любую таблицу)
+ALLOWED_SEQ_SCANS = {
+    # Полная загрузка сегментов для рассылок (раз в несколько минут)
+    'get_segment_users': {'users'},
+    'get_segment_courses': {'user_courses'},
+    # Разовая команда, переносит все оплаты и ручные доступы
+    'backfill_user_courses': None,
+    # Несколько строк на всю таблицу (файлы из media/) — индекс не нужен
+    'get_media_file': {'media_files'},
+    # Заданий рассылки — десятки строк за всё время
+    'get_broadcast_job': {'broadcast_jobs'},
+    'get_broadcast_jobs': {'broadcast_jobs'},
+    'get_sendable_broadcast_job_ids': {'broadcast_jobs'},
+    'set_broadcast_job_status': {'broadcast_jobs'},
+    # Кампаний — единицы
+    'get_campaigns': {'campaigns'},
+    'claim_due_campaigns': {'campaigns'},
+    'set_campaign_status': {'campaigns'},
+    'release_campaign_window': {'campaigns'},
+}
+
+# Синтетические данные для verify_plans. Размер задаётся параметром %(users)s
+SYNTHETIC_DATA = [
+    """
+    INSERT INTO users (user_id, username, first_name, created_at, updated_at)
+    SELECT g, 'user' || g, 'Имя', NOW() - g * INTERVAL '1 minute', NOW()
+    FROM generate_series(1, %(users)s) g
+    """,
+    """
+    INSERT INTO orders (user_id, course_chapter, order_code, email, agreed_offer,
+                        agreed_privacy, agreed_newsletter, payment_message_id)
+    SELECT (g %% %(users)s) + 1,
+           ARRAY['ch_' || (g %% 7 + 1)],
+           g,
+           'user' || g || '@example.com',
+           TRUE, TRUE, g %% 10 <> 0,
+           CASE WHEN g %% 3 = 0 THEN g END
+    FROM generate_series(1, %(users)s * 3) g
+    """,
+    """
+    INSERT INTO payments (amount, income_amount, payment_method_type, order_id, created_at)
+    SELECT 4990, 4800, 'BankCard', order_id, NOW()
+    FROM orders
+    WHERE order_id %% 10 = 0
+    """,
+    """
+    INSERT INTO manual_access (user_id, course_chapter, granted_by)
+    SELECT g, 'ch_' || (g %% 7 + 1), 1
+    FROM generate_series(1, %(users)s, 50) g
+    """,
+    """
+    INSERT INTO user_courses (user_id, course_chapter, source)
+    SELECT o.user_id, unnest(o.course_chapter), 'payment'
+    FROM orders o
+    JOIN payments p ON p.order_id = o.order_id
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO outbox (chat_id, method, payload, status, sent_at)
+    SELECT (g %% %(users)s) + 1, 'sendMessage', '{}',
+           CASE WHEN g %% 500 = 0 THEN 'pending' ELSE 'sent' END, NOW()
+    FROM generate_series(1, %(users)s) g
+    """,
+    """
+    INSERT INTO broadcast_jobs (name, message, status)
+    SELECT 'mail' || g, '{}', CASE WHEN g = 50 THEN 'running' ELSE 'done' END
+    FROM generate_series(1, 50) g
+    """,
+    """
+    INSERT INTO campaigns (template, message, send_at, status)
+    SELECT 'mail' || g, '{}', NOW() - g * INTERVAL '1 day',
+           CASE WHEN g <= 3 THEN 'scheduled' ELSE 'started' END
+    FROM generate_series(1, 200) g
+    """,
+    """
+    INSERT INTO invite_links (invite_link, course_chapter, channel_id, status)
+    SELECT 'https://t.me/+' || g, 'ch_' || (g %% 7 + 1), -100,
+           CASE WHEN g %% 50 = 0 THEN 'available' ELSE 'issued' END
+    FROM generate_series(1, %(users)s) g
+    """,
+    """
+    INSERT INTO broadcast_deliveries (job_id, user_id, status)
+    SELECT j, u, CASE WHEN j = 50 AND u %% 2 = 0 THEN 'pending' ELSE 'sent' END
+    FROM generate_series(46, 50) j, generate_series(1, %(users)s) u
+    """,
+]
+
+
+def list_migrations() -> list[tuple[int, str, Path]]:
+    """
+    Возвращает миграции из src/migrations в порядке версий.
+
+    :return: список (version, name, path)
+    """
+    migrations = []
+    for path in sorted(migrations_dir.glob("*.sql")):
+        version, _, name = path.stem.partition('_')
+        migrations.append((int(version), name, path))
+    return migrations
+
+
+async def _apply(conn) -> list[int]:
+    # У соединений пула statement_timeout 5 с, а построение индексов и чистка
+    # данных на боевой базе идут дольше — снимаем его до конца транзакции
+    await conn.execute("SET LOCAL statement_timeout = 0")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+    cursor = await conn.execute("SELECT version FROM schema_migrations")
+    applied_versions = {row[0] for row in await cursor.fetchall()}
+
+    applied = []
+    for version, name, path in list_migrations():
+        if version in applied_versions:
+            continue
+        await conn.execute(path.read_text(encoding='utf-8'))
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+            (version, name)
+        )
+        applied.append(version)
+    return applied
+
+
+async def apply_migrations(db) -> list[int]:
+    """
+    Накатывает все ещё не применённые миграции в одной транзакции.
+
+    :param db: postgresdb.Database с открытым пулом
+    :return: список применённых версий
+    """
+    async with db.pool.connection() as conn:
+        applied = await _apply(conn)
+    for version in applied:
+        logger.info(f"✅ Применена миграция {version:04d}")
+    return applied
+
+
+def collect_queries() -> list[tuple[str, str]]:
+    """
+    Достаёт из postgresdb.py все SQL-запросы, которые передаются в execute().
+
+    :return: список (имя метода, SQL)
+    """
+    tree = ast.parse(postgresdb_path.read_text(encoding='utf-8'))
+    queries = []
+    for func in ast.walk(tree):
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        # Запросы, вынесенные в локальную переменную: query = """..."""
+        local_strings = {
+            node.targets[0].id: node.value.value
+            for node in ast.walk(func)
+            if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name)
+            and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+        }
+        for node in ast.walk(func):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr == 'execute' and node.args):
+                continue
+            arg = node.args[0]
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                query = arg.value
+            elif isinstance(arg, ast.Name) and arg.id in local_strings:
+                query = local_strings[arg.id]
+            else:
+                continue
+            if re.match(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', query, re.IGNORECASE):
+                queries.append((func.name, query))
+    return queries
+
+
+def _to_generic(query: str) -> str:
+    counter = iter(range(1, 1000))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', query)
+
+
+def _seq_scans(plan: dict) -> set:
+    tables = set()
+    # Системные каталоги (pg_sequences и т.п.) крошечные — их seq scan не интересен
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Schema') != 'pg_catalog':
+        tables.add(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        tables |= _seq_scans(child)
+    return tables
+
+
+async def verify_plans(db, users: int = 200000) -> bool:
+    """
+    Во временной схеме накатывает миграции, заполняет её синтетическими данными
+    и прогоняет EXPLAIN (GENERIC_PLAN) по каждому запросу из postgresdb.py.
+    Все изменения откатываются.
+
+    :param db: postgresdb.Database с открытым пулом
+    :param users: число синтетических пользователей (заказов — втрое больше)
+    :return: True, если ни один запрос не уходит в seq scan
+    """
+    ok = True
+    async with db.pool.connection() as conn:
+        try:
+            await conn.execute("SET LOCAL statement_timeout = 0")
+            await conn.execute("CREATE SCHEMA plan_check")
+            await conn.execute("SET LOCAL search_path = plan_check")
+            await _apply(conn)
+            for statement in SYNTHETIC_DATA:
+                await conn.execute(statement, {'users': users})
+            cursor = await conn.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'plan_check'")
+            for (table,) in await cursor.fetchall():
+                await conn.execute(f"ANALYZE plan_check.{table}")
+
+            for name, query in collect_queries():
+                allowed = ALLOWED_SEQ_SCANS.get(name, set())
+                try:
+                    async with conn.transaction():
+                        cursor = await conn.execute(f"EXPLAIN (GENERIC_PLAN, VERBOSE, FORMAT JSON) {_to_generic(query)}")
+                        plan = (await cursor.fetchone())[0]
+                except Exception as e:
+                    logger.error(f"❌ {name}: не удалось построить план: {e}")
+                    ok = False
+                    continue
+
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                seq_scans = _seq_scans(plan[0]['Plan'])
+                seq_scans = set() if allowed is None else seq_scans - allowed
+                if seq_scans:
+                    logger.error(f"❌ {name}: seq scan по {', '.join(sorted(seq_scans))}")
+                    ok = False
+                else:
+                    logger.info(f"✅ {name}")
+        finally:
+            await conn.rollback()
+    return ok
@@ -0,0 +1,58 @@
+-- Базовые таблицы бота. IF NOT EXISTS — чтобы миграция спокойно легла
+-- на уже существующую боевую базу.
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    order_id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    course_chapter TEXT[] NOT NULL,
+    order_code INTEGER NOT NULL,
+    email TEXT,
+    agreed_offer BOOLEAN,
+    agreed_privacy BOOLEAN,
+    agreed_newsletter BOOLEAN,
+    payment_message_id BIGINT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id SERIAL PRIMARY KEY,
+    amount NUMERIC(12, 2) NOT NULL,
+    income_amount NUMERIC(12, 2),
+    payment_method_type TEXT,
+    order_id INTEGER NOT NULL REFERENCES orders (order_id),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS manual_access (
+    user_id BIGINT NOT NULL,
+    course_chapter TEXT NOT NULL,
+    granted_by BIGINT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (user_id, course_chapter)
+);
+
+-- check_order_code_unique, get_order_by_code, update_* и вебхук Robokassa (InvId)
+CREATE INDEX IF NOT EXISTS orders_order_code_idx ON orders (order_code);
+
+-- Заказы пользователя (в т.ч. коррелированные подзапросы рассылки)
+CREATE INDEX IF NOT EXISTS orders_user_id_idx ON orders (user_id) INCLUDE (order_id);
+
+-- Проверки вида course_chapter @> ARRAY['ch_1']
+CREATE INDEX IF NOT EXISTS orders_course_chapter_gin_idx ON orders USING GIN (course_chapter);
+
+-- Отказ от рассылки в оплаченных заказах
+CREATE INDEX IF NOT EXISTS orders_newsletter_decline_idx ON orders (user_id)
+    WHERE agreed_newsletter = FALSE AND payment_message_id IS NOT NULL;
+
+-- Связка orders ⋈ payments
+CREATE INDEX IF NOT EXISTS payments_order_id_idx ON payments (order_id);
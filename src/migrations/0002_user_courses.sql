@@ -0,0 +1,14 @@
+-- Денормализованные доступы пользователей к курсам.
+-- Пишется вместе с payments / manual_access, заполняется командой
+-- python manage.py backfill-user-courses
+
+CREATE TABLE IF NOT EXISTS user_courses (
+    user_id BIGINT NOT NULL,
+    course_chapter TEXT NOT NULL,
+    source TEXT NOT NULL,  -- 'payment' или 'manual'
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, course_chapter, source)
+);
+
+-- Владельцы конкретного курса (аудитории рассылок)
+CREATE INDEX IF NOT EXISTS user_courses_chapter_idx ON user_courses (course_chapter, source, user_id);
@@ -0,0 +1,13 @@
+-- Коды заказов (Robokassa InvId) выдаются блоками из последовательности:
+-- каждый nextval резервирует INCREMENT BY кодов подряд.
+-- Старые случайные коды были пятизначными, новые начинаются выше них,
+-- потолок — максимальный InvId Robokassa (int4).
+
+CREATE SEQUENCE IF NOT EXISTS order_code_seq
+    AS INTEGER
+    INCREMENT BY 100
+    MINVALUE 100000
+    MAXVALUE 2147483647
+    NO CYCLE;
+
+SELECT setval('order_code_seq', GREATEST((SELECT MAX(order_code) FROM orders) + 1, 100000), false);
@@ -0,0 +1,7 @@
+-- Время каждого согласия покупателя: раньше оно оставалось только в updated_at,
+-- который перетирался следующим шагом.
+
+ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS agreed_offer_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS agreed_privacy_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS agreed_newsletter_at TIMESTAMPTZ;
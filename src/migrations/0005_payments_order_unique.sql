@@ -0,0 +1,20 @@
+-- Один платёж на заказ: вебхук Robokassa делает INSERT ... ON CONFLICT (order_id),
+-- поэтому повторные уведомления о том же InvId больше не создают дублей.
+
+-- Дубли от прежних гонок повторных уведомлений: в payments остаётся самый ранний платёж,
+-- остальные не удаляются, а переносятся в payments_duplicates для сверки оператором
+CREATE TABLE IF NOT EXISTS payments_duplicates (LIKE payments INCLUDING DEFAULTS);
+ALTER TABLE payments_duplicates ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+WITH moved AS (
+    DELETE FROM payments p
+    USING payments earlier
+    WHERE earlier.order_id = p.order_id
+      AND earlier.payment_id < p.payment_id
+    RETURNING p.*
+)
+INSERT INTO payments_duplicates
+SELECT moved.*, NOW() FROM moved;
+
+CREATE UNIQUE INDEX IF NOT EXISTS payments_order_id_key ON payments (order_id);
+DROP INDEX IF EXISTS payments_order_id_idx;
@@ -0,0 +1,23 @@
+-- Исходящие сообщения Telegram после оплаты. Пишутся в одной транзакции
+-- с платежом, доставляются отдельным процессом outbox_worker.py.
+
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    method TEXT NOT NULL,                        -- метод Bot API: sendMessage, deleteMessage, ...
+    payload JSONB NOT NULL,                      -- параметры метода
+    status TEXT NOT NULL DEFAULT 'pending',      -- pending / sent / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+
+-- Выборка готовых к отправке
+CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at, outbox_id)
+    WHERE status = 'pending';
+
+-- Порядок доставки внутри одного получателя
+CREATE INDEX IF NOT EXISTS outbox_chat_pending_idx ON outbox (chat_id, outbox_id)
+    WHERE status = 'pending';
@@ -0,0 +1,11 @@
+-- Кэш file_id Telegram для файлов из media/: файл загружается один раз,
+-- дальше отправляется по file_id. sha256 — чтобы заметить замену файла.
+
+CREATE TABLE IF NOT EXISTS media_files (
+    name TEXT NOT NULL,              -- имя файла в config.media_dir
+    kind TEXT NOT NULL,              -- photo / video / video_note / document
+    sha256 TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (name, kind)
+);
@@ -0,0 +1,26 @@
+-- Рассылки, которые переживают перезапуск бота: задание + состояние доставки
+-- по каждому получателю. Незавершённые задания продолжаются с pending.
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    job_id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    message JSONB NOT NULL,                      -- что отправлять: kind, text, media, reply_markup
+    status TEXT NOT NULL DEFAULT 'running',      -- running / paused / cancelled / done
+    created_by BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id BIGINT NOT NULL REFERENCES broadcast_jobs (job_id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',      -- pending / sent / failed
+    error TEXT,
+    updated_at TIMESTAMPTZ,
+    PRIMARY KEY (job_id, user_id)
+);
+
+-- Кого ещё осталось отправить при продолжении задания
+CREATE INDEX IF NOT EXISTS broadcast_deliveries_pending_idx ON broadcast_deliveries (job_id, user_id)
+    WHERE status = 'pending';
@@ -0,0 +1,10 @@
+-- Пользователи, до которых бот не может достучаться: заблокировали бота,
+-- удалили аккаунт, чат не найден. Такие исключаются из рассылок.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMPTZ,   -- когда последний раз подтвердилось
+    ADD COLUMN IF NOT EXISTS unreachable_reason TEXT;      -- blocked / deactivated / chat_not_found
+
+-- Выборка для периодической повторной проверки
+CREATE INDEX IF NOT EXISTS users_unreachable_idx ON users (unreachable_at)
+    WHERE unreachable_at IS NOT NULL;
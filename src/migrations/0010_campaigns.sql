@@ -0,0 +1,30 @@
+-- Запланированные рассылки и drip-кампании. Запускает их JobQueue бота:
+-- в send_at выбирает сегмент и создаёт задание в broadcast_jobs.
+
+CREATE TABLE IF NOT EXISTS campaigns (
+    campaign_id BIGSERIAL PRIMARY KEY,
+    template TEXT NOT NULL,                      -- ключ из config/mailling.yml
+    message JSONB NOT NULL,                      -- kind, media, reply_markup (текст — из шаблона при запуске)
+    segment JSONB NOT NULL DEFAULT '{}',         -- аргументы Segments.select: owns, not_owns
+    send_at TIMESTAMPTZ NOT NULL,                -- когда запустить (для drip — следующий запуск)
+    drip_after INTERVAL,                         -- drip: через сколько после регистрации; NULL — разовая
+    registered_until TIMESTAMP,                  -- drip: до какого created_at пользователи уже охвачены
+    spread_minutes INTEGER NOT NULL DEFAULT 0,   -- на сколько минут растянуть отправку
+    quiet_start TIME,                            -- тихие часы по Москве, могут переходить через полночь
+    quiet_end TIME,
+    status TEXT NOT NULL DEFAULT 'scheduled',    -- scheduled / started / failed / cancelled
+    created_by BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Поиск кампаний, которым пора запускаться
+CREATE INDEX IF NOT EXISTS campaigns_due_idx ON campaigns (send_at)
+    WHERE status = 'scheduled';
+
+-- Темп и тихие часы задания: воркер рассылок не отправляет в тихие часы
+-- и не разгоняется быстрее rate (msg/s), если он задан
+ALTER TABLE broadcast_jobs
+    ADD COLUMN IF NOT EXISTS rate REAL,
+    ADD COLUMN IF NOT EXISTS quiet_start TIME,
+    ADD COLUMN IF NOT EXISTS quiet_end TIME,
+    ADD COLUMN IF NOT EXISTS campaign_id BIGINT REFERENCES campaigns (campaign_id);
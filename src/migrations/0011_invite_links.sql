@@ -0,0 +1,17 @@
+-- Запас заранее созданных одноразовых ссылок (member_limit = 1) в каналы курсов.
+-- Пополняет outbox_worker.py, выдаются в транзакции record_payment.
+
+CREATE TABLE IF NOT EXISTS invite_links (
+    invite_link TEXT PRIMARY KEY,
+    course_chapter TEXT NOT NULL,
+    channel_id BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'available',    -- available / issued
+    user_id BIGINT,
+    order_id BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    issued_at TIMESTAMPTZ
+);
+
+-- Выдача самой старой свободной ссылки курса и подсчёт запаса
+CREATE INDEX IF NOT EXISTS invite_links_available_idx ON invite_links (course_chapter, created_at)
+    WHERE status = 'available';
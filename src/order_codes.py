@@ -0,0 +1,25 @@
+import asyncio
+
+
+class OrderCodeAllocator:
+    """
+    Выдаёт уникальные коды заказов (InvId) из заранее зарезервированного блока.
+    В БД ходит только когда блок закончился — один nextval на INCREMENT BY заказов.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+        self.reservations = 0  # сколько раз резервировали блок (= запросов к БД)
+
+    async def allocate(self) -> int:
+        async with self._lock:
+            if self._next >= self._end:
+                start, size = await self.db.reserve_order_code_block()
+                self._next, self._end = start, start + size
+                self.reservations += 1
+            code = self._next
+            self._next += 1
+            return code
@@ -1,18 +1,12 @@
-import random
-import string
 import html
-from setup import pdb
+from setup import order_code_allocator
 
 
-def generate_order_number():
-    while True:
-        number = ''.join(random.choices(string.digits, k=5))  # Генерируем 5 случайных цифр
-
-        try:
-            if pdb.check_order_code_unique(number):  # Проверяем уникальность
-                return number
-        except Exception as e:
-            print(f"Error checking order number uniqueness: {e}")
+async def generate_order_number() -> int:
+    """
+    Возвращает новый уникальный код заказа (InvId для Robokassa).
+    """
+    return await order_code_allocator.allocate()
 
 
 def escape_user_data(user_info: str) -> str:
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+import config
+import migrate
+import telegram_https
+from invite_links import InviteLinkPool
+from setup import pdb
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(config.config_env.get('OUTBOX_BATCH_SIZE', 50))
+# Пауза, если очередь пуста
+POLL_INTERVAL = float(config.config_env.get('OUTBOX_POLL_INTERVAL', 1))
+# Сколько секунд взятое сообщение закреплено за воркером; потом его заберут снова
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 10
+MAX_BACKOFF = 600
+# Если лимит чата (группы — 20 в минуту) задержит сообщение дольше, оно откладывается,
+# а не держит всю пачку в asyncio.gather
+MAX_CHAT_WAIT = 1
+
+
+def unreachable_reason(error_code: int, description: str) -> str | None:
+    # То же, что broadcast.unreachable_reason, но по ответу Bot API, а не по исключению PTB
+    description = description.lower()
+    if error_code == 403:
+        return 'deactivated' if 'deactivated' in description else 'blocked'
+    if error_code == 400 and 'chat not found' in description:
+        return 'chat_not_found'
+    return None
+
+
+def backoff(attempts: int) -> float:
+    return min(5 * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+async def deliver(item: dict) -> bool:
+    """
+    Отправляет одно сообщение из outbox и записывает результат неудачной попытки.
+
+    :return: True, если Telegram принял сообщение.
+    """
+    outbox_id, attempts = item['outbox_id'], item['attempts']
+    wait = telegram_https.dispatcher.chat_wait_time(item['method'], item['chat_id'])
+    if wait > MAX_CHAT_WAIT:
+        await pdb.retry_outbox(outbox_id, wait, 'chat rate limit', attempted=False)
+        return False
+    try:
+        response = await telegram_https.call_api(item['method'], item['payload'])
+    except Exception as e:
+        # Сеть / таймаут — повторяем с растущей паузой
+        await pdb.retry_outbox(outbox_id, backoff(attempts), repr(e), give_up=attempts >= MAX_ATTEMPTS)
+        logger.warning(f"⚠️ outbox {outbox_id}: {e!r}, попытка {attempts}")
+        return False
+
+    if response.get('ok'):
+        return True
+
+    error_code = response.get('error_code')
+    description = response.get('description', '')
+    if error_code == 429:
+        # Лимит Telegram: ждём сколько сказали, на give_up это не влияет
+        retry_after = response.get('parameters', {}).get('retry_after', 1)
+        await pdb.retry_outbox(outbox_id, retry_after, description)
+    elif error_code in (400, 403):
+        # Повтор не поможет: бот заблокирован, сообщение уже удалено и т.п.
+        await pdb.retry_outbox(outbox_id, 0, description, give_up=True)
+        logger.error(f"❌ outbox {outbox_id} ({item['method']} → {item['chat_id']}): {description}")
+        reason = unreachable_reason(error_code, description)
+        if reason and item['chat_id'] > 0:
+            await pdb.mark_users_unreachable([(item['chat_id'], reason)])
+    else:
+        await pdb.retry_outbox(outbox_id, backoff(attempts), description, give_up=attempts >= MAX_ATTEMPTS)
+        logger.warning(f"⚠️ outbox {outbox_id}: {error_code} {description}, попытка {attempts}")
+    return False
+
+
+async def drain_once() -> int:
+    """
+    Забирает и отправляет одну пачку. В пачке не больше одного сообщения на
+    получателя, поэтому их можно отправлять параллельно без нарушения порядка.
+
+    :return: Размер обработанной пачки.
+    """
+    batch = await pdb.claim_outbox(BATCH_SIZE, LEASE_SECONDS)
+    if not batch:
+        return 0
+    results = await asyncio.gather(*(deliver(item) for item in batch))
+    sent = [item['outbox_id'] for item, ok in zip(batch, results) if ok]
+    if sent:
+        await pdb.complete_outbox(sent)
+    return len(batch)
+
+
+async def main():
+    await pdb.connect()
+    await migrate.apply_migrations(pdb)
+    await telegram_https.start('outbox')
+    # Одноразовые ссылки в каналы для оплат — создаются здесь, а не в вебхуке
+    refill_task = asyncio.create_task(InviteLinkPool(pdb).run_forever())
+    stats_task = asyncio.create_task(telegram_https.log_stats_forever())
+    logger.info("📤 Outbox-воркер запущен")
+    try:
+        while True:
+            try:
+                if await drain_once() == 0:
+                    await asyncio.sleep(POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"❗ Ошибка outbox-воркера: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        refill_task.cancel()
+        stats_task.cancel()
+        await telegram_https.close()
+        await pdb.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
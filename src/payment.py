@@ -1,4 +1,5 @@
 import config
+from catalog import catalog
 from yookassa import Configuration, Payment
 from robokassa import HashAlgorithm, Robokassa
 from robokassa.types import InvoiceType
@@ -16,10 +17,8 @@ Configuration.secret_key = config.config_env['SECRET_KEY']
 
 
 async def create_payment(price, user_id, email, num_of_chapter, order_id, order_code):
-    formatted_chapter = f'ch_{num_of_chapter}'
-    course = config.courses.get(formatted_chapter)
-    name = course['name']
-    short_name_for_receipt = course['short_name_for_receipt']
+    course = catalog.get_by_num(num_of_chapter)
+    formatted_chapter = course.key
     payment = Payment.create({
         "amount": {
             "value": str(price),  # Преобразуем цену в строку, как ожидает API
@@ -44,7 +43,7 @@ async def create_payment(price, user_id, email, num_of_chapter, order_id, order_
             },
             "items": [
                 {
-                    "description": f"{short_name_for_receipt}",
+                    "description": course.receipt_name,
                     "quantity": "1",
                     "amount": {
                         "value": str(price),  # Цена также должна быть строкой
@@ -97,22 +96,12 @@ def create_payment_robokassa(price, email, num_of_chapter, order_code, order_id,
     chapter_nums = num_of_chapter.split(',')  # Например: ['1', '2']
     formatted_chapters = [f'ch_{num}' for num in chapter_nums]
 
-    items = []
-
-    for num in chapter_nums:
-        chapter_key = f'ch_{num}'
-        course = config.courses.get(chapter_key)
-        if not course:
-            continue
-
-        items.append({
-            "Name": f"{course['short_name_for_receipt']}",
-            "Quantity": 1,
-            "Sum": course['price'],
-            "PaymentMethod": "full_prepayment",
-            "PaymentObject": "service",
-            "Tax": "none"
-        })
+    # Позиции чека собраны в каталоге заранее, здесь только копируются
+    items = [
+        dict(course.receipt_item)
+        for course in map(catalog.get_by_num, chapter_nums)
+        if course
+    ]
 
     # Описание для платёжной ссылки (не чек)
     description = f"Доступ к курсу. #n{order_code}"
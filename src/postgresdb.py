@@ -1,8 +1,12 @@
+import asyncio
 import json
-import psycopg2
-from psycopg2 import sql
-from psycopg2.extras import RealDictCursor, execute_values
+import psycopg
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 import config
+from catalog import catalog
+from entitlements import ENTITLEMENTS_CHANNEL, Entitlements, EntitlementCache
 import logging
 from datetime import datetime
 
@@ -14,16 +18,96 @@ logger = logging.getLogger(__name__)
 class Database:
     def __init__(self):
         """
-        Инициализация подключения к базе данных.
+        Инициализация параметров пула подключений к базе данных.
+        Сам пул открывается в connect() — внутри работающего event loop.
         """
-        self.conn = psycopg2.connect(
-            host=config.config_env['POSTGRES_HOST'],
-            database=config.config_env['POSTGRES_DB'],
-            user=config.config_env['POSTGRES_USER'],
-            password=config.config_env['POSTGRES_PASSWORD']
+        self.pool = None
+        self.min_size = int(config.config_env.get('POSTGRES_POOL_MIN_SIZE', 2))
+        self.max_size = int(config.config_env.get('POSTGRES_POOL_MAX_SIZE', 10))
+        # Сколько секунд ждать свободное подключение из пула
+        self.acquire_timeout = float(config.config_env.get('POSTGRES_POOL_TIMEOUT', 10))
+        # statement_timeout для каждого запроса (в миллисекундах)
+        self.query_timeout_ms = int(config.config_env.get('POSTGRES_QUERY_TIMEOUT_MS', 5000))
+        # Сколько строк за раз читают серверные курсоры (iter_* методы)
+        self.fetch_size = int(config.config_env.get('POSTGRES_FETCH_SIZE', 1000))
+        self.conn_kwargs = {
+            'host': config.config_env['POSTGRES_HOST'],
+            'dbname': config.config_env['POSTGRES_DB'],
+            'user': config.config_env['POSTGRES_USER'],
+            'password': config.config_env['POSTGRES_PASSWORD'],
+        }
+        # Кэш доступов пользователей к курсам
+        self.entitlements = EntitlementCache(
+            max_size=int(config.config_env.get('ENTITLEMENT_CACHE_SIZE', 10000)),
+            ttl=float(config.config_env.get('ENTITLEMENT_CACHE_TTL', 300))
         )
+        # Колбэки (user_id | None), которые вызываются на NOTIFY об изменении доступов
+        self.entitlement_listeners = []
+        self._listener_task = None
 
-    def user_exists(self, user_id: int) -> bool:
+    async def connect(self):
+        """
+        Открывает пул подключений. Вызывается в post_init бота и в lifespan FastAPI.
+        """
+        if self.pool is not None:
+            return
+        self.pool = AsyncConnectionPool(
+            kwargs={
+                **self.conn_kwargs,
+                'options': f'-c statement_timeout={self.query_timeout_ms}',
+            },
+            min_size=self.min_size,
+            max_size=self.max_size,
+            timeout=self.acquire_timeout,
+            open=False
+        )
+        await self.pool.open(wait=True)
+        logger.info(f"Пул подключений к БД открыт (min={self.min_size}, max={self.max_size})")
+        self._listener_task = asyncio.create_task(self._listen_entitlement_changes())
+
+    async def close(self):
+        """
+        Закрывает пул подключений.
+        """
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            self._listener_task = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def _listen_entitlement_changes(self):
+        """
+        Слушает NOTIFY об изменении доступов (в т.ч. из соседнего процесса)
+        и сбрасывает соответствующие записи кэша.
+        """
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(**self.conn_kwargs, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {ENTITLEMENTS_CHANNEL}")
+                    # Пока слушателя не было, уведомления могли потеряться
+                    self.entitlements.clear()
+                    self._notify_entitlement_listeners(None)
+                    async for notify in conn.notifies():
+                        user_id = int(notify.payload)
+                        self.entitlements.invalidate(user_id)
+                        self._notify_entitlement_listeners(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Слушатель {ENTITLEMENTS_CHANNEL} отключился: {e}")
+                self.entitlements.clear()
+                self._notify_entitlement_listeners(None)
+                await asyncio.sleep(5)
+
+    def _notify_entitlement_listeners(self, user_id: int | None):
+        for listener in self.entitlement_listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка в подписчике {ENTITLEMENTS_CHANNEL}: {e}")
+
+    async def user_exists(self, user_id: int) -> bool:
         """
         Проверяет, существует ли пользователь в таблице users по user_id.
 
@@ -31,17 +115,16 @@ class Database:
         :return: True, если пользователь существует, иначе False.
         """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
                     SELECT EXISTS(SELECT 1 FROM users WHERE user_id = %s)
                 """, (user_id,))
-                return cursor.fetchone()[0]
+                return (await cursor.fetchone())[0]
         except Exception as e:
             print(f"Ошибка при проверке существования пользователя: {e}")
-            self.conn.rollback()  # Откат транзакции в случае ошибки
             return False
 
-    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> bool:
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> bool:
         """
         Добавляет нового пользователя в таблицу users.
 
@@ -52,37 +135,34 @@ class Database:
         :return: True, если пользователь успешно добавлен, иначе False.
         """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
                     INSERT INTO users (user_id, username, first_name, last_name, created_at, updated_at)
                     VALUES (%s, %s, %s, %s, NOW(), NOW())
                 """, (user_id, username, first_name, last_name))
-                self.conn.commit()  # Подтверждение транзакции
                 return True
         except Exception as e:
             print(f"Ошибка при добавлении пользователя: {e}")
-            self.conn.rollback()  # Откат транзакции в случае ошибки
             return False
 
-    def get_user_by_user_id(self, user_id: int):
+    async def get_user_by_user_id(self, user_id: int):
         """
         Получение информации о пользователе по user_id.
         :param user_id: Telegram ID пользователя
         :return: Информация о платеже или None
         """
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
                     SELECT * FROM users WHERE user_id = %s
                 """, (user_id,))
-                return cursor.fetchone()
+                return await cursor.fetchone()
         except Exception as e:
-            self.conn.rollback()
             print(f"Error getting payment: {e}")
             return None
 
-    def add_payment(self, amount: float, income_amount: float,
-                    payment_method_type: str, order_id: int) -> bool:
+    async def add_payment(self, amount: float, income_amount: float,
+                          payment_method_type: str, order_id: int) -> bool:
         """
         Добавляет новый платёж в таблицу payments.
 
@@ -93,41 +173,146 @@ class Database:
         :return: True, если платёж успешно добавлен, иначе False.
         """
         try:
-            with self.conn.cursor() as cursor:
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                # Вместе с платежом обновляем user_courses и отправляем NOTIFY,
+                # чтобы все процессы сбросили кэш доступов
                 query = """
-                    INSERT INTO payments (
-                        amount, income_amount, 
-                        payment_method_type, order_id, created_at
-                    ) VALUES (%s, %s, %s, %s, NOW())
+                    WITH inserted AS (
+                        INSERT INTO payments (
+                            amount, income_amount, 
+                            payment_method_type, order_id, created_at
+                        ) VALUES (%s, %s, %s, %s, NOW())
+                        RETURNING order_id
+                    ), paid_order AS (
+                        SELECT o.user_id, o.course_chapter
+                        FROM inserted i
+                        JOIN orders o ON o.order_id = i.order_id
+                    ), granted AS (
+                        INSERT INTO user_courses (user_id, course_chapter, source)
+                        SELECT user_id, unnest(course_chapter), 'payment'
+                        FROM paid_order
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT user_id, pg_notify(%s, user_id::text)
+                    FROM paid_order
                 """
                 params = (
                     amount,
                     income_amount,
                     payment_method_type,
-                    order_id
+                    order_id,
+                    ENTITLEMENTS_CHANNEL
                 )
-                cursor.execute(query, params)
-                self.conn.commit()
-                return True
+                await cursor.execute(query, params)
+                row = await cursor.fetchone()
+            if row:
+                self.entitlements.invalidate(row[0])
+            return True
         except Exception as e:
             print(f"Ошибка при добавлении платежа: {e}")
-            self.conn.rollback()
             return False
 
-    def get_payment_by_order_id(self, order_id: int):
+    async def record_payment(self, order_code: int, amount: float, income_amount: float,
+                             payment_method_type: str, build_outbox=None) -> dict | None:
+        """
+        Идемпотентно записывает оплату заказа за один запрос: платёж, доступы
+        в user_courses, NOTIFY для кэша — и возвращает всё, что нужно для уведомлений.
+        Сообщения из build_outbox кладутся в outbox в той же транзакции; перед этим
+        на каждый курс заказа выдаётся одноразовая ссылка из invite_links (row['invite_links']).
+
+        :param order_code: Код заказа (из Robokassa — InvId).
+        :param amount: Сумма платежа.
+        :param income_amount: Сумма после вычета комиссии.
+        :param payment_method_type: Тип платёжного метода.
+        :param build_outbox: Функция (строка оплаты) -> список (chat_id, method, payload).
+        :return: Словарь order_id, user_id, course_chapter, payment_message_id,
+                 first_name, last_name, username — или None, если платёж
+                 по заказу уже был записан (или заказ не найден).
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                WITH paid_order AS (
+                    -- Блокировка против update_payment_message_id: сообщение со ссылкой на оплату
+                    -- удалит либо этот запрос, либо он (см. там)
+                    SELECT order_id, user_id, course_chapter, payment_message_id
+                    FROM orders
+                    WHERE order_code = %s
+                    ORDER BY order_id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                ), inserted AS (
+                    INSERT INTO payments (
+                        amount, income_amount,
+                        payment_method_type, order_id, created_at
+                    )
+                    SELECT %s, %s, %s, order_id, NOW()
+                    FROM paid_order
+                    ON CONFLICT (order_id) DO NOTHING
+                    RETURNING order_id
+                ), granted AS (
+                    INSERT INTO user_courses (user_id, course_chapter, source)
+                    SELECT po.user_id, unnest(po.course_chapter), 'payment'
+                    FROM paid_order po
+                    JOIN inserted i ON i.order_id = po.order_id
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT po.order_id, po.user_id, po.course_chapter, po.payment_message_id,
+                       u.first_name, u.last_name, u.username,
+                       pg_notify(%s, po.user_id::text) AS notified
+                FROM inserted i
+                JOIN paid_order po ON po.order_id = i.order_id
+                LEFT JOIN users u ON u.user_id = po.user_id
+            """, (order_code, amount, income_amount, payment_method_type, ENTITLEMENTS_CHANNEL))
+            row = await cursor.fetchone()
+            if row and build_outbox is not None:
+                row['invite_links'] = await self._claim_invite_links(cursor, row)
+                messages = build_outbox(row)
+                if messages:
+                    await self._insert_outbox(cursor, messages)
+        if row:
+            self.entitlements.invalidate(row['user_id'])
+        return row
+
+    async def _claim_invite_links(self, cursor, paid_order: dict) -> dict[str, str]:
+        """
+        Выдаёт по одной свободной ссылке на каждый курс заказа (в транзакции record_payment).
+
+        :return: {course_chapter: invite_link}; курсов без запаса в словаре нет.
+        """
+        await cursor.execute("""
+            WITH picked AS (
+                SELECT l.invite_link
+                FROM unnest(%s::text[]) AS c (course_chapter)
+                CROSS JOIN LATERAL (
+                    SELECT invite_link
+                    FROM invite_links
+                    WHERE course_chapter = c.course_chapter AND status = 'available'
+                    ORDER BY created_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                ) l
+            )
+            UPDATE invite_links il
+            SET status = 'issued', user_id = %s, order_id = %s, issued_at = NOW()
+            FROM picked
+            WHERE il.invite_link = picked.invite_link
+            RETURNING il.course_chapter, il.invite_link
+        """, (paid_order['course_chapter'], paid_order['user_id'], paid_order['order_id']))
+        return {row['course_chapter']: row['invite_link'] for row in await cursor.fetchall()}
+
+    async def get_payment_by_order_id(self, order_id: int):
         """
         Получение информации о платеже по order_id.
         :param order_id: Уникальный идентификатор заказа.
         :return: Словарь с данными платежа или None.
         """
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
                     SELECT * FROM payments WHERE order_id = %s
                 """, (order_id,))
-                return cursor.fetchone()  # Возвращает словарь или None, если запись не найдена
+                return await cursor.fetchone()  # Возвращает словарь или None, если запись не найдена
         except Exception as e:
-            self.conn.rollback()
             print(f"Ошибка при получении платежа по order_id {order_id}: {e}")
             return None
 
@@ -148,15 +333,15 @@ class Database:
     #         print(f"Error checking payment existence: {e}")
     #         return False
 
-    def payment_exists_by_order_code(self, order_code: int) -> bool:
+    async def payment_exists_by_order_code(self, order_code: int) -> bool:
         """
         Проверка, существует ли платеж, связанный с данным order_code (InvId).
         :param order_code: Код заказа (из Robokassa — InvId)
         :return: True, если платеж существует, иначе False
         """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
                     SELECT EXISTS(
                         SELECT 1
                         FROM payments p
@@ -164,13 +349,12 @@ class Database:
                         WHERE o.order_code = %s
                     )
                 """, (order_code,))
-                return cursor.fetchone()[0]
+                return (await cursor.fetchone())[0]
         except Exception as e:
-            self.conn.rollback()
             print(f"Error checking payment by order_code: {e}")
             return False
 
-    def get_paid_courses_by_user(self, user_id: int) -> list:
+    async def get_paid_courses_by_user(self, user_id: int) -> list:
         """
         Возвращает список курсов, которые пользователь успешно оплатил.
 
@@ -178,15 +362,14 @@ class Database:
         :return: Список названий курсов (course_chapter).
         """
         try:
-            with self.conn.cursor() as cursor:
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
                 query = """
-                    SELECT DISTINCT o.course_chapter
-                    FROM orders o
-                    JOIN payments p ON o.order_id = p.order_id
-                    WHERE o.user_id = %s
+                    SELECT course_chapter
+                    FROM user_courses
+                    WHERE user_id = %s AND source = 'payment'
                 """
-                cursor.execute(query, (user_id,))
-                result = cursor.fetchall()
+                await cursor.execute(query, (user_id,))
+                result = await cursor.fetchall()
                 return [row[0] for row in result]  # список course_chapter
         except Exception as e:
             print(f"Ошибка при получении курсов: {e}")
@@ -222,7 +405,72 @@ class Database:
     #         print(f"❌ Ошибка при получении всех доступных курсов: {e}")
     #         return []
 
-    def get_all_user_courses(self, user_id: int) -> list:
+    async def get_user_entitlements(self, user_id: int) -> Entitlements:
+        """
+        Возвращает оплаченные и выданные вручную курсы пользователя.
+        Сначала смотрит в кэш, при промахе — выборка по первичному ключу user_courses.
+
+        :param user_id: Telegram user ID
+        :return: Entitlements(paid, manual)
+        """
+        entitlements = self.entitlements.get(user_id)
+        if entitlements is not None:
+            return entitlements
+
+        # Версия до чтения: NOTIFY, пришедший во время SELECT, не даст закэшировать устаревшее
+        version = self.entitlements.version()
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT course_chapter, source
+                FROM user_courses
+                WHERE user_id = %s
+            """, (user_id,))
+            rows = await cursor.fetchall()
+
+        entitlements = Entitlements(
+            paid=frozenset(chapter for chapter, source in rows if source == 'payment'),
+            manual=frozenset(chapter for chapter, source in rows if source == 'manual')
+        )
+        self.entitlements.set(user_id, entitlements, version)
+        return entitlements
+
+    async def get_users_entitlements(self, user_ids: list[int]) -> dict[int, Entitlements]:
+        """
+        То же, что get_user_entitlements, но для многих пользователей сразу:
+        промахи кэша добираются одним запросом.
+
+        :return: {user_id: Entitlements(paid, manual)} для каждого из user_ids.
+        """
+        result = {}
+        missing = []
+        for user_id in set(user_ids):
+            entitlements = self.entitlements.get(user_id)
+            if entitlements is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = entitlements
+        if not missing:
+            return result
+
+        version = self.entitlements.version()
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT user_id, course_chapter, source
+                FROM user_courses
+                WHERE user_id = ANY(%s)
+            """, (missing,))
+            rows = await cursor.fetchall()
+
+        courses = {user_id: ([], []) for user_id in missing}
+        for user_id, chapter, source in rows:
+            courses[user_id][0 if source == 'payment' else 1].append(chapter)
+        for user_id, (paid, manual) in courses.items():
+            entitlements = Entitlements(paid=frozenset(paid), manual=frozenset(manual))
+            self.entitlements.set(user_id, entitlements, version)
+            result[user_id] = entitlements
+        return result
+
+    async def get_all_user_courses(self, user_id: int) -> list:
         """
         Возвращает список всех курсов, к которым у пользователя есть доступ:
         - оплаченные (в orders)
@@ -232,22 +480,7 @@ class Database:
         :return: список course_chapter
         """
         try:
-            with self.conn.cursor() as cursor:
-                query = """
-                    SELECT DISTINCT unnest(course_chapter) AS chapter FROM (
-                        SELECT o.course_chapter
-                        FROM orders o
-                        JOIN payments p ON o.order_id = p.order_id
-                        WHERE o.user_id = %s
-                        UNION ALL
-                        SELECT ARRAY[ma.course_chapter]  -- manual_access.course_chapter — строка
-                        FROM manual_access ma
-                        WHERE ma.user_id = %s
-                    ) AS combined
-                """
-                cursor.execute(query, (user_id, user_id))
-                result = cursor.fetchall()
-                return [row[0] for row in result]
+            return list((await self.get_user_entitlements(user_id)).all)
         except Exception as e:
             print(f"❌ Ошибка при получении всех доступных курсов: {e}")
             return []
@@ -277,40 +510,25 @@ class Database:
     #         print(f"Ошибка при проверке оплаты курса: {e}")
     #         return False
 
-    def get_not_bought_courses(self, user_id: int) -> list:
+    async def get_not_bought_courses(self, user_id: int) -> list:
         """
         Возвращает список курсов, которые пользователь еще не купил.
 
         :param user_id: Telegram user ID
-        :return: список course_chapter, которые доступны в config.courses, но не куплены
+        :return: список course_chapter, которые есть в каталоге, но не куплены
         """
         try:
-            with self.conn.cursor() as cursor:
-                # Получаем уже купленные курсы
-                query = """
-                    SELECT DISTINCT unnest(course_chapter) AS chapter FROM (
-                        SELECT o.course_chapter
-                        FROM orders o
-                        JOIN payments p ON o.order_id = p.order_id
-                        WHERE o.user_id = %s
-                        UNION ALL
-                        SELECT ARRAY[ma.course_chapter]
-                        FROM manual_access ma
-                        WHERE ma.user_id = %s
-                    ) AS combined
-                """
-                cursor.execute(query, (user_id, user_id))
-                bought_courses = {row[0] for row in cursor.fetchall()}
+            bought_courses = (await self.get_user_entitlements(user_id)).all
 
-                # Вычитаем из всех возможных курсов
-                all_courses = set(config.courses.keys())
-                not_bought = list(all_courses - bought_courses)
-                return not_bought
+            # Вычитаем из всех возможных курсов
+            all_courses = set(catalog.keys())
+            not_bought = list(all_courses - bought_courses)
+            return not_bought
         except Exception as e:
             print(f"❌ Ошибка при получении некупленных курсов: {e}")
             return []
 
-    def has_paid_course(self, user_id: int, course_chapter: str) -> bool:
+    async def has_paid_course(self, user_id: int, course_chapter: str) -> bool:
         """
         Проверяет, оплатил ли пользователь указанный курс.
 
@@ -319,18 +537,7 @@ class Database:
         :return: True, если оплата есть, иначе False.
         """
         try:
-            with self.conn.cursor() as cursor:
-                query = """
-                    SELECT EXISTS (
-                        SELECT 1
-                        FROM orders o
-                        JOIN payments p ON o.order_id = p.order_id
-                        WHERE o.user_id = %s AND %s = ANY(o.course_chapter)
-                    )
-                """
-                cursor.execute(query, (user_id, course_chapter))
-                result = cursor.fetchone()
-                return result[0]  # True или False
+            return course_chapter in (await self.get_user_entitlements(user_id)).paid
         except Exception as e:
             print(f"Ошибка при проверке оплаты курса: {e}")
             return False
@@ -356,111 +563,94 @@ class Database:
     #         self.conn.rollback()
     #         raise
 
-    def create_order(self, user_id: int, course_chapter: list[str], order_code: int) -> int:
+    async def create_order(self, user_id: int, course_chapter: list[str], order_code: int,
+                           email: str = None, agreed_offer_at: datetime = None,
+                           agreed_privacy_at: datetime = None, agreed_newsletter: bool = None,
+                           agreed_newsletter_at: datetime = None) -> int:
         """
         Создает заказ в таблице orders и возвращает order_id.
-        Email будет добавлен позже.
+        Вызывается, когда покупатель ввёл e-mail, — сразу со всеми согласиями.
 
         :param user_id: Telegram user ID
         :param course_chapter: Список курсов, например: ['ch1', 'ch3']
         :param order_code: Уникальный код заказа
+        :param email: E-mail для чека
+        :param agreed_offer_at: Когда принята оферта (None — не принята)
+        :param agreed_privacy_at: Когда дано согласие на обработку ПДн (None — не дано)
+        :param agreed_newsletter: Согласие на рассылку
+        :param agreed_newsletter_at: Когда дан ответ про рассылку
         :return: order_id
         """
         try:
-            with self.conn.cursor() as cursor:
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
                 query = """
-                    INSERT INTO orders (user_id, course_chapter, order_code)
-                    VALUES (%s, %s, %s)
+                    INSERT INTO orders (
+                        user_id, course_chapter, order_code, email,
+                        agreed_offer, agreed_offer_at,
+                        agreed_privacy, agreed_privacy_at,
+                        agreed_newsletter, agreed_newsletter_at
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                     RETURNING order_id;
                 """
-                cursor.execute(query, (user_id, course_chapter, order_code))
-                order_id = cursor.fetchone()[0]
-                self.conn.commit()
+                await cursor.execute(query, (
+                    user_id, course_chapter, order_code, email,
+                    agreed_offer_at is not None, agreed_offer_at,
+                    agreed_privacy_at is not None, agreed_privacy_at,
+                    agreed_newsletter, agreed_newsletter_at
+                ))
+                order_id = (await cursor.fetchone())[0]
                 return order_id
         except Exception as e:
             print(f"❌ Ошибка при создании заказа: {e}")
-            self.conn.rollback()
             raise
 
-    def update_email(self, order_code: int, email: str):
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE orders
-                    SET email = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE order_code = %s
-                """, (email, order_code))
-                self.conn.commit()
-        except Exception as e:
-            print(f"❌ Ошибка при обновлении email: {e}")
-            self.conn.rollback()
-            raise
-
-    def update_agreed_offer(self, order_code: int, value: bool):
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE orders
-                    SET agreed_offer = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE order_code = %s
-                """, (value, order_code))
-                self.conn.commit()
-        except Exception as e:
-            print(f"❌ Ошибка при обновлении agreed_offer: {e}")
-            self.conn.rollback()
-            raise
-
-    def update_agreed_privacy(self, order_code: int, value: bool):
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE orders
-                    SET agreed_privacy = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE order_code = %s
-                """, (value, order_code))
-                self.conn.commit()
-        except Exception as e:
-            print(f"❌ Ошибка при обновлении agreed_privacy: {e}")
-            self.conn.rollback()
-            raise
-
-    def update_agreed_newsletter(self, order_code: int, value: bool):
+    async def update_payment_message_id(self, order_code: int, message_id: int):
+        """
+        Запоминает сообщение со ссылкой на оплату. Если заказ успели оплатить, пока сообщение
+        отправлялось, record_payment его id не видел — тогда удаление кладётся в outbox здесь же.
+        Строка заказа блокируется так же, как в record_payment, поэтому удалит кто-то один.
+        """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE orders
-                    SET agreed_newsletter = %s, updated_at = CURRENT_TIMESTAMP
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT order_id, user_id
+                    FROM orders
                     WHERE order_code = %s
-                """, (value, order_code))
-                self.conn.commit()
-        except Exception as e:
-            print(f"❌ Ошибка при обновлении agreed_newsletter: {e}")
-            self.conn.rollback()
-            raise
-
-    def update_payment_message_id(self, order_code: int, message_id: int):
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+                    ORDER BY order_id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                """, (order_code,))
+                order = await cursor.fetchone()
+                await cursor.execute("""
                     UPDATE orders
                     SET payment_message_id = %s, updated_at = CURRENT_TIMESTAMP
                     WHERE order_code = %s
                 """, (message_id, order_code))
-                self.conn.commit()
+                if order is None:
+                    return
+                # Отдельный запрос уже после блокировки — видит оплату, закоммиченную до неё
+                await cursor.execute("""
+                    SELECT EXISTS (SELECT 1 FROM payments WHERE order_id = %s)
+                """, (order[0],))
+                if (await cursor.fetchone())[0]:
+                    user_id = order[1]
+                    await self._insert_outbox(cursor, [(user_id, 'deleteMessage', {
+                        'chat_id': user_id,
+                        'message_id': message_id
+                    })])
         except Exception as e:
             print(f"❌ Ошибка при обновлении payment_message_id: {e}")
-            self.conn.rollback()
             raise
 
-    def get_payment_message_id(self, order_id: int) -> int | None:
+    async def get_payment_message_id(self, order_id: int) -> int | None:
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
                     SELECT payment_message_id
                     FROM orders
                     WHERE order_id = %s
                 """, (order_id,))
-                result = cursor.fetchone()
+                result = await cursor.fetchone()
                 if result:
                     return result[0]  # может быть None, если не задан
                 return None
@@ -468,58 +658,57 @@ class Database:
             print(f"❌ Ошибка при получении payment_message_id: {e}")
             raise
 
-    def check_order_code_unique(self, order_code: int) -> bool:
+    async def reserve_order_code_block(self) -> tuple[int, int]:
         """
-        Проверяет, существует ли order_code в таблице orders.
-        :param order_code: Номер заказа, который нужно проверить
-        :return: True, если код уникален, иначе False
+        Резервирует блок кодов заказов из последовательности order_code_seq.
+
+        :return: (первый код блока, размер блока)
         """
-        try:
-            with self.conn.cursor() as cursor:
-                query = """
-                    SELECT COUNT(*)
-                    FROM orders
-                    WHERE order_code = %s
-                """
-                cursor.execute(query, (order_code,))
-                count = cursor.fetchone()[0]
-                return count == 0  # True, если код не найден
-        except Exception as e:
-            print(f"Error checking order code uniqueness: {e}")
-            return False  # В случае ошибки считаем код не уникальным
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT nextval('order_code_seq'), increment_by
+                FROM pg_sequences
+                WHERE schemaname = current_schema() AND sequencename = 'order_code_seq'
+            """)
+            start, size = await cursor.fetchone()
+            return start, size
 
-    def get_order_by_code(self, order_code: int):
+    async def get_order_by_code(self, order_code: int):
         """
         Получение информации о заказе по order_id.
         :param order_code: Уникальный код заказа.
         :return: Словарь с данными заказа или None.
         """
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
                     SELECT * FROM orders WHERE order_code = %s
                 """, (order_code,))
-                return cursor.fetchone()
+                return await cursor.fetchone()
         except Exception as e:
-            self.conn.rollback()
             print(f"Error getting order: {e}")
             return None
 
-    def grant_manual_access(self, user_id: int, course_chapter: str, granted_by: int):
+    async def grant_manual_access(self, user_id: int, course_chapter: str, granted_by: int):
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
                     INSERT INTO manual_access (user_id, course_chapter, granted_by)
                     VALUES (%s, %s, %s)
                     ON CONFLICT (user_id, course_chapter) DO NOTHING
                 """, (user_id, course_chapter, granted_by))
-                self.conn.commit()
+                await cursor.execute("""
+                    INSERT INTO user_courses (user_id, course_chapter, source)
+                    VALUES (%s, %s, 'manual')
+                    ON CONFLICT DO NOTHING
+                """, (user_id, course_chapter))
+                await cursor.execute("SELECT pg_notify(%s, %s)", (ENTITLEMENTS_CHANNEL, str(user_id)))
+            self.entitlements.invalidate(user_id)
         except Exception as e:
             print(f"❌ Ошибка при добавлении доступа в manual_access: {e}")
-            self.conn.rollback()
             raise
 
-    def has_manual_access(self, user_id: int, course_chapter: str) -> bool:
+    async def has_manual_access(self, user_id: int, course_chapter: str) -> bool:
         """
         Проверяет, был ли пользователю вручную выдан доступ к курсу.
 
@@ -528,49 +717,509 @@ class Database:
         :return: True, если доступ есть, иначе False.
         """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT EXISTS (
-                        SELECT 1 FROM manual_access
-                        WHERE user_id = %s AND course_chapter = %s
-                    )
-                """, (user_id, course_chapter))
-                return cursor.fetchone()[0]
+            return course_chapter in (await self.get_user_entitlements(user_id)).manual
         except Exception as e:
             print(f"❌ Ошибка при проверке ручного доступа: {e}")
             return False
 
-    def get_users_without_course_and_newsletter_decline(self) -> list[int]:
+    async def backfill_user_courses(self) -> int:
+        """
+        Заполняет user_courses по уже существующим оплатам и ручным доступам.
+        Повторный запуск безопасен.
+
+        :return: количество добавленных строк
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            # Полный проход по оплатам дольше обычного statement_timeout пула
+            await cursor.execute("SET LOCAL statement_timeout = 0")
+            await cursor.execute("""
+                INSERT INTO user_courses (user_id, course_chapter, source, created_at)
+                SELECT o.user_id, unnest(o.course_chapter), 'payment', p.created_at
+                FROM orders o
+                JOIN payments p ON o.order_id = p.order_id
+                UNION ALL
+                SELECT ma.user_id, ma.course_chapter, 'manual', NOW()
+                FROM manual_access ma
+                ON CONFLICT DO NOTHING
+            """)
+            inserted = cursor.rowcount
+        self.entitlements.clear()
+        return inserted
+
+    async def _insert_outbox(self, cursor, messages: list[tuple[int, str, dict]]):
+        """
+        Кладёт сообщения в outbox в текущей транзакции.
+
+        :param cursor: Курсор открытой транзакции.
+        :param messages: Список (chat_id, method, payload).
+        """
+        await cursor.executemany("""
+            INSERT INTO outbox (chat_id, method, payload)
+            VALUES (%s, %s, %s)
+        """, [(chat_id, method, Jsonb(payload)) for chat_id, method, payload in messages])
+
+    async def add_outbox(self, messages: list[tuple[int, str, dict]]):
         """
-        Возвращает список user_id, которые:
-        - не покупали курс 'ch_1'
-        - не имеют заказов с agreed_newsletter = false
+        Кладёт сообщения в outbox отдельной транзакцией (уведомления в админский чат из бота).
 
-        :return: список Telegram user_id
+        :param messages: Список (chat_id, method, payload).
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await self._insert_outbox(cursor, messages)
+
+    async def claim_outbox(self, limit: int, lease_seconds: int) -> list[dict]:
+        """
+        Забирает пачку сообщений к отправке. Для каждого получателя — только самое
+        раннее неотправленное, чтобы сохранить порядок. Взятые сообщения откладываются
+        на lease_seconds: если воркер упадёт, они вернутся в очередь сами.
+
+        :param limit: Размер пачки.
+        :param lease_seconds: На сколько секунд сообщение закрепляется за воркером.
+        :return: Список словарей outbox_id, chat_id, method, payload, attempts.
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                UPDATE outbox
+                SET next_attempt_at = NOW() + make_interval(secs => %s),
+                    attempts = attempts + 1
+                WHERE outbox_id IN (
+                    SELECT o.outbox_id
+                    FROM outbox o
+                    WHERE o.status = 'pending'
+                      AND o.next_attempt_at <= NOW()
+                      AND NOT EXISTS (
+                          SELECT 1
+                          FROM outbox earlier
+                          WHERE earlier.chat_id = o.chat_id
+                            AND earlier.status = 'pending'
+                            AND earlier.outbox_id < o.outbox_id
+                      )
+                    ORDER BY o.next_attempt_at, o.outbox_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING outbox_id, chat_id, method, payload, attempts
+            """, (lease_seconds, limit))
+            return await cursor.fetchall()
+
+    async def complete_outbox(self, outbox_ids: list[int]):
+        """
+        Отмечает сообщения outbox как доставленные.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE outbox
+                SET status = 'sent', sent_at = NOW(), last_error = NULL
+                WHERE outbox_id = ANY(%s)
+            """, (outbox_ids,))
+
+    async def retry_outbox(self, outbox_id: int, delay_seconds: float, error: str, give_up: bool = False,
+                           attempted: bool = True):
+        """
+        Откладывает сообщение outbox после неудачной попытки (или помечает failed).
+
+        :param outbox_id: ID сообщения.
+        :param delay_seconds: Через сколько секунд повторить.
+        :param error: Текст ошибки.
+        :param give_up: Больше не пытаться.
+        :param attempted: False — сообщение не отправлялось (отложено до лимита), попытка не засчитывается.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE outbox
+                SET status = CASE WHEN %s THEN 'failed' ELSE 'pending' END,
+                    next_attempt_at = NOW() + make_interval(secs => %s),
+                    last_error = %s,
+                    attempts = attempts - CASE WHEN %s THEN 0 ELSE 1 END
+                WHERE outbox_id = %s
+            """, (give_up, delay_seconds, error, attempted, outbox_id))
+
+    async def get_media_file(self, name: str, kind: str) -> dict | None:
+        """
+        Сохранённый file_id файла из media/.
+
+        :param name: Имя файла.
+        :param kind: Тип отправки (photo, video_note, ...).
+        :return: Словарь sha256, file_id или None.
         """
         try:
-            with self.conn.cursor() as cursor:
-                query = """
-                    SELECT u.user_id
-                    FROM users u
-                    WHERE NOT EXISTS (  -- не покупал ch_1
-                        SELECT 1
-                        FROM orders o
-                        JOIN payments p ON p.order_id = o.order_id
-                        WHERE o.user_id = u.user_id
-                          AND 'ch_1' = ANY (o.course_chapter)
-                    )
-                    AND NOT EXISTS (  -- нет ОПЛАЧЕННЫХ заказов с отказом от рассылки
-                        SELECT 1
-                        FROM orders o
-                        WHERE o.user_id = u.user_id
-                          AND o.agreed_newsletter = FALSE
-                          AND o.payment_message_id IS NOT NULL
-                    );
-                """
-                cursor.execute(query)
-                rows = cursor.fetchall()
-                return [row[0] for row in rows]
+            async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                    SELECT sha256, file_id FROM media_files WHERE name = %s AND kind = %s
+                """, (name, kind))
+                return await cursor.fetchone()
         except Exception as e:
-            print(f"❌ Ошибка при получении списка user_id: {e}")
-            return []
\ No newline at end of file
+            print(f"Ошибка при получении file_id для {name}: {e}")
+            return None
+
+    async def save_media_file(self, name: str, kind: str, sha256: str, file_id: str):
+        """
+        Сохраняет file_id загруженного файла (заменяет прежний, если файл поменялся).
+        """
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
+                    INSERT INTO media_files (name, kind, sha256, file_id)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (name, kind) DO UPDATE
+                    SET sha256 = EXCLUDED.sha256, file_id = EXCLUDED.file_id, updated_at = NOW()
+                """, (name, kind, sha256, file_id))
+        except Exception as e:
+            print(f"Ошибка при сохранении file_id для {name}: {e}")
+
+    async def create_broadcast_job(self, name: str, message: dict, recipients,
+                                   created_by: int, rate: float = None, quiet_hours: tuple = None,
+                                   campaign_id: int = None) -> int:
+        """
+        Создаёт задание рассылки и записывает получателей одним COPY.
+
+        :param name: Название (например, ключ шаблона).
+        :param message: Что отправлять (см. broadcast.make_sender).
+        :param recipients: user_id получателей (список или генератор — читается один раз).
+        :param created_by: Кто запустил.
+        :param rate: Потолок скорости, msg/s (None — вся доля broadcast).
+        :param quiet_hours: (начало, конец) — datetime.time по Москве, когда не отправлять.
+        :param campaign_id: Кампания, из которой создано задание.
+        :return: job_id
+        """
+        quiet_start, quiet_end = quiet_hours or (None, None)
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO broadcast_jobs (name, message, created_by, rate, quiet_start, quiet_end, campaign_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING job_id
+            """, (name, Jsonb(message), created_by, rate, quiet_start, quiet_end, campaign_id))
+            job_id = (await cursor.fetchone())[0]
+            async with cursor.copy("COPY broadcast_deliveries (job_id, user_id) FROM STDIN") as copy:
+                for user_id in recipients:
+                    await copy.write_row((job_id, user_id))
+            return job_id
+
+    async def get_broadcast_job(self, job_id: int) -> dict | None:
+        """
+        Задание рассылки со счётчиками доставки (pending, sent, failed).
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT j.job_id, j.name, j.message, j.status, j.created_by, j.created_at, j.rate,
+                       c.pending, c.sent, c.failed
+                FROM broadcast_jobs j
+                CROSS JOIN LATERAL (
+                    SELECT COUNT(*) FILTER (WHERE d.status = 'pending') AS pending,
+                           COUNT(*) FILTER (WHERE d.status = 'sent') AS sent,
+                           COUNT(*) FILTER (WHERE d.status = 'failed') AS failed
+                    FROM broadcast_deliveries d
+                    WHERE d.job_id = j.job_id
+                ) c
+                WHERE j.job_id = %s
+            """, (job_id,))
+            return await cursor.fetchone()
+
+    async def get_broadcast_jobs(self, statuses: list[str]) -> list[dict]:
+        """
+        Задания рассылок в указанных статусах со счётчиками доставки.
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT j.job_id, j.name, j.status, j.created_by, j.created_at,
+                       c.pending, c.sent, c.failed
+                FROM broadcast_jobs j
+                CROSS JOIN LATERAL (
+                    SELECT COUNT(*) FILTER (WHERE d.status = 'pending') AS pending,
+                           COUNT(*) FILTER (WHERE d.status = 'sent') AS sent,
+                           COUNT(*) FILTER (WHERE d.status = 'failed') AS failed
+                    FROM broadcast_deliveries d
+                    WHERE d.job_id = j.job_id
+                ) c
+                WHERE j.status = ANY(%s)
+                ORDER BY j.job_id
+            """, (statuses,))
+            return await cursor.fetchall()
+
+    async def get_sendable_broadcast_job_ids(self) -> list[int]:
+        """
+        Номера заданий в статусе running, у которых сейчас не тихие часы, — без подсчёта
+        доставок, для частой сверки в воркере рассылок.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT j.job_id
+                FROM broadcast_jobs j
+                CROSS JOIN LATERAL (SELECT (NOW() AT TIME ZONE 'Europe/Moscow')::time AS now) t
+                WHERE j.status = 'running'
+                  AND NOT COALESCE(
+                      CASE WHEN j.quiet_start <= j.quiet_end
+                           THEN t.now >= j.quiet_start AND t.now < j.quiet_end
+                           -- Тихие часы через полночь, например 22:00–09:00
+                           ELSE t.now >= j.quiet_start OR t.now < j.quiet_end
+                      END, FALSE)
+                ORDER BY j.job_id
+            """)
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def set_broadcast_job_status(self, job_id: int, status: str, from_statuses: list[str]) -> bool:
+        """
+        Переводит задание в новый статус, если сейчас оно в одном из from_statuses.
+
+        :return: True, если статус изменился.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE broadcast_jobs
+                SET status = %s,
+                    updated_at = NOW(),
+                    finished_at = CASE WHEN %s IN ('done', 'cancelled') THEN NOW() END
+                WHERE job_id = %s AND status = ANY(%s)
+            """, (status, status, job_id, from_statuses))
+            return cursor.rowcount > 0
+
+    async def iter_pending_broadcast_recipients(self, job_id: int, fetch_size: int = None):
+        """
+        Ещё не обработанные получатели задания рассылки — страницами по fetch_size
+        (keyset по user_id). Каждая страница — короткий запрос: подключение и транзакция
+        не держатся часами, пока идёт рассылка, и не мешают vacuum.
+
+        :return: асинхронный генератор user_id
+        """
+        fetch_size = fetch_size or self.fetch_size
+        last_user_id = 0
+        while True:
+            async with self.pool.connection() as conn, conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT user_id
+                    FROM broadcast_deliveries
+                    WHERE job_id = %s AND status = 'pending' AND user_id > %s
+                    ORDER BY user_id
+                    LIMIT %s
+                """, (job_id, last_user_id, fetch_size))
+                rows = await cursor.fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < fetch_size:
+                return
+            last_user_id = rows[-1][0]
+
+    async def record_broadcast_deliveries(self, job_id: int, sent: list[int], failed: list[tuple[int, str]]):
+        """
+        Записывает результаты пачки отправок одним UPDATE.
+
+        :param sent: user_id, которым сообщение доставлено.
+        :param failed: (user_id, текст ошибки) — не доставлено окончательно.
+        """
+        user_ids = sent + [user_id for user_id, _ in failed]
+        statuses = ['sent'] * len(sent) + ['failed'] * len(failed)
+        errors = [None] * len(sent) + [error for _, error in failed]
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE broadcast_deliveries d
+                SET status = r.status, error = r.error, updated_at = NOW()
+                FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS r (user_id, status, error)
+                WHERE d.job_id = %s AND d.user_id = r.user_id
+            """, (user_ids, statuses, errors, job_id))
+
+    async def mark_users_unreachable(self, users: list[tuple[int, str]]):
+        """
+        Отмечает пользователей недоступными (Forbidden, chat not found).
+
+        :param users: Список (user_id, причина: blocked / deactivated / chat_not_found).
+        """
+        if not users:
+            return
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE users u
+                SET unreachable_at = NOW(), unreachable_reason = r.reason
+                FROM unnest(%s::bigint[], %s::text[]) AS r (user_id, reason)
+                WHERE u.user_id = r.user_id
+            """, ([user_id for user_id, _ in users], [reason for _, reason in users]))
+
+    async def mark_users_reachable(self, user_ids: list[int]):
+        """
+        Снимает отметку недоступности (пользователь разблокировал бота или написал сам).
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE users
+                SET unreachable_at = NULL, unreachable_reason = NULL
+                WHERE user_id = ANY(%s) AND unreachable_at IS NOT NULL
+            """, (user_ids,))
+
+    async def get_unreachable_users_to_probe(self, older_than_hours: int, limit: int) -> list[int]:
+        """
+        Недоступные пользователи для повторной проверки — сначала самые давние.
+        Удалённые аккаунты не проверяются: они не возвращаются.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT user_id
+                FROM users
+                WHERE unreachable_at IS NOT NULL
+                  AND unreachable_at < NOW() - make_interval(hours => %s)
+                  AND unreachable_reason <> 'deactivated'
+                ORDER BY unreachable_at
+                LIMIT %s
+            """, (older_than_hours, limit))
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def get_segment_users(self) -> tuple[datetime, list[dict]]:
+        """
+        Все пользователи в порядке регистрации — основа для segments.Segments.
+
+        :return: (момент выборки по часам БД — в той же шкале, что users.created_at;
+                  список словарей user_id, created_at, unreachable)
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("SELECT LOCALTIMESTAMP AS loaded_through")
+            loaded_through = (await cursor.fetchone())['loaded_through']
+            await cursor.execute("""
+                SELECT user_id, created_at, unreachable_at IS NOT NULL AS unreachable
+                FROM users
+                ORDER BY created_at, user_id
+            """)
+            return loaded_through, await cursor.fetchall()
+
+    async def get_segment_courses(self) -> list[tuple[int, str]]:
+        """
+        Все доступы к курсам (оплаченные и ручные): список (user_id, course_chapter).
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT DISTINCT user_id, course_chapter
+                FROM user_courses
+            """)
+            return await cursor.fetchall()
+
+    async def get_newsletter_declined_users(self) -> list[int]:
+        """
+        Пользователи, отказавшиеся от рассылки в заказе, дошедшем до оплаты.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT DISTINCT user_id
+                FROM orders
+                WHERE agreed_newsletter = FALSE AND payment_message_id IS NOT NULL
+            """)
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def create_campaign(self, template: str, message: dict, segment: dict, send_at: datetime,
+                              drip_after_hours: int = None, spread_minutes: int = 0,
+                              quiet_hours: tuple = None, created_by: int = None) -> int:
+        """
+        Планирует рассылку.
+
+        :param template: Ключ текста из config/mailling.yml.
+        :param message: kind, media, reply_markup (см. broadcast.make_sender), без текста.
+        :param segment: Аргументы Segments.select (owns, not_owns).
+        :param send_at: Когда запустить (aware datetime).
+        :param drip_after_hours: Для drip-кампании — через сколько часов после регистрации
+                                 отправлять; охватываются только пользователи, зарегистрированные позже.
+        :param spread_minutes: На сколько минут растянуть отправку.
+        :param quiet_hours: (начало, конец) — datetime.time по Москве, когда не отправлять.
+        :param created_by: Кто запланировал (ему придёт отчёт).
+        :return: campaign_id
+        """
+        quiet_start, quiet_end = quiet_hours or (None, None)
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO campaigns (template, message, segment, send_at, drip_after, registered_until,
+                                       spread_minutes, quiet_start, quiet_end, created_by)
+                VALUES (%s, %s, %s, %s, make_interval(hours => %s), LOCALTIMESTAMP - make_interval(hours => %s),
+                        %s, %s, %s, %s)
+                RETURNING campaign_id
+            """, (template, Jsonb(message), Jsonb(segment), send_at, drip_after_hours, drip_after_hours,
+                  spread_minutes, quiet_start, quiet_end, created_by))
+            return (await cursor.fetchone())[0]
+
+    async def claim_due_campaigns(self, drip_interval_minutes: int) -> list[dict]:
+        """
+        Забирает кампании, которым пора запускаться. Разовые переходят в started,
+        у drip сдвигаются send_at (на drip_interval_minutes) и граница охваченных регистраций.
+
+        :return: Кампании; registered_after / registered_until — окно регистраций для drip.
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                WITH due AS (
+                    SELECT campaign_id, registered_until AS registered_after
+                    FROM campaigns
+                    WHERE status = 'scheduled' AND send_at <= NOW()
+                    ORDER BY send_at
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE campaigns c
+                SET status = CASE WHEN c.drip_after IS NULL THEN 'started' ELSE c.status END,
+                    send_at = CASE WHEN c.drip_after IS NULL THEN c.send_at
+                                   ELSE NOW() + make_interval(mins => %s) END,
+                    registered_until = LOCALTIMESTAMP - c.drip_after
+                FROM due
+                WHERE c.campaign_id = due.campaign_id
+                RETURNING c.campaign_id, c.template, c.message, c.segment, c.drip_after, c.spread_minutes,
+                          c.quiet_start, c.quiet_end, c.created_by, due.registered_after, c.registered_until
+            """, (drip_interval_minutes,))
+            return await cursor.fetchall()
+
+    async def get_campaigns(self, statuses: list[str]) -> list[dict]:
+        """
+        Кампании в указанных статусах.
+        """
+        async with self.pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT campaign_id, template, segment, send_at, drip_after, spread_minutes,
+                       quiet_start, quiet_end, status
+                FROM campaigns
+                WHERE status = ANY(%s)
+                ORDER BY send_at
+            """, (statuses,))
+            return await cursor.fetchall()
+
+    async def set_campaign_status(self, campaign_id: int, status: str, from_statuses: list[str]) -> bool:
+        """
+        Переводит кампанию в новый статус, если сейчас она в одном из from_statuses.
+
+        :return: True, если статус изменился.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE campaigns SET status = %s
+                WHERE campaign_id = %s AND status = ANY(%s)
+            """, (status, campaign_id, from_statuses))
+            return cursor.rowcount > 0
+
+    async def release_campaign_window(self, campaign_id: int, registered_after, registered_until) -> bool:
+        """
+        Возвращает границу охваченных регистраций drip-кампании, забранную claim_due_campaigns,
+        если запуск не удался: следующий запуск снова охватит это окно.
+
+        :param registered_until: Граница, выставленная при claim; если её уже сдвинули, ничего не меняется.
+        :return: True, если граница возвращена.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                UPDATE campaigns SET registered_until = %s
+                WHERE campaign_id = %s AND registered_until = %s
+            """, (registered_after, campaign_id, registered_until))
+            return cursor.rowcount > 0
+
+    async def get_invite_link_stock(self) -> dict[str, int]:
+        """
+        Сколько свободных одноразовых ссылок осталось по каждому курсу.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT course_chapter, COUNT(*)
+                FROM invite_links
+                WHERE status = 'available'
+                GROUP BY course_chapter
+            """)
+            return dict(await cursor.fetchall())
+
+    async def save_invite_links(self, course_chapter: str, channel_id: int, invite_links: list[str]):
+        """
+        Добавляет созданные ссылки в запас.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO invite_links (invite_link, course_chapter, channel_id)
+                SELECT link, %s, %s FROM unnest(%s::text[]) AS link
+                ON CONFLICT DO NOTHING
+            """, (course_chapter, channel_id, invite_links))
@@ -0,0 +1,160 @@
+import inspect
+import logging
+
+from telegram import Update
+from telegram.ext import CallbackContext, CallbackQueryHandler
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Версия формата callback_data: "1" + код действия + ":арг" на каждый аргумент, например 1ch:2:my_courses
+VERSION = '1'
+SEP = ':'
+# Ограничение Bot API на callback_data, байт
+MAX_CALLBACK_DATA = 64
+
+# Коды действий
+MAIN_MENU = 'mm'
+BUY_COURSES = 'bc'
+BUY_CHAPTER = 'ch'            # номер раздела, откуда открыт
+PAY_CHAPTER = 'pc'            # номер раздела
+BUY_MULTIPLY = 'bm'
+MULTI_BUY_CHAPTER = 'mc'      # номер раздела, откуда открыт
+CONFIRM_MULTI_BUY = 'cm'
+CLEAR_MULTI_BUY = 'cl'
+ALL_COURSES = 'ac'
+MY_COURSES = 'my'
+DOCUMENTS = 'dc'
+SUPPORT = 'sp'
+GO_BACK = 'gb'                # откуда открыт
+AGREE_OFFER = 'ao'            # токен оформления
+AGREE_PRIVACY = 'ap'          # токен оформления
+AGREE_NEWSLETTER = 'an'       # токен оформления, 1 — согласен / 0 — нет
+CANCEL = 'cx'
+UPD_PAYMENT_URL = 'pu'        # номер заказа
+GRANT_ACCESS = 'ga'           # user_id, ключ раздела
+DENY_ACCESS = 'da'            # user_id, ключ раздела
+
+# Старые callback_data (уже отправленные сообщения, рассылки в очереди, кнопки из bot_buttons.yml):
+# первая часть до ":" -> (код действия, аргументы, дописываемые после разобранных)
+LEGACY = {
+    'main_menu': (MAIN_MENU, ()),
+    'buy_courses': (BUY_COURSES, ()),
+    'buy_chapter': (BUY_CHAPTER, ()),
+    'pay_chapter': (PAY_CHAPTER, ()),
+    'buy_multiply': (BUY_MULTIPLY, ()),
+    'multi_buy_chapter': (MULTI_BUY_CHAPTER, ()),
+    'confirm_buy_multiply': (CONFIRM_MULTI_BUY, ()),
+    'clear_buy_multiply': (CLEAR_MULTI_BUY, ()),
+    'go_back_buy_multiply': (ALL_COURSES, ()),
+    'all_courses': (ALL_COURSES, ()),
+    'my_courses': (MY_COURSES, ()),
+    'documents': (DOCUMENTS, ()),
+    'support': (SUPPORT, ()),
+    'go_back': (GO_BACK, ()),
+    'agree_offer': (AGREE_OFFER, ()),
+    'agree_privacy': (AGREE_PRIVACY, ()),
+    'agree_newsletter': (AGREE_NEWSLETTER, ('1',)),
+    'disagree_newsletter': (AGREE_NEWSLETTER, ('0',)),
+    'cancel': (CANCEL, ()),
+    'upd_payment_url': (UPD_PAYMENT_URL, ()),
+    'grant_access': (GRANT_ACCESS, ()),
+    'deny_access': (DENY_ACCESS, ()),
+}
+
+
+def pack(action: str, *args) -> str:
+    """
+    Собирает callback_data в текущем формате.
+
+    :raises ValueError: Если аргумент содержит разделитель или данные длиннее 64 байт —
+                        Telegram не примет такую кнопку, лучше узнать об этом при сборке.
+    """
+    parts = [str(arg) for arg in args]
+    if any(SEP in part for part in parts):
+        raise ValueError(f"Аргумент callback_data содержит '{SEP}': {parts}")
+    data = SEP.join([VERSION + action, *parts])
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+    return data
+
+
+def parse(data: str) -> tuple[str, list] | None:
+    """
+    Разбирает callback_data текущего или старого формата.
+
+    :return: (код действия, аргументы-строки) или None, если формат не распознан.
+    """
+    if not data:
+        return None
+    if data[0] == VERSION:
+        action, *args = data[1:].split(SEP)
+        return action, args
+    name, *args = data.split(SEP)
+    legacy = LEGACY.get(name)
+    if legacy is None:
+        return None
+    action, extra = legacy
+    return action, args + list(extra)
+
+
+def flag(value: str) -> bool:
+    """
+    Тип аргумента "1" / "0".
+    """
+    return value == '1'
+
+
+class CallbackRouter:
+    """
+    Один CallbackQueryHandler на все кнопки бота: callback_data разбирается один раз,
+    обработчик выбирается по коду действия из словаря и получает аргументы уже
+    приведёнными к типам: handler(update, context, *args).
+    """
+
+    def __init__(self):
+        self._routes = {}
+
+    def add(self, action: str, handler, *arg_types):
+        """
+        :param action: Код действия.
+        :param handler: async def handler(update, context, *args); необязательные аргументы — со значением по умолчанию.
+        :param arg_types: Функции приведения аргументов по порядку (str, int, flag...).
+        """
+        params = list(inspect.signature(handler).parameters.values())[2:]
+        required = sum(1 for param in params if param.default is inspect.Parameter.empty)
+        self._routes[action] = (handler, arg_types, required)
+
+    def resolve(self, data: str):
+        """
+        :return: (обработчик, аргументы) или None, если кнопка неизвестна или аргументы не подходят.
+        """
+        parsed = parse(data)
+        if parsed is None:
+            return None
+        action, raw_args = parsed
+        route = self._routes.get(action)
+        if route is None:
+            return None
+        handler, arg_types, required = route
+        if not required <= len(raw_args) <= len(arg_types):
+            return None
+        try:
+            args = [convert(value) for convert, value in zip(arg_types, raw_args)]
+        except ValueError:
+            return None
+        return handler, args
+
+    async def dispatch(self, update: Update, context: CallbackContext):
+        query = update.callback_query
+        resolved = self.resolve(query.data)
+        if resolved is None:
+            logger.warning(f"⚠️ Неизвестная кнопка от {query.from_user.id}: {query.data!r}")
+            await query.answer("Кнопка устарела, откройте меню заново.")
+            return
+        handler, args = resolved
+        await handler(update, context, *args)
+
+    def handler(self) -> CallbackQueryHandler:
+        return CallbackQueryHandler(self.dispatch)
@@ -0,0 +1,179 @@
+import asyncio
+import bisect
+import logging
+import time
+from datetime import datetime
+from typing import NamedTuple
+
+# Настройка логгера
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд перечитывать сегменты целиком (новые пользователи, блокировки, отказы от рассылки).
+# Покупки и ручные доступы приходят сразу — через NOTIFY
+MAX_AGE = 300
+
+
+class Audience(NamedTuple):
+    mask: int        # бит на позиции каждого подходящего пользователя
+    user_ids: list   # позиция -> user_id на момент выборки (load() заменяет список, а не меняет его)
+
+
+def _bitmap(positions) -> int:
+    """
+    Собирает битовую маску из номеров позиций за один проход (без O(n²) на сдвигах).
+    """
+    positions = list(positions)
+    if not positions:
+        return 0
+    buffer = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class Segments:
+    """
+    Аудитории для рассылок в памяти. Каждый пользователь — бит на своей позиции
+    (позиции идут в порядке регистрации), каждый признак — битовая маска (int):
+    владельцы каждого курса, отказавшиеся от рассылки, недоступные.
+    Фильтр — несколько битовых операций над масками.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.user_ids = []        # позиция -> user_id
+        self.positions = {}       # user_id -> позиция
+        self.registered_at = []   # позиция -> created_at, по возрастанию
+        self.owners = {}          # course_chapter -> маска
+        self.newsletter_declined = 0
+        self.unreachable = 0
+        self.loaded_at = None
+        self.loaded_through = None  # по часам БД: кто зарегистрировался позже, в сегментах ещё нет
+        self._dirty = set()       # user_id, у которых поменялись доступы
+        self._reload = True
+        self._lock = asyncio.Lock()
+
+    @property
+    def everyone(self) -> int:
+        return (1 << len(self.user_ids)) - 1
+
+    def on_entitlements_changed(self, user_id: int | None):
+        """
+        Колбэк для Database.entitlement_listeners: доступы пользователя поменялись
+        (None — могли поменяться у всех, например после переподключения слушателя).
+        """
+        if user_id is None:
+            self._reload = True
+        else:
+            self._dirty.add(user_id)
+
+    async def load(self):
+        """
+        Перечитывает все сегменты из БД.
+        """
+        started = time.perf_counter()
+        loaded_through, users = await self.db.get_segment_users()
+        courses = await self.db.get_segment_courses()
+        declined = await self.db.get_newsletter_declined_users()
+
+        self.user_ids = [user['user_id'] for user in users]
+        self.positions = {user_id: position for position, user_id in enumerate(self.user_ids)}
+        self.registered_at = [user['created_at'] for user in users]
+        self.unreachable = _bitmap(position for position, user in enumerate(users) if user['unreachable'])
+
+        owners = {}
+        for user_id, chapter in courses:
+            position = self.positions.get(user_id)
+            if position is not None:
+                owners.setdefault(chapter, []).append(position)
+        self.owners = {chapter: _bitmap(positions) for chapter, positions in owners.items()}
+        self.newsletter_declined = _bitmap(self.positions[user_id] for user_id in declined if user_id in self.positions)
+
+        self.loaded_at = time.monotonic()
+        self.loaded_through = loaded_through
+        self._reload = False
+        self._dirty.clear()
+        logger.info(f"🧮 Сегменты загружены: {len(self.user_ids)} пользователей "
+                    f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    async def _refresh_dirty(self):
+        user_ids, self._dirty = list(self._dirty), set()
+        for user_id in user_ids:
+            position = self.positions.get(user_id)
+            if position is None:
+                # Новый пользователь — попадёт в сегменты при следующей полной загрузке
+                continue
+            bit = 1 << position
+            entitlements = await self.db.get_user_entitlements(user_id)
+            for chapter in set(self.owners) | entitlements.all:
+                if chapter in entitlements.all:
+                    self.owners[chapter] = self.owners.get(chapter, 0) | bit
+                else:
+                    self.owners[chapter] &= ~bit
+
+    async def ensure_fresh(self, registered_before: datetime = None):
+        """
+        :param registered_before: Нужны все зарегистрированные до этого момента — если загрузка
+                                  была раньше (drip с нулевой задержкой), перечитать сегменты.
+        """
+        async with self._lock:
+            stale = registered_before is not None and (self.loaded_through is None
+                                                       or registered_before > self.loaded_through)
+            if stale or self._reload or self.loaded_at is None or time.monotonic() - self.loaded_at > MAX_AGE:
+                await self.load()
+            elif self._dirty:
+                await self._refresh_dirty()
+
+    async def select(self, owns: list[str] = (), not_owns: list[str] = (), consented: bool = True,
+                     reachable: bool = True, registered_after: datetime = None,
+                     registered_before: datetime = None) -> Audience:
+        """
+        Маска пользователей, подходящих под все условия.
+
+        :param owns: Курсы, которые у пользователя должны быть (все).
+        :param not_owns: Курсы, которых у пользователя быть не должно (ни одного).
+        :param consented: Только не отказавшиеся от рассылки.
+        :param reachable: Только не заблокировавшие бота.
+        :param registered_after: Только зарегистрированные после этого момента (время без зоны, как users.created_at).
+        :param registered_before: Только зарегистрированные не позже этого момента.
+        :return: Audience — маска вместе со списком user_id, по которому она построена;
+                 user_id — через user_ids_of(), количество — count().
+        """
+        await self.ensure_fresh(registered_before)
+        result = self.everyone
+        for chapter in owns:
+            result &= self.owners.get(chapter, 0)
+        for chapter in not_owns:
+            result &= ~self.owners.get(chapter, 0)
+        if consented:
+            result &= ~self.newsletter_declined
+        if reachable:
+            result &= ~self.unreachable
+        if registered_after is not None:
+            # Позиции упорядочены по дате регистрации — отсекаем префикс
+            start = bisect.bisect_right(self.registered_at, registered_after)
+            result &= ~((1 << start) - 1)
+        if registered_before is not None:
+            end = bisect.bisect_right(self.registered_at, registered_before)
+            result &= (1 << end) - 1
+        # Между select и user_ids_of сегменты могут перезагрузиться — позиции
+        # остаются привязаны к списку этой выборки
+        return Audience(result, self.user_ids)
+
+    @staticmethod
+    def count(audience: Audience) -> int:
+        return audience.mask.bit_count()
+
+    @staticmethod
+    def user_ids_of(audience: Audience):
+        """
+        Генератор user_id из выборки, без промежуточного списка.
+        """
+        user_ids = audience.user_ids
+        # Строка бит, младший бит первым: поиск единиц идёт на уровне C
+        bits = bin(audience.mask)[:1:-1]
+        position = bits.find('1')
+        while position != -1:
+            yield user_ids[position]
+            position = bits.find('1', position + 1)
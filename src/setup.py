@@ -1,8 +1,20 @@
 import pytz
 import postgresdb
 from datetime import datetime
+from order_codes import OrderCodeAllocator
+from media_registry import MediaRegistry
+from broadcast import BroadcastJobs
+from segments import Segments
+from campaigns import Campaigns
+from join_requests import JoinRequestBatcher
 
 pdb = postgresdb.Database()
+order_code_allocator = OrderCodeAllocator(pdb)
+media_registry = MediaRegistry(pdb)
+broadcast_jobs = BroadcastJobs(pdb, media_registry)
+segments = Segments(pdb)
+campaigns = Campaigns(pdb, segments, broadcast_jobs)
+join_requests = JoinRequestBatcher(pdb)
 
 # Установка часового пояса МСК
 utc_tz = pytz.utc
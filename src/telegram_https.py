@@ -1,3 +1,7 @@
+import asyncio
+import time
+from collections import OrderedDict
+
 import aiohttp
 import config
 import logging
@@ -6,89 +10,289 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Адрес Bot API можно переопределить (локальный Bot API сервер, фейк для бенчмарка)
+API_URL = config.config_env.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Одновременных соединений к Bot API на процесс
+CONNECTION_LIMIT = int(config.config_env.get('TELEGRAM_CONNECTION_LIMIT', 100))
+# Сколько последних чатов помнить для поштучного лимита
+CHAT_BUCKETS_SIZE = 10000
+# Как часто писать в лог очередь и троттлинг Dispatcher, секунд
+STATS_INTERVAL = 60
+
+# Методы, на которые действуют лимиты Telegram на чат / группу
+SEND_METHODS_PREFIXES = ('send', 'copy', 'forward')
+
+# Общая на процесс сессия: соединения и TLS переиспользуются между запросами
+_session: aiohttp.ClientSession | None = None
+
+
+def rate_limits(process: str) -> dict:
+    """
+    Лимиты Bot API для процесса. Лимиты действуют на весь токен, а отправляют
+    несколько процессов, поэтому каждый берёт свою долю общего лимита (config/other.yml → telegram_limits).
+    Бакеты живут в памяти процесса и между процессами не согласуются — общий лимит
+    соблюдается только за счёт того, что доли в сумме не больше 1.
+
+    :param process: Имя процесса из telegram_limits.shares (bot, webhook, outbox, broadcast).
+    :return: {'overall_per_second', 'chat_per_second', 'group_per_minute', 'max_retries'}
+    """
+    limits = config.other_cfg['telegram_limits']
+    share = limits['shares'][process]
+    return {
+        'overall_per_second': limits['overall_per_second'] * share,
+        # Лимиты на чат не делим: личный чат почти всегда обслуживает один процесс,
+        # а всё потоковое в админский чат идёт через outbox (остальные шлют туда разовые сообщения)
+        'chat_per_second': limits['chat_per_second'],
+        'group_per_minute': limits['group_per_minute'],
+        'max_retries': limits['max_retries']
+    }
+
+
+class TokenBucket:
+    """
+    Токен-бакет: rate токенов за period секунд, запас не больше capacity.
+    """
+
+    def __init__(self, rate: float, period: float = 1.0, capacity: float = None):
+        self.rate = rate / period
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (delay := self.wait_time()) > 0:
+            await asyncio.sleep(delay)
+        self.tokens -= 1
+
+
+class Dispatcher:
+    """
+    Отправка запросов в Bot API с соблюдением лимитов: общий на процесс,
+    на личный чат и на группу. На 429 ставит на паузу все отправки процесса
+    и повторяет запрос после retry_after.
+    """
+
+    def __init__(self, overall_per_second: float, chat_per_second: float, group_per_minute: float,
+                 max_retries: int):
+        self.overall = TokenBucket(overall_per_second)
+        self.chat_per_second = chat_per_second
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._chats = OrderedDict()  # chat_id -> TokenBucket
+        self._paused_until = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.throttled = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Группы и каналы (отрицательный id или @username) — лимит в минуту
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_per_minute, period=60)
+            else:
+                bucket = TokenBucket(self.chat_per_second)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > CHAT_BUCKETS_SIZE:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    def chat_wait_time(self, method: str, chat_id) -> float:
+        """
+        Сколько секунд запрос ждал бы лимита чата (токен не расходуется).
+        """
+        if chat_id is None or not method.startswith(SEND_METHODS_PREFIXES):
+            return 0.0
+        return self._chat_bucket(chat_id).wait_time()
+
+    async def _acquire(self, method: str, chat_id):
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+        if chat_id is not None and method.startswith(SEND_METHODS_PREFIXES):
+            await self._chat_bucket(chat_id).acquire()
+        await self.overall.acquire()
+
+    async def call(self, method: str, payload: dict) -> tuple[int, dict]:
+        """
+        Выполняет метод Bot API, дожидаясь своей очереди по лимитам.
+
+        :return: (HTTP-статус, ответ Telegram). Если 429 повторился больше max_retries раз,
+                 возвращается последний ответ с 429.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.queued += 1
+            try:
+                await self._acquire(method, payload.get('chat_id'))
+            finally:
+                self.queued -= 1
+
+            self.in_flight += 1
+            try:
+                status, response_data = await _post(method, payload)
+            finally:
+                self.in_flight -= 1
+
+            if response_data.get('error_code') != 429:
+                self.sent += 1
+                return status, response_data
+
+            self.throttled += 1
+            retry_after = response_data.get('parameters', {}).get('retry_after', 1)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning(f"⏳ 429 на {method}: пауза {retry_after} с (попытка {attempt + 1})")
+        return status, response_data
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'paused_for': max(0.0, self._paused_until - time.monotonic())
+        }
+
+
+# Пока процесс не вызвал start() со своим именем, действует доля webhook
+dispatcher = Dispatcher(**rate_limits('webhook'))
+
+
+async def log_stats_forever(interval: float = STATS_INTERVAL):
+    """
+    Раз в interval секунд пишет в лог Dispatcher.stats(): глубину очереди, запросы в работе,
+    отправленные и 429 за период. Пока отправок не было, молчит.
+    """
+    last_sent = last_throttled = 0
+    while True:
+        await asyncio.sleep(interval)
+        stats = dispatcher.stats()
+        sent, throttled = stats['sent'] - last_sent, stats['throttled'] - last_throttled
+        last_sent, last_throttled = stats['sent'], stats['throttled']
+        if not (sent or throttled or stats['queued'] or stats['in_flight']):
+            continue
+        logger.info(f"📊 Bot API: в очереди {stats['queued']}, в работе {stats['in_flight']}, "
+                    f"отправлено {sent} и 429 — {throttled} за {interval:g} с, "
+                    f"пауза {stats['paused_for']:.1f} с")
+
+
+async def start(process: str = None):
+    """
+    Создаёт общую сессию и настраивает лимиты процесса.
+    Вызывается при старте процесса (lifespan FastAPI, воркеры).
+
+    :param process: Имя процесса из telegram_limits.shares.
+    """
+    global _session, dispatcher
+    if process is not None:
+        dispatcher = Dispatcher(**rate_limits(process))
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30, connect=10)
+        )
+
+
+async def close():
+    """
+    Закрывает общую сессию при остановке процесса.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _post(method: str, payload: dict) -> tuple[int, dict]:
+    # Если start() не вызывали, сессия создаётся при первом запросе
+    if _session is None or _session.closed:
+        await start()
+    url = f"{API_URL}/bot{config.config_env['TELEGRAM_TOKEN']}/{method}"
+    async with _session.post(url, json=payload) as response:
+        return response.status, await response.json()
+
 
 async def send_message(user_id: int, text, reply_markup=None, message_thread_id=None, reply_to_message_id=None,
                        disable_web_page_preview=True):
-    # Проверяем, соответствует ли событие успешной оплате
-    async with aiohttp.ClientSession() as session:
-        # Здесь необходимо указать ваш токен и chat_id
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/sendMessage"
-        payload = {
-            'chat_id': user_id,  # Укажите chat_id группы
-            'text': text,
-            'parse_mode': 'HTML',
-            'disable_web_page_preview': disable_web_page_preview,
-        }
+    payload = {
+        'chat_id': user_id,  # Укажите chat_id группы
+        'text': text,
+        'parse_mode': 'HTML',
+        'disable_web_page_preview': disable_web_page_preview,
+    }
 
-        # Если передан message_thread_id, добавляем его в payload
-        if message_thread_id is not None:
-            payload['message_thread_id'] = message_thread_id
+    # Если передан message_thread_id, добавляем его в payload
+    if message_thread_id is not None:
+        payload['message_thread_id'] = message_thread_id
 
-        # Если передан reply_to_message_id, добавляем его в payload для ответа на сообщение
-        if reply_to_message_id is not None:
-            payload['reply_to_message_id'] = reply_to_message_id
+    # Если передан reply_to_message_id, добавляем его в payload для ответа на сообщение
+    if reply_to_message_id is not None:
+        payload['reply_to_message_id'] = reply_to_message_id
 
-        # Преобразуем InlineKeyboardMarkup в JSON
-        if reply_markup is not None:
-            payload['reply_markup'] = reply_markup.to_dict()  # Преобразуем в формат JSON для отправки
+    # Преобразуем InlineKeyboardMarkup в JSON
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup.to_dict()  # Преобразуем в формат JSON для отправки
 
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200:
-                logger.info("Message sent to Telegram successfully")
-            else:
-                logger.error(f"Failed to send message to Telegram: {response_data}")
+    status, response_data = await dispatcher.call('sendMessage', payload)
+    if status == 200:
+        logger.info("Message sent to Telegram successfully")
+    else:
+        logger.error(f"Failed to send message to Telegram: {response_data}")
 
 
 async def send_location(user_id: int, latitude: float, longitude: float):
-    # Проверяем, соответствует ли событие успешной оплате
-    async with aiohttp.ClientSession() as session:
-        # Здесь необходимо указать ваш токен и chat_id
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/sendLocation"
-        payload = {
-            'chat_id': user_id,  # Укажите chat_id группы
-            'latitude': latitude,
-            'longitude': longitude,
-        }
+    payload = {
+        'chat_id': user_id,  # Укажите chat_id группы
+        'latitude': latitude,
+        'longitude': longitude,
+    }
 
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200:
-                logger.info("Message sent to Telegram successfully")
-            else:
-                logger.error(f"Failed to send message to Telegram: {response_data}")
+    status, response_data = await dispatcher.call('sendLocation', payload)
+    if status == 200:
+        logger.info("Message sent to Telegram successfully")
+    else:
+        logger.error(f"Failed to send message to Telegram: {response_data}")
 
 
 async def send_photo(user_id: int, photo, reply_markup=None, message_thread_id=None, reply_to_message_id=None,
                      disable_web_page_preview=True):
-    # Проверяем, соответствует ли событие успешной оплате
-    async with aiohttp.ClientSession() as session:
-        # Здесь необходимо указать ваш токен и chat_id
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/sendPhoto"
-        payload = {
-            'chat_id': user_id,  # Укажите chat_id группы
-            'photo': text,
-            'disable_web_page_preview': disable_web_page_preview,
-        }
+    payload = {
+        'chat_id': user_id,  # Укажите chat_id группы
+        'photo': photo,
+        'disable_web_page_preview': disable_web_page_preview,
+    }
 
-        # Если передан message_thread_id, добавляем его в payload
-        if message_thread_id is not None:
-            payload['message_thread_id'] = message_thread_id
+    # Если передан message_thread_id, добавляем его в payload
+    if message_thread_id is not None:
+        payload['message_thread_id'] = message_thread_id
 
-        # Если передан reply_to_message_id, добавляем его в payload для ответа на сообщение
-        if reply_to_message_id is not None:
-            payload['reply_to_message_id'] = reply_to_message_id
+    # Если передан reply_to_message_id, добавляем его в payload для ответа на сообщение
+    if reply_to_message_id is not None:
+        payload['reply_to_message_id'] = reply_to_message_id
 
-        # Преобразуем InlineKeyboardMarkup в JSON
-        if reply_markup is not None:
-            payload['reply_markup'] = reply_markup.to_dict()  # Преобразуем в формат JSON для отправки
+    # Преобразуем InlineKeyboardMarkup в JSON
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup.to_dict()  # Преобразуем в формат JSON для отправки
 
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200:
-                logger.info("Message sent to Telegram successfully")
-            else:
-                logger.error(f"Failed to send message to Telegram: {response_data}")
+    status, response_data = await dispatcher.call('sendPhoto', payload)
+    if status == 200:
+        logger.info("Message sent to Telegram successfully")
+    else:
+        logger.error(f"Failed to send message to Telegram: {response_data}")
 
 
 async def edit_reply_markup(chat_id: int, message_id: int, reply_markup: dict):
@@ -99,27 +303,22 @@ async def edit_reply_markup(chat_id: int, message_id: int, reply_markup: dict):
     :param message_id: ID сообщения, для которого нужно изменить клавиатуру.
     :param reply_markup: Словарь с текстом кнопок и их callback_data.
     """
-    async with aiohttp.ClientSession() as session:
-        # Формируем URL для запроса
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/editMessageReplyMarkup"
-
-        # Преобразуем reply_markup в формат JSON для Telegram API
-        inline_keyboard = [
-            [{"text": text, "callback_data": callback_data}]
-            for text, callback_data in reply_markup.items()
-        ]
-        payload = {
-            'chat_id': chat_id,
-            'message_id': message_id,
-            'reply_markup': {"inline_keyboard": inline_keyboard}
-        }
+    # Преобразуем reply_markup в формат JSON для Telegram API
+    inline_keyboard = [
+        [{"text": text, "callback_data": callback_data}]
+        for text, callback_data in reply_markup.items()
+    ]
+    payload = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'reply_markup': {"inline_keyboard": inline_keyboard}
+    }
 
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200 and response_data.get("ok"):
-                logger.info("Reply markup updated successfully")
-            else:
-                logger.error(f"Failed to update reply markup: {response_data}")
+    status, response_data = await dispatcher.call('editMessageReplyMarkup', payload)
+    if status == 200 and response_data.get("ok"):
+        logger.info("Reply markup updated successfully")
+    else:
+        logger.error(f"Failed to update reply markup: {response_data}")
 
 
 async def delete_message(chat_id: int, message_id: int):
@@ -129,19 +328,16 @@ async def delete_message(chat_id: int, message_id: int):
     :param chat_id: ID чата (или пользователя), откуда нужно удалить сообщение.
     :param message_id: ID сообщения, которое нужно удалить.
     """
-    async with aiohttp.ClientSession() as session:
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/deleteMessage"
-        payload = {
-            'chat_id': chat_id,
-            'message_id': message_id
-        }
+    payload = {
+        'chat_id': chat_id,
+        'message_id': message_id
+    }
 
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200 and response_data.get("ok"):
-                logger.info(f"✅ Сообщение {message_id} успешно удалено у {chat_id}")
-            else:
-                logger.error(f"❌ Ошибка при удалении сообщения {message_id} у {chat_id}: {response_data}")
+    status, response_data = await dispatcher.call('deleteMessage', payload)
+    if status == 200 and response_data.get("ok"):
+        logger.info(f"✅ Сообщение {message_id} успешно удалено у {chat_id}")
+    else:
+        logger.error(f"❌ Ошибка при удалении сообщения {message_id} у {chat_id}: {response_data}")
 
 
 async def create_invite_link(chat_id: int, creates_join_request: bool, name: str = None,
@@ -156,25 +352,35 @@ async def create_invite_link(chat_id: int, creates_join_request: bool, name: str
     :param creates_join_request: Требуется ли одобрение (по умолчанию False).
     :return: Словарь с результатом или None при ошибке.
     """
-    async with aiohttp.ClientSession() as session:
-        url = f"https://api.telegram.org/bot{config.config_env['TELEGRAM_TOKEN']}/createChatInviteLink"
-        payload = {
-            'chat_id': chat_id,
-            'member_limit': member_limit,
-            'creates_join_request': creates_join_request
-        }
+    payload = {
+        'chat_id': chat_id,
+        'member_limit': member_limit,
+        'creates_join_request': creates_join_request
+    }
 
-        if name:
-            payload['name'] = name
-        if expire_date:
-            payload['expire_date'] = expire_date
-
-        async with session.post(url, json=payload) as response:
-            response_data = await response.json()
-            if response.status == 200 and response_data.get("ok"):
-                invite_link = response_data['result']['invite_link']
-                logger.info(f"🔗 Ссылка создана: {invite_link}")
-                return response_data['result']['invite_link']
-            else:
-                logger.error(f"❌ Ошибка при создании ссылки: {response_data}")
-                return None
\ No newline at end of file
+    if name:
+        payload['name'] = name
+    if expire_date:
+        payload['expire_date'] = expire_date
+
+    status, response_data = await dispatcher.call('createChatInviteLink', payload)
+    if status == 200 and response_data.get("ok"):
+        invite_link = response_data['result']['invite_link']
+        logger.info(f"🔗 Ссылка создана: {invite_link}")
+        return response_data['result']['invite_link']
+    else:
+        logger.error(f"❌ Ошибка при создании ссылки: {response_data}")
+        return None
+
+
+async def call_api(method: str, payload: dict) -> dict:
+    """
+    Вызывает произвольный метод Bot API и возвращает ответ как есть.
+    Ошибки сети пробрасываются вызывающему.
+
+    :param method: Имя метода (sendMessage, deleteMessage, ...).
+    :param payload: Параметры метода.
+    :return: Ответ Telegram: {'ok': ..., 'result' | 'error_code', 'description', 'parameters'}.
+    """
+    _, response_data = await dispatcher.call(method, payload)
+    return response_data
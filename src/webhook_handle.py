@@ -1,9 +1,12 @@
-from fastapi import FastAPI, BackgroundTasks
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.responses import PlainTextResponse
 import logging
 import config
+from catalog import catalog
 from other_func import escape_user_data
 import telegram_https
 from fastapi import Request
@@ -15,7 +18,21 @@ from jinja2 import Template
 # Настройка логгера
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Пул подключений к БД и HTTP-сессия Bot API живут столько же, сколько процесс uvicorn
+    await pdb.connect()
+    await telegram_https.start('webhook')
+    stats_task = asyncio.create_task(telegram_https.log_stats_forever())
+    yield
+    stats_task.cancel()
+    await telegram_https.close()
+    await pdb.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Настройка CORS
 app.add_middleware(
@@ -28,13 +45,13 @@ app.add_middleware(
 
 
 @app.post("/webhook/yookassa/")
-async def yookassa_webhook(request: Request, background_tasks: BackgroundTasks):
+async def yookassa_webhook(request: Request):
     data = await request.json()
     payment_object = data.get('object', {})
     payment_id = payment_object.get('id')
 
     # Проверяем, был ли платеж уже обработан
-    if pdb.payment_exists(payment_id):
+    if await pdb.payment_exists(payment_id):
         logger.info(f"Payment {payment_id} already processed. Skipping.")
         return {"status": "ok"}
 
@@ -46,13 +63,13 @@ async def yookassa_webhook(request: Request, background_tasks: BackgroundTasks):
     user_id = int(payment_object.get('metadata', {}).get('user_id'))
     chapter = payment_object.get('metadata', {}).get('chapter', '')
     order_id = int(payment_object.get('metadata', {}).get('order_id', ''))
-    course = config.courses.get(chapter)
+    course = catalog.get(chapter)
 
-    channel_invite_url = course['channel_invite_link']
-    channel_name = course['name']
+    channel_invite_url = course.channel_invite_link
+    channel_name = course.name
 
-    pdb.add_payment(external_payment_id=payment_id, amount=amount, income_amount=income_amount,
-                    payment_method_type=payment_method_type, order_id=order_id)
+    await pdb.add_payment(external_payment_id=payment_id, amount=amount, income_amount=income_amount,
+                          payment_method_type=payment_method_type, order_id=order_id)
 
     keyboard = [
         [InlineKeyboardButton("Вступить в канал ✅", url=channel_invite_url)],
@@ -67,8 +84,93 @@ async def yookassa_webhook(request: Request, background_tasks: BackgroundTasks):
     return {"status": "ok"}
 
 
+def build_payment_outbox(paid_order: dict, inv_id: int, out_sum: float, payment_method_type: str,
+                         income_amount: float) -> list[tuple[int, str, dict]]:
+    """
+    Собирает сообщения после оплаты: удаление сообщения со ссылкой на оплату,
+    ссылки на каналы пользователю и уведомление администратору.
+
+    :param paid_order: Строка, которую вернул pdb.record_payment.
+    :return: Список (chat_id, method, payload) для outbox.
+    """
+    user_id = paid_order['user_id']
+    messages = []
+
+    # Удаляем сообщение об оплате (если было)
+    if paid_order['payment_message_id']:
+        messages.append((user_id, 'deleteMessage', {
+            'chat_id': user_id,
+            'message_id': paid_order['payment_message_id']
+        }))
+
+    # Разбиваем курсы
+    formatted_chapters = paid_order['course_chapter']
+    course_names = []
+    for chapter_key in formatted_chapters:
+        course = catalog.get(chapter_key)
+        if not course:
+            logger.warning(f"❌ Курс по ключу '{chapter_key}' не найден.")
+            continue
+
+        course_names.append(course.name)
+        channel_name = course.name
+        # Персональная одноразовая ссылка из запаса; если он кончился — общая из courses.yml
+        channel_invite_url = paid_order.get('invite_links', {}).get(chapter_key) or course.channel_invite_link
+
+        keyboard = [[InlineKeyboardButton("Вступить в канал ✅", url=channel_invite_url)]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        messages.append((user_id, 'sendMessage', {
+            'chat_id': user_id,
+            'text': f"🎉 Вы успешно оплатили курс <b>{channel_name}</b>!\n\n"
+                    f"Нажмите кнопку ниже, чтобы вступить в канал:",
+            'parse_mode': 'HTML',
+            'disable_web_page_preview': True,
+            'reply_markup': reply_markup.to_dict()
+        }))
+
+    # Подготовка данных о пользователе
+    first_name = escape_user_data(paid_order['first_name'] or '')
+    last_name = escape_user_data(paid_order['last_name'] or '')
+    username = escape_user_data(paid_order['username'] or '')
+
+    user_data = {
+        "user_id": user_id,
+        "full_name": f"{first_name} {last_name}".strip(),
+        "username": username
+    }
+
+    # Рендерим блок про пользователя
+    user_template_str = config.admin_msg['user_info_block']
+    user_info_block = Template(user_template_str).render(**user_data)
+
+    # Рендерим общее сообщение админу
+    admin_template_str = config.admin_msg['admin_payment_notification']
+    admin_payment_notification_text = Template(admin_template_str).render(
+        user_info_block=user_info_block,
+        channel_names=course_names,
+        out_sum=out_sum,
+        payment_method_type=payment_method_type,
+        income_amount=income_amount,
+        user_id=user_id,
+        order_code=inv_id,
+        formatted_chapters=formatted_chapters
+    )
+
+    # Уведомление администратору
+    admin_chat_id = int(config.cfg['ADMIN_CHAT_ID']['MAIN'])
+    messages.append((admin_chat_id, 'sendMessage', {
+        'chat_id': admin_chat_id,
+        'text': admin_payment_notification_text,
+        'parse_mode': 'HTML',
+        'disable_web_page_preview': True,
+        'message_thread_id': config.cfg['ADMIN_CHAT_ID']['PAYMENTS']
+    }))
+    return messages
+
+
 @app.post("/webhook/robokassa/", response_class=PlainTextResponse)
-async def robokassa_webhook(request: Request, background_tasks: BackgroundTasks):
+async def robokassa_webhook(request: Request):
     form = await request.form()
     data = dict(form)
     logger.info(f"📥 Robokassa webhook data: {data}")
@@ -80,98 +182,32 @@ async def robokassa_webhook(request: Request, background_tasks: BackgroundTasks)
         fee = float(data.get("Fee", 0.0))
         income_amount = out_sum - fee
 
-        user_id = int(data.get("shp_user_id"))
-        order_id = int(data.get("shp_order_id"))
-        formatted_chapter = data.get("shp_formatted_chapter")
-
-        # Проверка: уже обработан?
-        if pdb.payment_exists_by_order_code(inv_id):
-            logger.info(f"🔁 Платёж по order_code={inv_id} уже обработан. Пропускаем.")
-            return "OK"
-
-        # Удаляем сообщение об оплате (если было)
-        try:
-            payment_message_id = pdb.get_payment_message_id(order_id)
-            background_tasks.add_task(
-                telegram_https.delete_message,
-                chat_id=user_id,
-                message_id=payment_message_id
-            )
-        except Exception as e:
-            logger.warning(f"⚠️ Не удалось удалить сообщение об оплате: {e}")
-
-        # Сохраняем платёж
-        pdb.add_payment(
+        def payment_outbox(row: dict) -> list:
+            # Ошибка в шаблоне не должна откатывать саму оплату
+            try:
+                return build_payment_outbox(row, inv_id, out_sum, payment_method_type, income_amount)
+            except Exception as e:
+                logger.error(f"❗ Не удалось собрать уведомления по InvId={inv_id}: {e}")
+                return []
+
+        # Платёж, доступы и сообщения в outbox — в одной транзакции.
+        # Отправляет их outbox_worker.py; повторное уведомление по тому же InvId вернёт None
+        paid_order = await pdb.record_payment(
+            order_code=inv_id,
             amount=out_sum,
             income_amount=income_amount,
             payment_method_type=payment_method_type,
-            order_id=order_id
-        )
-
-        # Разбиваем курсы
-        formatted_chapters = formatted_chapter.split(',')
-        course_names = []
-        for chapter_key in formatted_chapters:
-            course = config.courses.get(chapter_key)
-            if not course:
-                logger.warning(f"❌ Курс по ключу '{chapter_key}' не найден.")
-                continue
-
-            course_names.append(course["name"])
-            channel_name = course["name"]
-            channel_invite_url = course["channel_invite_link"]
-
-            keyboard = [[InlineKeyboardButton("Вступить в канал ✅", url=channel_invite_url)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            background_tasks.add_task(
-                telegram_https.send_message,
-                user_id=user_id,
-                text=f"🎉 Вы успешно оплатили курс <b>{channel_name}</b>!\n\n"
-                     f"Нажмите кнопку ниже, чтобы вступить в канал:",
-                reply_markup=reply_markup
-            )
-
-        # Подготовка данных о пользователе
-        user_info = pdb.get_user_by_user_id(user_id)
-        first_name = escape_user_data(user_info.get('first_name', ''))
-        last_name = escape_user_data(user_info.get('last_name', ''))
-        username = escape_user_data(user_info.get('username', ''))
-
-        user_data = {
-            "user_id": user_id,
-            "full_name": f"{first_name} {last_name}".strip(),
-            "username": username
-        }
-
-        # Рендерим блок про пользователя
-        user_template_str = config.admin_msg['user_info_block']
-        user_info_block = Template(user_template_str).render(**user_data)
-
-        # Рендерим общее сообщение админу
-        admin_template_str = config.admin_msg['admin_payment_notification']
-        admin_payment_notification_text = Template(admin_template_str).render(
-            user_info_block=user_info_block,
-            channel_names=course_names,
-            out_sum=out_sum,
-            payment_method_type=payment_method_type,
-            income_amount=income_amount,
-            user_id=user_id,
-            order_code=inv_id,
-            formatted_chapters=formatted_chapters
-        )
-
-        # Уведомление администратору
-        background_tasks.add_task(
-            telegram_https.send_message,
-            user_id=config.cfg['ADMIN_CHAT_ID']['MAIN'],
-            text=admin_payment_notification_text,
-            message_thread_id=config.cfg['ADMIN_CHAT_ID']['PAYMENTS']
+            build_outbox=payment_outbox
         )
+        if paid_order is None:
+            logger.info(f"🔁 Платёж по order_code={inv_id} уже обработан. Пропускаем.")
+            return "OK"
 
-        logger.info(f"✅ Платёж InvId={inv_id} от user_id={user_id} успешно обработан.")
+        logger.info(f"✅ Платёж InvId={inv_id} от user_id={paid_order['user_id']} успешно обработан.")
         return "OK"
 
     except Exception as e:
+        # Не "OK": Robokassa повторит уведомление, а record_payment идемпотентен.
+        # Иначе оплаченный заказ при сбое БД потерялся бы насовсем
         logger.error(f"❗ Ошибка обработки Robokassa webhook: {e}")
-        return "OK"
\ No newline at end of file
+        return PlainTextResponse("ERROR", status_code=500)